@@ -1,7 +1,18 @@
 import sys
 import re
 import os
+import time
+import glob
+import json
+import math
+import bisect
+import hashlib
+import operator
+import cProfile
+import argparse
+from array import array
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 
 # table of all instructions and their (basic) opcode
 instructions : tuple = (('add', 'a', '#U8', '0x4300'),
@@ -75,128 +86,739 @@ special_args : tuple = ('', '#S8', '#U8', '#U16')
 # tuple of number arguments
 num_args : tuple = ('#S8', '#U8', '#U16')
 
-# each instruction gets assigned a calculated number to identify it
-fingerprint : list = []
+# operand classes used as keys of table 'encodings'
+# a named argument ('a', 'status', ...) is its own class
+ARG_NONE = ''		# no argument
+ARG_NUM = '#'		# number or label (#S8, #U8 or #U16)
 
-# table of assembler directives
-directives : tuple = ('org_e', 'org_i', 'equ', 'res_i', 'res_e', 'dw_e')
-
-# two arrays with reserved names
-named_args : tuple = ()
-mnemonics_and_directives : tuple = ()
-
-# each source file is first read into 'single_source' and converted to all lower case
-single_source : list = []  
-# by resolving the includes all source files are aggregated in 'full_source'
-full_source : list = []     
 
-# the pure source code is extracted from 'full_source' into 'code'
-code : list = []    
+# bits 15:14 (CYC) of an opcode give the number of cycles of the instruction:
+# 00 : 1 cycle, 01 : 2 cycles, 10 : 3 cycles, 11 : branch, 1 if not taken, 2 if taken
+# returns (minimum, maximum)
+def opcode_cycles(opcode):
+    return ((1, 1), (2, 2), (3, 3), (1, 2))[opcode >> 14]
 
-# named constants for columns of array 'code'
-# 0 - 4  : source code
-C_LNUM = 0		# line number of source code
-C_LBL = 1		# label (address of the EC16)
-C_MNE = 2		# mnemonic
-C_ARG1 = 3		# first argument
-C_ARG2 = 4		# second argument
-# 5 - 9 : assembler temporary output
-C_OLT = 5		# flag for linker 
-C_ADDR = 6		# address of the EC16
-C_OPC = 7		# full resp. upper half of opcode
-C_OPCLO = 8		# lower half of opcode (#S8/#U8)
-C_ARG = 9		# #U16 argument
 
+# encoding record for one entry of table 'instructions'
+class Encoding:
+    __slots__ = ('mnemonic', 'opcode', 'arg1', 'arg2', 'length', 'cycles')
 
-lbl_line : list = []       # list of source code line numbers where labels are defined
-lbl_name : list = []       # list of label names
-lbl_value : list = []      # list of label values
-
-filename : str = ""
-list_of_filenames : list = [] # list of included files to avoid multiple inclusions
-listing_name : str = ""  # name of first asm file but with extension .lst
+    def __init__(self, instr):
+        self.mnemonic = instr[I_MNE]
+        self.opcode = int(instr[I_OPC], 16)	# basic opcode
+        self.arg1 = instr[I_ARG1]		# operand kind of first argument
+        self.arg2 = instr[I_ARG2]		# operand kind of second argument
+        # instructions with a #U16 argument need a second word
+        if '#U16' in (self.arg1, self.arg2):
+            self.length = 2
+        else:
+            self.length = 1
+        self.cycles = opcode_cycles(self.opcode)	# (minimum, maximum)
 
-line : list = []  #holds current source code line
-linenum : int = 0  # holds number of current source code line
 
-extmem_cnt : int = 0  # counter for external memory location (0..65535)
-intmem_cnt : int = 0  # counter for internal memory location (0..255)
+# each instruction is identified by its mnemonic and the classes of its arguments
+# (mnemonic, class of arg1, class of arg2) -> Encoding
+encodings : dict = {}
 
+# table of assembler directives
+directives : tuple = ('org_e', 'org_i', 'equ', 'res_i', 'res_e', 'dw_e')
 
+# directives of the preprocessor (step 1b), they never reach step 3
+preprocessor_directives : tuple = ('macro', 'endm', 'rept', 'endr', 'if', 'ifdef', 'ifndef',
+                                   'else', 'endif')
+PRE_CONDITIONALS : frozenset = frozenset(('if', 'ifdef', 'ifndef', 'else', 'endif'))
+
+# source files without these directives skip the preprocessor: the lowercase text
+# is searched for the words, only the lines found are matched by 'preprocessor_line'
+preprocessor_word = re.compile(r'macro|rept|if')
+preprocessor_line = re.compile(r'''[ \t]*(?:[^\s;"']+[ \t]+)?(?:macro|rept|if|ifdef|ifndef)(?![^\s,;])''')
+
+# macro calls nested deeper than this are taken as endless recursion
+MAX_MACRO_DEPTH = 64
+
+# two sets with reserved names
+named_args : frozenset = frozenset()
+mnemonics_and_directives : frozenset = frozenset()
+
+# kinds of the tokens made by the lexer of step 2, each token is a tuple (kind, value)
+TOK_LABEL = 'label'		# any other name: a label or a reference to one, lowercase
+TOK_MNEMONIC = 'mnemonic'	# mnemonic or directive, lowercase
+TOK_REGISTER = 'register'	# reserved argument name (a, c, ie, status, ...), lowercase
+TOK_NUMBER = 'number'		# integer, the value is parsed by the lexer
+TOK_STRING = 'string'		# text in quotes, kept with its quotes and case
+TOK_COMMA = 'comma'		# optional separator of arguments
+TOK_EXPR = 'expr'		# expression of numbers, labels and operators (see parse_expression), lowercase
+
+# regular expression of the lexer, each match is either a comment up to the end of
+# the line (group 1), a text in quotes (group 2), a comma (group 3) or a word,
+# i.e. a name or number (group 4)
+lexer = re.compile(r'''\s*(?:(;.*)|("[^"\n]*"?|'[^'\n]*'?)|(,)|([^\s,;"']+))''')
+
+# first characters of words that are parsed as numbers
+NUMBER_START : frozenset = frozenset('0123456789+-')
+
+# an argument with one of these characters is an expression, written without spaces,
+# e.g. table+4, len*2, hi(addr) or $-1
+expression_chars = re.compile(r'[-+*/%&|^~<>()$]')
+
+# names and numbers between the operators of an expression
+expression_part = re.compile(r'[^-+*/%&|^~<>()$]+')
+
+# lexer of expressions: number (group 1), label (group 2), '$' (group 3) or operator (group 4)
+# labels made by macro expansions contain an '@'
+expression_lexer = re.compile(r'([0-9][0-9a-z_]*)|([a-z_@][a-z0-9_@]*)|(\$)|(<<|>>|[-+*/%&|^~()])')
+
+# binary operators of expressions, from the lowest to the highest precedence as in C
+expression_operators : tuple = ({'|': operator.or_},
+                                {'^': operator.xor},
+                                {'&': operator.and_},
+                                {'<<': operator.lshift, '>>': operator.rshift},
+                                {'+': operator.add, '-': operator.sub},
+                                {'*': operator.mul, '/': operator.floordiv, '%': operator.mod})
+# unary operators, '~' inverts the 16 bits of a word
+expression_unary : dict = {'-': operator.neg, '+': operator.pos, '~': lambda x: ~x & 0xFFFF}
+# functions: high and low byte of a word
+expression_functions : dict = {'hi': lambda x: (x >> 8) & 0xFF, 'lo': lambda x: x & 0xFF}
+
+# token kinds of the reserved names, filled from the two sets below
+token_kinds : dict = {}
+
+# one entry of list 'code': a line of pure source code and the assembler output for it
+# all addresses, opcodes and values are kept as integers, they are only
+# formatted as strings when the listing and the output files are written
+class CodeLine:
+    __slots__ = ('lnum', 'label', 'mne', 'args', 'olt', 'addr', 'size', 'cycles',
+                 'opcode', 'lo', 'lo_ref', 'arg', 'arg_ref', 'far', 'removed', 'opt',
+                 'words', 'refs')
+
+    def __init__(self, lnum, label, mne, args):
+        # source code
+        self.lnum = lnum	# line number of source code
+        self.label = label	# label (address of the EC16)
+        self.mne = mne		# mnemonic or directive
+        self.args = args	# list of arguments: int for numbers, str for names and texts in quotes
+        # assembler temporary output
+        self.olt = ''		# flag for linker (#S8/#U8 in lower half of opcode)
+        self.addr = None	# address of the EC16 (instructions, dw_e, res_e)
+        self.size = 0		# number of EXTMEM words occupied
+        self.cycles = None	# (minimum, maximum) cycles of an instruction
+        self.opcode = 0		# full opcode, the lower half is added by the linker
+        self.lo = 0		# lower half of opcode (#S8/#U8)
+        self.lo_ref = ''	# label to be linked into 'lo'
+        self.arg = None		# #U16 argument, None if the instruction has one word
+        self.arg_ref = ''	# label to be linked into 'arg'
+        self.far = False	# branch relaxed to inverted branch + jmpd (target in 'arg')
+        self.removed = False	# instruction removed by the peephole optimizer
+        self.opt = ''		# name of the peephole rule that removed or changed it
+        self.words = None	# dw_e data words
+        self.refs = None	# dw_e list of (index into 'words', label) to be linked
+
+
+# kinds of labels held in the symbol table
+SYM_CODE = 'code'		# label of an instruction or dw_e (address in EXTMEM)
+SYM_EQU = 'equ'			# named constant
+SYM_RES_I = 'res_i'		# reserved words in INTMEM
+SYM_RES_E = 'res_e'		# reserved words in EXTMEM
+
+
+# one entry of the symbol table
+class Symbol:
+    __slots__ = ('name', 'line', 'value', 'kind')
+
+    def __init__(self, name, line, kind):
+        self.name = name	# label name
+        self.line = line	# source code line number where the label is defined
+        self.value = -1		# -1 as marker for 'not initialized'
+        self.kind = kind	# one of SYM_CODE, SYM_EQU, SYM_RES_I, SYM_RES_E
+
+
+# all labels keyed by name, iteration yields them in order of definition
+class SymbolTable:
+
+    def __init__(self):
+        self._symbols : dict = {}
+
+    def __contains__(self, name):
+        return name in self._symbols
+
+    def __iter__(self):
+        return iter(self._symbols.values())
+
+    def __len__(self):
+        return len(self._symbols)
+
+    def define(self, name, line, kind):
+        symbol = Symbol(name, line, kind)
+        self._symbols[name] = symbol
+        return symbol
+
+    def get(self, name):
+        return self._symbols.get(name)
+
+    def value(self, name):
+        return self._symbols[name].value
+
+    def set_value(self, name, value):
+        self._symbols[name].value = value
+
+
+# version shown in the greeting of the command line tool
+VERSION = 'V1.0.1 08-Feb-2025'
+
+# entry points of the EC16: reset vector and interrupt vectors of IRQ0 - IRQ3
+RESET_VECTOR = 0x0000
+IRQ_VECTORS : tuple = (0x0008, 0x0010, 0x0018, 0x0020)
+
+# additional output formats (option --format): name -> (file extension, description)
+output_formats : dict = {'raw': ('.raw', 'raw 16-bit memory image'),
+                         'mem': ('.mem', 'hex memory image for $readmemh'),
+                         'ihex': ('.hex', 'Intel HEX'),
+                         'srec': ('.srec', 'Motorola S-records')}
+
+# data bytes per record of Intel HEX and S-record files
+HEX_RECORD_BYTES = 16
+
+# words per line of the .ecm file (option --ecm-words)
+ECM_WORDS = 8
+# serial port for the upload time estimate of the .ecm file (option --baud),
+# 8N1: start bit, 8 data bits, stop bit per character
+ECM_BAUD = 115200
+SERIAL_CHAR_BITS = 10
+
+# error messages reported by the command line tool before it gives up (option --max-errors)
+MAX_ERRORS = 100
+
+# identification of object files (see Assembler.compile)
+OBJ_FORMAT = 'EC16OBJ'
+OBJ_VERSION = 3
+
+# identification of source map files (see Assembler.make_map)
+MAP_FORMAT = 'EC16MAP'
+MAP_VERSION = 1
+
+
+# one error message of the assembler
+class Diagnostic:
+    __slots__ = ('message', 'lnum', 'source', 'listing_name', 'note', 'column',
+                 'filename', 'fileline')
+
+    def __init__(self, message, lnum=None, source='', listing_name='', note='', column=None,
+                 filename=None, fileline=None):
+        self.message = message			# error text, may span several lines
+        self.lnum = lnum			# line number in the combined listing or None
+        self.source = source			# source code of that line
+        self.listing_name = listing_name	# name of the listing the line number refers to
+        self.note = note			# appended to the line reference, e.g. ' or previous'
+        self.column = column			# column of the token in error or None
+        self.filename = filename		# source file of that line or None
+        self.fileline = fileline		# line number in that source file
+
+    # order of the error messages: by source file, line and column
+    def sort_key(self):
+        if self.filename is None:
+            return ('', self.lnum or 0, self.column or 0)
+        return (self.filename, self.fileline, self.column or 0)
+
+    def __str__(self):
+        text = self.message
+        if self.lnum is not None:
+            if self.filename is not None:
+                text += '\nSee file "' + self.filename + '" at line ' + str(self.fileline)
+            else:
+                text += '\nSee file "' + self.listing_name + '" at line ' + str(self.lnum)
+            if self.column is not None:
+                text += ', column ' + str(self.column)
+            text += self.note
+            if self.filename is not None:
+                text += ' (line ' + str(self.lnum) + ' of "' + self.listing_name + '")'
+            text += '\n' + self.source.rstrip('\n')
+            if self.column is not None:
+                # mark the token, tabs are kept to line up with the source
+                marker = ''.join(c if c == '\t' else ' ' for c in self.source[:self.column - 1])
+                text += '\n' + marker + '^'
+        return text
+
+
+# raised by the assembler instead of exiting the program
+class AsmError(Exception):
+
+    def __init__(self, diagnostics, listing=None):
+        super().__init__('\n'.join(str(d) for d in diagnostics))
+        self.diagnostics = diagnostics	# list of Diagnostic
+        self.listing = listing		# combined source gathered so far (None if nothing read)
+
+
+# EXTMEM contents produced by step 6 as runs of contiguous words
+# gaps between the runs (org_e and res_e) are not stored, 'start' and 'end' also
+# include the words reserved by res_e at the beginning and the end
+# runs are added in ascending order of addresses, so they are always sorted
+class MemoryImage:
+    __slots__ = ('segments', 'start', 'end')
+
+    def __init__(self):
+        self.segments : list = []  # list of [first address, array('H') of words]
+        self.start : int = 0  # first address of the image
+        self.end : int = 0  # address after the last word (data or reserved)
+
+    def empty(self):
+        return self.start == self.end
+
+    # add words at 'addr', which must not be below 'end'
+    def add(self, addr, words):
+        if self.empty():
+            self.start = addr
+        segments = self.segments
+        if segments and segments[-1][0] + len(segments[-1][1]) == addr:
+            segments[-1][1].extend(words)
+        else:
+            segments.append([addr, array('H', words)])
+        self.end = addr + len(words)
+
+    # reserve 'size' words at 'addr' (res_e), which must not be below 'end'
+    def reserve(self, addr, size):
+        if self.empty():
+            self.start = addr
+        self.end = addr + size
+
+    # move the image to begin at 'start' (raw images carry no addresses)
+    def rebase(self, start):
+        shift = start - self.start
+        for segment in self.segments:
+            segment[0] += shift
+        self.start += shift
+        self.end += shift
+
+    # all words from 'start' to 'end', the gaps filled with zeros
+    def dense(self):
+        words = array('H', bytes(2 * (self.end - self.start)))
+        for addr, run in self.segments:
+            words[addr - self.start:addr - self.start + len(run)] = run
+        return words
+
+    # for the build cache
+    def to_json(self):
+        return [self.start, self.end, [[addr, image_bytes(run).hex()] for addr, run in self.segments]]
+
+    @classmethod
+    def from_json(cls, value):
+        image = cls()
+        image.start, image.end, segments = value
+        for addr, data in segments:
+            run = array('H', bytes.fromhex(data))
+            if sys.byteorder == 'big':
+                run.byteswap()
+            image.segments.append([addr, run])
+        return image
+
+
+# everything produced by one run of the assembler
+# if the outputs were taken from the build cache, 'symbols' and 'code' are None
+class Result:
+
+    def __init__(self, asm, cached=False):
+        self.filename = asm.filename			# name of the 'main' asm file
+        self.files = asm.list_of_filenames		# absolute paths of all source files
+        self.symbols = None if cached else asm.symbols	# SymbolTable
+        self.code = None if cached else asm.code	# list of CodeLine
+        self.listing = asm.listing			# contents of the .lst file
+        self.binary = asm.binary			# contents of the .bin file
+        self.ecmon = asm.ecmon				# contents of the .ecm file
+        self.image = asm.image				# MemoryImage of EXTMEM
+        self.outputs = asm.outputs			# additional formats: file extension -> contents
+        self.map = asm.map				# contents of the .map file
+        self.stats = asm.statistics()			# times and counts, see Assembler.statistics
+        # savings of the peephole optimizer: rule name -> [count, words, cycles]
+        self.peephole = asm.peephole_stats
+        # blocks removed by the dead code elimination: list of (label, line number, words)
+        self.gc_blocks = asm.gc_blocks
+        self.cached = cached				# outputs taken from the build cache
+
+
+# one source file read by step 1
+class SourceFile:
+    __slots__ = ('name', 'lines', '_digest', '_preprocess')
+
+    def __init__(self, name, lines):
+        self.name = name	# file name as given on the command line or in the include directive
+        self.lines = lines	# list of source code lines
+        self._digest = ''
+        self._preprocess = None
+
+    # True if the file contains a directive of the preprocessor (macro, rept, if...)
+    @property
+    def preprocess(self):
+        if self._preprocess is None:
+            text = ''.join(self.lines).lower()
+            self._preprocess = any(preprocessor_line.match(text, text.rfind('\n', 0, word.start()) + 1)
+                                   for word in preprocessor_word.finditer(text))
+        return self._preprocess
+
+    # content hash, also depends on the assembler itself (only computed for the build cache)
+    @property
+    def digest(self):
+        if self._digest == '':
+            self._digest = hashlib.sha256((asm_digest() + ''.join(self.lines)).encode('utf-8')).hexdigest()
+        return self._digest
+
+
+# hash of this program, so cached results of another version are never used
+_asm_digest : str = ''
+
+def asm_digest():
+    global _asm_digest
+    if _asm_digest == '':
+        with open(__file__, 'rb') as f:
+            _asm_digest = hashlib.sha256(f.read()).hexdigest()
+    return _asm_digest
+
+
+# cache for the tokens of each source file (step 2) and the outputs of a
+# whole set of source files, both keyed by content hashes
+# entries are kept in memory and, if a directory is given, in JSON files
+class BuildCache:
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self._memory : dict = {}
+        # source files already read: absolute path -> (file stamp, SourceFile)
+        self._files : dict = {}
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    # source file read before if it is still unchanged on disk, otherwise None
+    def source(self, path, stamp):
+        entry = self._files.get(os.path.abspath(path))
+        if entry is not None and stamp is not None and entry[0] == stamp:
+            return entry[1]
+        return None
+
+    def store_source(self, path, stamp, source):
+        if stamp is not None:
+            self._files[os.path.abspath(path)] = (stamp, source)
+
+    def load(self, key):
+        if key in self._memory:
+            return self._memory[key]
+        if self.directory is None:
+            return None
+        try:
+            with open(os.path.join(self.directory, key + '.json'), 'r', encoding='utf-8') as f:
+                value = json.load(f)
+        except (OSError, ValueError):
+            return None
+        self._memory[key] = value
+        return value
 
-def readsourcefile(file):  #read source file into 'single_source', convert to lower case
-    global linenum
-    try:
-        with open(file, "rt", encoding='UTF-8') as f:
-            # simply read in source file and convert it to lower case
-            for sourceline in f:
-                # sourceline = sourceline.lower()
-                single_source.append(sourceline)
-    except FileNotFoundError:
-        # if the first ('main') file is not found, only error message
-        if full_source == []:
-            print('Error opening first asm file! File "' + file + '" not found.')
-            sys.exit()
-        # if one of the include files not found, error message plus listing
+    def store(self, key, value):
+        self._memory[key] = value
+        if self.directory is None:
+            return
+        # write to a temporary file first, parallel builds may share the cache
+        path = os.path.join(self.directory, key + '.json')
+        temp = path + '.' + str(os.getpid())
+        with open(temp, 'w', encoding='utf-8') as f:
+            json.dump(value, f, separators=(',', ':'))
+        os.replace(temp, path)
+
+    # tokens of all lines of a source file, the number in the key changes with the
+    # kinds of tokens
+    def tokens(self, source):
+        key = 'tok2-' + source.digest
+        tokens = self._memory.get(key)
+        if tokens is not None:
+            return tokens
+        tokens = self.load(key)
+        if tokens is None:
+            tokens = tokenize_lines(source.lines)
+            self.store(key, tokens)
         else:
-            with open(listing_name, 'w', encoding="utf-8") as listing:
-                listing.writelines(full_source)
-            print('Error gathering asm files! Include file "' + file + '" not found.')
-            print('See file "' + listing_name + '" at line '  + str(linenum+1))
-            print(full_source[linenum])
-            sys.exit()
+            # JSON has no tuples, the tokens are compared as tuples in step 2
+            tokens = [None if line is None else [tuple(token) for token in line] for line in tokens]
+            self._memory[key] = tokens
+        return tokens
 
+    # key of the outputs of a set of source files assembled with the given options
+    def outputs_key(self, filename, sources, options=''):
+        digest = hashlib.sha256((filename + '|' + options).encode('utf-8'))
+        for source in sources:
+            digest.update(source.digest.encode('ascii'))
+        return 'out-' + digest.hexdigest()
 
-# scan 'full_source' for 'include' directives
-def find_include():  
 
-    global linenum, filename
+# ################################################################################
+# ################################################################################
 
-    asmlinesplit = []
-    # scan full_source from linenum onwards
-    for i, asmline in enumerate(full_source[linenum:]):
-        asmline = asmline.strip()
-        # remove comments
-        asmline = asmline.split(';', 1)[0]
-        if asmline[0:7] == 'include':
-            linenum += i
-            asmlinesplit = [p for p in re.split("(\\s|\\\".*?\\\"|'.*?')", asmline) if p.strip()]
-            if len(asmlinesplit) < 2:
-                with open(listing_name, 'w', encoding="utf-8") as listing:
-                    listing.writelines(full_source)
-                print('Error in INCLUDE directive!')
-                print('See file "' + listing_name + '" at line '  + str(linenum+1))
-                print(full_source[i])
-                sys.exit()
-            filename = asmlinesplit[1]
-            return True 
-    return False
-
-
-def getnum(number):
-    try:
-        value=int(number, 0)
-    except (TypeError, ValueError):
-        print('Error: Integer expected. (Perhaps label not defined?)')
-        print('See file "' + listing_name + '" at line '  + str(line[C_LNUM]))
-        print(full_source[line[C_LNUM] - 1])
-        sys.exit()
-    if 0 <= value <=65535 : 
-        return value
-    print('Error: Number too big, must be 0 .. 65535')
-    print('See file "' + listing_name + '" at line '  + str(line[C_LNUM]))
-    print(full_source[line[C_LNUM] - 1])
-    sys.exit()
-   
+# ---  Setup assembler : create lists from table of instructions ---
+# ##################################################################
 
+# from table 'instructions' extract mnemonics, args1 and args2
+for instr in instructions:
+    if instr[I_MNE] not in mnemonics:
+        mnemonics.append(instr[0])
+    if (instr[I_ARG1] not in args1) and (instr[I_ARG1] not in special_args):
+        args1.append(instr[I_ARG1])
+    if (instr[I_ARG2] not in args2) and (instr[I_ARG2] not in special_args):
+        args2.append(instr[I_ARG2])
 
+# create the encoding for each instruction, the number arguments
+# (#S8, #U8, #U16) all belong to the same class ARG_NUM
+for instr in instructions:
+    key = (instr[I_MNE],
+           ARG_NUM if instr[I_ARG1] in num_args else instr[I_ARG1],
+           ARG_NUM if instr[I_ARG2] in num_args else instr[I_ARG2])
+    # Debug! Should only be invoked when making changes to 'instructions'
+    # that lead to duplicate keys
+    if key in encodings:
+        print('Error! Instructions table is equivocal')
+    encodings[key] = Encoding(instr)
+
+# fill the two sets with reserved strings  
+named_args = frozenset(args1 + args2)
+mnemonics_and_directives = frozenset(mnemonics + list(directives) + list(preprocessor_directives))
+token_kinds.update(dict.fromkeys(named_args, TOK_REGISTER))
+token_kinds.update(dict.fromkeys(mnemonics_and_directives, TOK_MNEMONIC))
+
+# a branch out of reach is relaxed to the inverted branch skipping a jmpd:
+#   brxx target  ->  br(not xx) +2,  jmpd target
+# bit 10 of a branch opcode selects branching on flag set or clear
+BRANCH_INVERT = 0x0400
+JMPD_OPCODE = encodings[('jmpd', ARG_NUM, ARG_NONE)].opcode
+FAR_BRANCH_SIZE = 1 + encodings[('jmpd', ARG_NUM, ARG_NONE)].length
+# the inverted branch is taken (2 cycles) or falls through to jmpd (1 + 3 cycles)
+FAR_BRANCH_CYCLES = (2, 1 + encodings[('jmpd', ARG_NUM, ARG_NONE)].cycles[1])
+# after this number of passes relaxed branches are not shrunk again,
+# so the layout always reaches a fixpoint
+RELAX_SHRINK_PASSES = 8
+
+# mnemonics of the conditional branches
+branch_mnemonics : tuple = tuple(instr[I_MNE] for instr in instructions if instr[I_ARG1] == '#S8')
+
+# rewrites of the peephole optimizer (-O), none of them changes a flag
+# (name, first instruction, second instruction or None, action)
+# an instruction is matched by (mnemonics, arg1, arg2), in the arguments
+#   'X'    is a number or label, the same in both instructions
+#   'NEXT' is a label of the instruction following the first one
+#   'JMPD' is a label of a jmpd instruction
+# actions:
+#   PEEP_DROP_FIRST / PEEP_DROP_BOTH / PEEP_DROP_SECOND remove instructions
+#   PEEP_RETARGET replaces the target by the target of the jmpd
+# the second instruction is never removed when it has a label, since it may
+# be entered from elsewhere
+PEEP_DROP_FIRST = 'drop first'
+PEEP_DROP_SECOND = 'drop second'
+PEEP_DROP_BOTH = 'drop both'
+PEEP_RETARGET = 'retarget'
+
+peephole_rules : tuple = (
+    ('push a / pop a',    (('push',), 'a', ''),          (('pop',), 'a', ''),   PEEP_DROP_BOTH),
+    ('mov a X / mov X a', (('mov',), 'a', 'X'),          (('mov',), 'X', 'a'),  PEEP_DROP_SECOND),
+    ('mov X a / mov a X', (('mov',), 'X', 'a'),          (('mov',), 'a', 'X'),  PEEP_DROP_SECOND),
+    ('branch to next',    (branch_mnemonics, 'NEXT', ''), None,                 PEEP_DROP_FIRST),
+    ('jmpd to next',      (('jmpd',), 'NEXT', ''),       None,                  PEEP_DROP_FIRST),
+    ('jmpd to jmpd',      (('jmpd',), 'JMPD', ''),       None,                  PEEP_RETARGET),
+    ('calld to jmpd',     (('calld',), 'JMPD', ''),      None,                  PEEP_RETARGET),
+)
+
+
+# numbers are parsed by the lexer, all other arguments are strings
 def testnum(number):
+    return isinstance(number, int)
+
+
+# True if an argument (lowercase text, not a number) is an expression and not a label
+def is_expression(arg):
+    return arg[:1] not in ('"', "'") and expression_chars.search(arg) is not None
+
+
+# an expression of an operand, parsed once: function(value, addr) computes it, the
+# function 'value' gives the value of a label and 'addr' is the address for '$'
+class Expression:
+    __slots__ = ('text', 'names', 'address', 'function')
+
+    def __init__(self, text, names, address, function):
+        self.text = text		# the expression as written (lowercase)
+        self.names = names		# set of the labels used
+        self.address = address		# True if '$' is used
+        self.function = function
+
+
+# parse an expression into nested functions, parts without labels and '$' are
+# folded into constants at once, raises ValueError with the reason if it is invalid
+#   expression : unary { operator unary }   operators see 'expression_operators'
+#   unary      : ( '-' | '+' | '~' ) unary | primary
+#   primary    : number | label | '$' | '(' expression ')' | ( 'hi' | 'lo' ) '(' expression ')'
+def parse_expression(text):
+    tokens = []
+    pos = 0
+    while pos < len(text):
+        match = expression_lexer.match(text, pos)
+        if match is None:
+            raise ValueError('unexpected "' + text[pos:] + '"')
+        tokens.append((match.lastindex, match.group(match.lastindex)))
+        pos = match.end()
+    tokens.append((0, ''))
+    names = set()
+    address = False
+    pos = 0
+
+    # each part is a pair (function, value), the value is None unless it is a constant
+    def constant(value):
+        return (lambda value_of, addr: value), value
+
+    def operation(function, *parts):
+        if all(part[1] is not None for part in parts):
+            try:
+                return constant(function(*[part[1] for part in parts]))
+            except (ArithmeticError, ValueError):
+                # reported when the expression is computed for its line
+                pass
+        functions = [part[0] for part in parts]
+        if len(functions) == 1:
+            first = functions[0]
+            return (lambda value_of, addr: function(first(value_of, addr))), None
+        first, second = functions
+        return (lambda value_of, addr: function(first(value_of, addr), second(value_of, addr))), None
+
+    def expect(value):
+        nonlocal pos
+        if tokens[pos] != (4, value):
+            raise ValueError('"' + value + '" expected')
+        pos += 1
+
+    def binary(level):
+        nonlocal pos
+        if level == len(expression_operators):
+            return unary()
+        left = binary(level + 1)
+        operators = expression_operators[level]
+        while tokens[pos][0] == 4 and tokens[pos][1] in operators:
+            function = operators[tokens[pos][1]]
+            pos += 1
+            left = operation(function, left, binary(level + 1))
+        return left
+
+    def unary():
+        nonlocal pos
+        if tokens[pos][0] == 4 and tokens[pos][1] in expression_unary:
+            function = expression_unary[tokens[pos][1]]
+            pos += 1
+            return operation(function, unary())
+        return primary()
+
+    def primary():
+        nonlocal pos, address
+        group, value = tokens[pos]
+        pos += 1
+        if group == 1:
+            try:
+                return constant(int(value, 0))
+            except ValueError:
+                raise ValueError('invalid number "' + value + '"') from None
+        if group == 2:
+            if value in expression_functions and tokens[pos] == (4, '('):
+                pos += 1
+                part = binary(0)
+                expect(')')
+                return operation(expression_functions[value], part)
+            names.add(value)
+            return (lambda value_of, addr: value_of(value)), None
+        if group == 3:
+            address = True
+            return (lambda value_of, addr: addr), None
+        if value == '(':
+            part = binary(0)
+            expect(')')
+            return part
+        raise ValueError('unexpected "' + value + '"' if value else 'incomplete expression')
+
+    function = binary(0)[0]
+    if pos < len(tokens) - 1:
+        raise ValueError('unexpected "' + tokens[pos][1] + '"')
+    return Expression(text, names, address, function)
+
+
+# True if a branch at 'addr' reaches 'target', the offset is added to the
+# address of the next instruction and must fit into a signed byte, i.e.
+# the offset is -128 .. +127
+def branch_fits(addr, target):
+    return -128 <= target - addr - 1 <= 127
+
+
+# split one source line into its tokens (see TOK_...) in a single pass
+# names are converted to lowercase, only texts in quotes keep their case
+# returns None if the line contains no code (empty, comment or include directive)
+# the columns of the tokens are not kept, Assembler.column finds them again for
+# an error message
+def tokenize_line(asmline):
+    # include directives are resolved by step 1
+    if asmline.lstrip()[0:7] == 'include':
+        return None
+
+    tokens = []
+    for comment, string, comma, word in lexer.findall(asmline):
+        if word:
+            if word[0] in NUMBER_START:
+                try:
+                    tokens.append((TOK_NUMBER, int(word, 0)))
+                    continue
+                except ValueError:
+                    pass
+            word = word.lower()
+            kind = token_kinds.get(word)
+            if kind is None:
+                kind = TOK_LABEL
+                if not word.isidentifier() and expression_chars.search(word):
+                    kind = TOK_EXPR
+            tokens.append((kind, word))
+        elif string:
+            tokens.append((TOK_STRING, string))
+        elif comma:
+            tokens.append((TOK_COMMA, comma))
+
+    if not tokens:
+        return None
+    return tokens
+
+
+# a line of a macro body as list of pieces for its expansion: text, the numbers of
+# the parameters used (to be replaced by the arguments) and names with an '@' as
+# tuple (name,), None if the line needs no changes
+def macro_template(text, params):
+    pieces = []
+    pos = 0
+    for word_match in lexer.finditer(text):
+        if word_match.lastindex != 4:
+            continue
+        # the names in an expression are replaced as well
+        for match in expression_part.finditer(text, word_match.start(4), word_match.end(4)):
+            word = match.group()
+            if word.lower() in params:
+                piece = params.index(word.lower())
+            elif '@' in word:
+                piece = (word,)
+            else:
+                continue
+            pieces.append(text[pos:match.start()])
+            pieces.append(piece)
+            pos = match.end()
+    if not pieces:
+        return None
+    pieces.append(text[pos:])
+    return pieces
+
+
+# tokens of all lines of a source file
+def tokenize_lines(lines):
+    return [tokenize_line(asmline) for asmline in lines]
+
+
+# modification time and size of a file, None if it does not exist
+def file_stamp(path):
     try:
-        int(number, 0)
-    except (TypeError, ValueError):
-        return False
-
-    return True
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
 
 
 def is_valid_label(label) : 
@@ -212,698 +834,2484 @@ def is_valid_label(label) :
     return True
 
 
-def add_to_code():
-    global linenum, extmem_cnt
-    
-    # calculate value to check against table 'fingerprint'
-    fp = mnemonics.index(line[C_MNE]) * 65536
-
-    if line[C_ARG1] != '':
-        if testnum(line[C_ARG1]) or (line[C_ARG1] in lbl_name):
-            fp += 256
-        elif line[C_ARG1] in args1:
-            fp += (args1.index(line[C_ARG1]) + 2) * 256
-    if line[C_ARG2] != '':
-        if testnum(line[C_ARG2]) or (line[C_ARG2] in lbl_name):
-            fp += 1
-        elif line[C_ARG2] in args2:
-            fp += (args2.index(line[C_ARG2]) + 2)
-
-
-    if fp not in fingerprint:
-        print('Error! Unknown instruction')
-        print('See file "' + listing_name + '" at line '  + str(line[C_LNUM]))
-        print(full_source[line[C_LNUM] - 1])
-        sys.exit()
-
-    # if applicable update labellist
-    if line[C_LBL] in lbl_name :
-        lbl_value[lbl_name.index(line[C_LBL])] = extmem_cnt
-
-    # get index to 'instructions'
-    instr_idx = fingerprint.index(fp)
-
-    # add address
-    code[linenum][C_ADDR] = '0x%04X' % extmem_cnt
-    extmem_cnt += 1
-    # add basic opcode
-    code[linenum][C_OPC] = instructions[instr_idx][I_OPC]
-
-    # arg1
-    opc_lt = instructions[instr_idx][I_ARG1]
-    if (opc_lt == '#S8') or (opc_lt == '#U8') :
-        code[linenum][C_OPCLO] = line[C_ARG1]
-        code[linenum][C_OLT] = opc_lt
-    elif (opc_lt == '#U16') :
-        code[linenum][C_ARG] = line[C_ARG1]
-        extmem_cnt += 1
-    
-    # arg2
-    opc_lt = instructions[instr_idx][I_ARG2]
-    if opc_lt == '#U8' :
-        code[linenum][C_OPCLO] = line[C_ARG2]
-        code[linenum][C_OLT] = opc_lt
-    elif (opc_lt == '#U16') :
-        code[linenum][C_ARG] = line[C_ARG2]
-        extmem_cnt += 1
-        
-    if testnum(code[linenum][C_OPCLO]) == True:
-        code[linenum][C_OPCLO] = '0x%04X' % getnum(code[linenum][C_OPCLO])
-
-    if testnum(code[linenum][C_ARG]) == True:
-        code[linenum][C_ARG] = '0x%04X' % getnum(code[linenum][C_ARG])
-
-    # print(code[linenum])
-
-
-def exec_directive():
-    global extmem_cnt, intmem_cnt
-
-    # EQU
-    if line[C_MNE]=='equ':
-        if len(line)!=4:
-            print('Error in EQU directive!')
-            print('See file "' + listing_name + '" at line '  + str(line[C_LNUM]))
-            print(full_source[line[C_LNUM] - 1])
-            sys.exit()
-        value = getnum(line[C_ARG1])
-        if value < 0 or value > 65535:
-            print('Error: Value out of range 0..65535')
-            print('See file "' + listing_name + '" at line '  + str(line[C_LNUM]))
-            print(full_source[line[C_LNUM] - 1])
-            sys.exit()
-        # search index of linenumber in list lbl_line
-        # write value to list lbl_value at index
-        idx=lbl_line.index(line[C_LNUM])
-        lbl_value[idx]=value
-     
-    # ORG_E
-    elif line[C_MNE]=='org_e':
-        if len(line)!=4:
-            print('Error in ORG_E directive!')
-            print('See file "' + listing_name + '" at line '  + str(line[C_LNUM]))
-            print(full_source[line[C_LNUM] - 1])
-            sys.exit()
-        if line[C_ARG1] in lbl_name:
-            idx = lbl_name.index(line[C_ARG1])
-            value = lbl_value[idx]
-            if value == -1:
-                print('Error: Label value has to be defined before usage')
-                print('See file "' + listing_name + '" at line '  + str(line[C_LNUM]))
-                print(full_source[line[C_LNUM] - 1])
-                sys.exit()
+# ################################################################################
+# ################################################################################
+
+# the assembler keeps all state of one run in its attributes, so any number
+# of files can be assembled in one process, errors raise AsmError
+class Assembler:
+
+    def __init__(self, cache=None, relax=False, optimize=False, gc=False, keep=(),
+                 formats=(), big_endian=False, ecm_words=ECM_WORDS, max_errors=1):
+        self.filename : str = ""
+        self.list_of_filenames : list = [] # list of included files to avoid multiple inclusions
+        self.listing_name : str = ""  # name of first asm file but with extension .lst
+        self.cache = cache  # BuildCache or None
+        self.relax = relax  # relax branches out of reach (see Step 3b)
+        self.optimize = optimize  # run the peephole optimizer (see Step 3a)
+        self.gc = gc  # remove code not reachable from the vectors (see Step 3c)
+        self.keep : list = list(keep)  # labels kept by the dead code elimination
+        self.formats : list = list(formats)  # names of additional output formats
+        self.big_endian = big_endian  # byte order of the raw, Intel HEX and S-record outputs
+        self.ecm_words = ecm_words  # words per line of the .ecm file
+        self.max_errors = max_errors  # errors collected before giving up, 0 for no limit
+        self.relocatable = False  # assemble an object file, see compile()
+        self.externals : set = set()  # labels of other objects used by an object
+
+        # by resolving the includes all source files are aggregated in 'full_source'
+        self.full_source : list = []
+        # all files read, in the order of their inclusion
+        self.sources : list = []
+        # runs of lines in 'full_source' taken from one source file:
+        # list of (first line in 'full_source', index to 'sources', first line in that file)
+        # lines added by the assembler (end markers) have index -1
+        self.source_map : list = []
+        # preprocessor: tokens of each line of 'full_source' after the expansion of the
+        # macros (None if the preprocessor did not run), the macros by name and
+        # the EQU values known so far
+        self.line_tokens = None
+        self.macros : dict = {}
+        self.pre_values : dict = {}
+        self.expansions : int = 0  # number of macro expansions, makes local labels unique
+        # expressions used as arguments, each parsed once: text -> Expression
+        self.expressions : dict = {}
+        # EQU labels whose value depends on EXTMEM addresses (see address_dependent)
+        self.address_equs : set = set()
+        # the pure source code is extracted from 'full_source' into 'code'
+        self.code : list = []
+        self.symbols = SymbolTable()    # all labels with their line number, value and kind
+        # EXTMEM address -> index into 'code' of the instruction at this address
+        self.code_index : dict = {}
+        # savings of the peephole optimizer: rule name -> [count, words, cycles]
+        self.peephole_stats : dict = {}
+        # blocks removed by the dead code elimination: list of (label, line number, words)
+        self.gc_blocks : list = []
+        # each step run: name -> (wall time in seconds, net change of allocated memory blocks)
+        self.step_stats : dict = {}
+        # errors collected so far (see collect), list of Diagnostic
+        self.diagnostics : list = []
+
+        self.extmem_cnt : int = 0  # counter for external memory location (0..65535)
+        self.intmem_cnt : int = 0  # counter for internal memory location (0..255)
+        # INTMEM reserved by res_i: list of (first location, number of words, line number)
+        self.intmem_ranges : list = []
+
+        # outputs
+        self.listing : str = ""  # full listing
+        self.binary : str = ""   # bin data for FPGA memory
+        self.ecmon : str = ""    # hex data for upload with ECMON via terminal
+        self.image = MemoryImage()  # EXTMEM contents of the outputs
+        self.outputs : dict = {}  # additional output formats: file extension -> contents
+        self.map : str = ""      # source map of the EXTMEM addresses (JSON)
+
+
+    # stop assembling with an error message referring to line 'lnum' of the listing
+    # 'column' points to the token in error within that line
+    def error(self, message, lnum=None, note='', column=None):
+        source = ''
+        filename = fileline = None
+        if lnum is not None:
+            source = self.full_source[lnum - 1]
+            filename, fileline = self.source_line(lnum)
+        listing = None
+        if self.full_source != []:
+            listing = ''.join(self.full_source)
+        raise AsmError([Diagnostic(message, lnum, source, self.listing_name, note, column,
+                                   filename, fileline)], listing)
+
+
+    # the loops over the lines of steps 2 to 4 go on with the next line after an
+    # error, which is kept until check_errors() raises all errors together
+    # 'max_errors' errors are raised at once, so with 1 the first error stops
+    def collect(self, e):
+        self.diagnostics.extend(e.diagnostics)
+        if self.max_errors and len(self.diagnostics) >= self.max_errors:
+            self.check_errors()
+
+
+    # raise the errors collected so far sorted by source file and line
+    def check_errors(self):
+        if not self.diagnostics:
+            return
+        diagnostics = sorted(self.diagnostics, key=Diagnostic.sort_key)
+        if self.max_errors > 1 and len(diagnostics) >= self.max_errors:
+            diagnostics.append(Diagnostic('Stopped after ' + str(self.max_errors) + ' errors'))
+        listing = None
+        if self.full_source != []:
+            listing = ''.join(self.full_source)
+        raise AsmError(diagnostics, listing)
+
+
+    # file name and line number in that file of line 'lnum' of 'full_source',
+    # (None, None) for lines added by the assembler or when linking objects
+    def source_line(self, lnum):
+        # the first run starting after line 'lnum', index -1 of the tuples sorts before any file
+        num = bisect.bisect_left(self.source_map, (lnum, -1)) - 1
+        if num < 0 or self.source_map[num][1] < 0:
+            return None, None
+        start, index, fileline = self.source_map[num]
+        return self.sources[index].name, fileline + lnum - start
+
+
+    # source column of the mnemonic (num 0) or of argument 'num' in line 'lnum' of
+    # 'full_source', the lexer finds the tokens again as only error messages need it
+    def column(self, lnum, num=0):
+        if num is None:
+            return None
+        words = [match for match in lexer.finditer(self.full_source[lnum - 1])
+                 if match.lastindex in (2, 4)]
+        # skip the label
+        if words and token_kinds.get(words[0].group(words[0].lastindex).lower()) != TOK_MNEMONIC:
+            num += 1
+        if num >= len(words):
+            return None
+        return words[num].start(words[num].lastindex) + 1
+
+
+    def readsourcefile(self, file, source=None):  #read source file and return its lines
+        if source is not None:
+            return source.splitlines(keepends=True)
+        try:
+            with open(file, "rt", encoding='UTF-8') as f:
+                # simply read in source file
+                return f.readlines()
+        except FileNotFoundError:
+            # if the first ('main') file is not found, only error message
+            if self.full_source == []:
+                self.error('Error opening first asm file! File "' + file + '" not found.')
+            # if one of the include files not found, error message plus listing
+            else:
+                self.error('Error gathering asm files! Include file "' + file + '" not found.',
+                           len(self.full_source))
+
+
+    # test a source line for an 'include' directive and
+    # return the name of the file to be included or None
+    def find_include(self, sourceline):  
+
+        asmline = sourceline.strip()
+        # remove comments
+        asmline = asmline.split(';', 1)[0]
+        if asmline[0:7] != 'include':
+            return None
+        # the file name keeps its case, it is the second token
+        asmlinesplit = [match.group(match.lastindex) for match in lexer.finditer(asmline)]
+        if len(asmlinesplit) < 2:
+            self.full_source.append(sourceline)
+            self.error('Error in INCLUDE directive!', len(self.full_source))
+        return asmlinesplit[1].strip('\"')
+
+
+    # the following lines of 'full_source' are taken from file 'index' starting at 'fileline'
+    def map_source(self, index, fileline):
+        start = len(self.full_source)
+        if self.source_map and self.source_map[-1][0] == start:
+            self.source_map.pop()
+        self.source_map.append((start, index, fileline))
+
+
+    # read a source file and append its lines to 'full_source'
+    # include files are expanded recursively in place of their 'include' directive
+    # so the combined source is built in a single pass
+    def gather_source(self, file, source=None):
+
+        full_source = self.full_source
+        # files kept by the cache are not read again while unchanged
+        sourcefile = None
+        if self.cache is not None and source is None:
+            stamp = file_stamp(file)
+            sourcefile = self.cache.source(file, stamp)
+        if sourcefile is None:
+            sourcefile = SourceFile(file, self.readsourcefile(file, source))
+            if self.cache is not None and source is None:
+                self.cache.store_source(file, stamp, sourcefile)
+        lines = sourcefile.lines
+        index = len(self.sources)
+        self.sources.append(sourcefile)
+        self.map_source(index, 0)
+
+        for num, sourceline in enumerate(lines):
+            include_name = self.find_include(sourceline)
+            if include_name is None :
+                full_source.append(sourceline)
+                continue
+            # include directive found, so comment it out and mark it with '; -> '
+            full_source.append('; -> ' + sourceline)
+            # ensure that no file is included more than once
+            if os.path.abspath(include_name) not in self.list_of_filenames:
+                # register the filename
+                self.list_of_filenames.append(os.path.abspath(include_name))
+                # insert include file into 'full_source' 
+                self.gather_source(include_name)
+                # mark the end of the include file
+                self.map_source(-1, 0)
+                full_source.append('; -> end of included file "' + include_name + '"\n')
+            else:
+                # if the file is already included only add a comment
+                self.map_source(-1, 0)
+                full_source.append('; -> ignored since already included\n')
+            self.map_source(index, num + 1)
+
+
+    # 'argnum' is the number of the argument (1, 2, ...) shown in an error message
+    def getnum(self, number, lnum, argnum=None):
+        column = None
+        if argnum is not None and not (testnum(number) and 0 <= number <= 65535):
+            column = self.column(lnum, argnum)
+        if not testnum(number):
+            self.error('Error: Integer expected. (Perhaps label not defined?)', lnum, column=column)
+        if 0 <= number <=65535 : 
+            return number
+        self.error('Error: Number too big, must be 0 .. 65535', lnum, column=column)
+
+
+    # class of an instruction argument as used in the keys of table 'encodings'
+    def arg_class(self, arg):
+        if arg == '' or arg in named_args:
+            return arg
+        if testnum(arg) or (arg in self.symbols) or self.is_external(arg) or is_expression(arg):
+            return ARG_NUM
+        return None
+
+
+    # the parsed expression of an argument, every text is parsed only once
+    def expression(self, text, lnum, argnum=None):
+        expression = self.expressions.get(text)
+        if expression is None:
+            try:
+                expression = parse_expression(text)
+            except ValueError as e:
+                self.error('Error in expression: ' + str(e), lnum, column=self.column(lnum, argnum))
+            self.expressions[text] = expression
+        return expression
+
+
+    # compute an expression for a line at address 'addr' ('$'), 'value_of' gives the
+    # value of a label
+    def evaluate(self, expression, addr, lnum, value_of):
+        try:
+            return expression.function(value_of, addr)
+        except (ArithmeticError, ValueError):
+            self.error('Error: Expression "' + expression.text + '" divides by zero or shifts by a negative count',
+                       lnum)
+
+
+    # value of a label or expression to be linked into a line at 'addr', -1 if a
+    # label has no value yet (without error messages, see linkvalue)
+    def ref_value(self, ref, addr):
+        symbol = self.symbols.get(ref)
+        if symbol is not None:
+            return symbol.value
+        expression = self.expressions.get(ref)
+        if expression is None or any(self.symbols.get(name) is None or self.symbols.value(name) == -1
+                                     for name in expression.names):
+            return -1
+        try:
+            return expression.function(self.symbols.value, addr)
+        except (ArithmeticError, ValueError):
+            return -1
+
+
+    # labels a label or expression to be linked depends on
+    def ref_names(self, ref):
+        if ref in self.symbols or not is_expression(ref):
+            return (ref,)
+        return self.expression(ref, None).names
+
+
+    # when assembling an object a label that is not defined in its source files
+    # is taken as defined by another object, the linker resolves it
+    def is_external(self, name):
+        if (not self.relocatable or name in mnemonics_and_directives or
+                not is_valid_label(name)):
+            return False
+        self.externals.add(name)
+        return True
+
+
+    # split an argument into a number or a label or expression to be linked: (value, label)
+    # an expression of numbers and EQU labels defined before is computed at once
+    def operand(self, arg, lnum, argnum=None):
+        if testnum(arg):
+            return self.getnum(arg, lnum, argnum), ''
+        if arg in self.symbols or not is_expression(arg):
+            return 0, arg
+        expression = self.expression(arg, lnum, argnum)
+        constant = not expression.address
+        for name in expression.names:
+            symbol = self.symbols.get(name)
+            if symbol is None:
+                if not self.is_external(name):
+                    self.error('Error: Label "' + name + '" not defined', lnum, column=self.column(lnum, argnum))
+                constant = False
+            elif symbol.kind != SYM_EQU or symbol.value == -1 or name in self.address_equs:
+                constant = False
+        if constant:
+            return self.getnum(self.evaluate(expression, None, lnum, self.symbols.value), lnum, argnum), ''
+        return 0, arg
+
+
+    # True if the value of an argument depends on EXTMEM addresses, i.e. on '$', the
+    # labels of code, dw_e and res_e or EQU labels of those. The addresses change
+    # when the code is moved (-O, --relax, --gc and the linker), so these values
+    # are computed again by layout()
+    def address_dependent(self, arg):
+        if testnum(arg):
+            return False
+        if arg in self.symbols:
+            names = (arg,)
+        elif is_expression(arg):
+            expression = self.expressions.get(arg)
+            if expression is None or expression.address:
+                return True
+            names = expression.names
         else:
-            value = getnum(line[C_ARG1])
-        if value < 0 or value > 65535:
-            print('Error: Value out of range 0..65535')
-            print('See file "' + listing_name + '" at line '  + str(line[C_LNUM]))
-            print(full_source[line[C_LNUM] - 1])
-            sys.exit()
-        
-        if value < extmem_cnt:
-            print('Error: address counter must not be set back')
-            print('Current value : ' + '0x%04X' % extmem_cnt + '   New value : ' + '0x%04X' % value)
-            print('See file "' + listing_name + '" at line '  + str(line[C_LNUM]))
-            print(full_source[line[C_LNUM] - 1])
-            sys.exit()
-            
-        extmem_cnt = value
-
-    # ORG_I
-    elif line[C_MNE]=='org_i':
-        if len(line)!=4:
-            print('Error in ORG_I directive!')
-            print('See file "' + listing_name + '" at line '  + str(line[C_LNUM]))
-            print(full_source[line[C_LNUM] - 1])
-            sys.exit()
-        if line[C_ARG1] in lbl_name:
-            idx = lbl_name.index(line[C_ARG1])
-            value = lbl_value[idx]
+            return False
+        for name in names:
+            symbol = self.symbols.get(name)
+            if symbol is not None and (symbol.kind in (SYM_CODE, SYM_RES_E) or name in self.address_equs):
+                return True
+        return False
+
+
+    # value of an argument needed at once (equ, org_e, org_i, res_i, res_e): a number,
+    # a label or an expression of labels defined before, '$' is the current EXTMEM address
+    def const_value(self, arg, lnum, argnum=None):
+        symbols = self.symbols
+        if arg in symbols:
+            value = symbols.value(arg)
             if value == -1:
-                print('Error: Label value has to be defined before usage')
-                print('See file "' + listing_name + '" at line '  + str(line[C_LNUM]))
-                print(full_source[line[C_LNUM] - 1])
-                sys.exit()
-        else:
-            value = getnum(line[C_ARG1])
-        if value < 0 or value > 255:
-            print('Error: Value out of range 0..255')
-            print('See file "' + listing_name + '" at line '  + str(line[C_LNUM]))
-            print(full_source[line[C_LNUM] - 1])
-            sys.exit()
-
-        intmem_cnt = value
-
-
-    # RES_I
-    elif line[C_MNE]=='res_i':
-        if len(line)!=4:
-            print('Error in RES_I directive! Wrong number of arguments')
-            print('See file "' + listing_name + '" at line '  + str(line[C_LNUM]))
-            print(full_source[line[C_LNUM] - 1])
-            sys.exit()
-        # get the number of words to reserve
-        # Must be an integer or
-        if testnum(line[C_ARG1]) == True :
-            value = getnum(line[C_ARG1])
-        # an already defined label
-        elif line[C_ARG1] in lbl_name :
-            value = lbl_value[lbl_name.index(line[C_ARG1])]
+                self.error('Error: Label value has to be defined before usage', lnum)
+            return value
+        if testnum(arg) or not is_expression(arg):
+            return self.getnum(arg, lnum, argnum)
+        expression = self.expression(arg, lnum, argnum)
+        for name in expression.names:
+            if name not in symbols:
+                self.error('Error: Label "' + name + '" not defined', lnum, column=self.column(lnum, argnum))
+            if symbols.value(name) == -1:
+                self.error('Error: Label value has to be defined before usage', lnum)
+        return self.getnum(self.evaluate(expression, self.extmem_cnt, lnum, symbols.value), lnum, argnum)
+
+
+    # number of words to reserve by res_i/res_e: an integer or an already defined label
+    def reserve_count(self, arg, lnum, argnum=None):
+        value = -1
+        if testnum(arg) == True :
+            value = self.getnum(arg, lnum, argnum)
+        elif arg in self.symbols :
+            value = self.symbols.value(arg)
+        elif is_expression(arg) :
+            value = self.const_value(arg, lnum, argnum)
         if value == -1 :
-            print('Error: Argument must be an integer or an already defined label')
-            print('See file "' + listing_name + '" at line '  + str(line[C_LNUM]))
-            print(full_source[line[C_LNUM] - 1])
-            sys.exit()
-
-        # add own label value to label list
-        if line[C_LBL] in lbl_name:
-            idx = lbl_name.index(line[C_LBL])
-            lbl_value[idx]=intmem_cnt
-
-        intmem_cnt+=value
-        if intmem_cnt > 256:
-            print('Error: Exceeded INTMEM range 0..255')
-            print('See file "' + listing_name + '" at line '  + str(line[C_LNUM]) + ' or previous')
-            print(full_source[line[C_LNUM] - 1])
-            sys.exit()
+            self.error('Error: Argument must be an integer or an already defined label', lnum,
+                       column=self.column(lnum, argnum))
+        return value
 
-    
-    # RES_E
-    elif line[C_MNE]=='res_e':
-        if len(line)!=4:
-            print('Error in RES_E directive! Wrong number of arguments')
-            print('See file "' + listing_name + '" at line '  + str(line[C_LNUM]))
-            print(full_source[line[C_LNUM] - 1])
-            sys.exit()
-        # insert current EXTMEM address for listing
-        line[C_ARG1:C_ARG1]=['0x%04X' % extmem_cnt]
-        # get the number of words to reserve
-        # Must be an integer or
-        if testnum(line[C_ARG2]) == True :
-            value = getnum(line[C_ARG2])
-        # an already defined label
-        elif line[C_ARG2] in lbl_name :
-            value = lbl_value[lbl_name.index(line[C_ARG2])]
-        if value == -1 :
-            print('Error: Argument must be an integer or an already defined label')
-            print('See file "' + listing_name + '" at line '  + str(line[C_LNUM]))
-            print(full_source[line[C_LNUM] - 1])
-            sys.exit()
 
-        # add own label value to label list
-        if line[C_LBL] in lbl_name:
-            idx = lbl_name.index(line[C_LBL])
-            lbl_value[idx]=extmem_cnt
+    # value of a target label, its definition must have set it, or of an expression
+    # for the line at 'addr', its labels are linked the same way
+    def linkvalue(self, name, lnum, addr=None):
+        if name not in self.symbols:
+            if is_expression(name):
+                expression = self.expression(name, lnum)
+                value = self.evaluate(expression, addr, lnum, lambda label: self.linkvalue(label, lnum))
+                if not 0 <= value <= 65535:
+                    self.error('Error: Value of expression "' + name + '" out of range 0 .. 65535', lnum)
+                return value
+            # only possible for objects, where labels may be defined by another object
+            self.error('Error: Label not defined in any object', lnum)
+        value = self.symbols.value(name)
+        if value == -1:
+            self.error('Error: Label value has to be defined before usage', lnum)
+        return value
 
-        
-        extmem_cnt+=value
-        if extmem_cnt > 65536:
-            print('Error: Exceeded EXTMEM range 0..65535')
-            print('See file "' + listing_name + '" at line '  + str(line[C_LNUM]) + ' or previous')
-            print(full_source[line[C_LNUM] - 1])
-            sys.exit()
 
-    
-    #'DW_E'
-    elif line[C_MNE]=='dw_e':
-        dw_e_len = len(line)
-
-        if dw_e_len <4:
-            print('Error in DW_E directive! No arguments found.')
-            print('See file "' + listing_name + '" at line '  + str(line[C_LNUM]))
-            print(full_source[line[C_LNUM] - 1])
-            sys.exit()
- 
-        # update labellist
-        if line[C_LBL] in lbl_name :
-            lbl_value[lbl_name.index(line[C_LBL])] = extmem_cnt
-            
-        line.append('0x%04X' % extmem_cnt)
+    def add_to_code(self, line):
+
+        # at most two arguments, missing ones are empty strings
+        arg1 = line.args[0] if len(line.args) > 0 else ''
+        arg2 = line.args[1] if len(line.args) > 1 else ''
+
+        # if applicable update labellist, also if the line has an error, so the
+        # lines using the label get no further errors
+        if line.label in self.symbols :
+            self.symbols.set_value(line.label, self.extmem_cnt)
+
+        # look up the encoding by mnemonic and argument classes
+        classes = (self.arg_class(arg1), self.arg_class(arg2))
+        enc = encodings.get((line.mne,) + classes)
+
+        if enc is None or len(line.args) > 2:
+            # a name that is no label at all is not a wrong kind of argument
+            for num, (arg, argclass) in enumerate(zip((arg1, arg2), classes)):
+                if argclass is None and not testnum(arg) and is_valid_label(arg):
+                    self.error('Error: Label "' + arg + '" not defined', line.lnum,
+                               column=self.column(line.lnum, num + 1))
+            self.error('Error! Unknown instruction', line.lnum)
+
+        # add address
+        line.addr = self.extmem_cnt
+        line.size = enc.length
+        line.cycles = enc.cycles
+        self.extmem_cnt += enc.length
+        # add basic opcode
+        line.opcode = enc.opcode
+
+        # arg1
+        opc_lt = enc.arg1
+        if (opc_lt == '#S8') or (opc_lt == '#U8') :
+            line.lo, line.lo_ref = self.operand(arg1, line.lnum, 1)
+            self.check_u8(line, opc_lt, 1)
+            line.olt = opc_lt
+        elif (opc_lt == '#U16') :
+            line.arg, line.arg_ref = self.operand(arg1, line.lnum, 1)
         
-        for x in line[C_ARG1:dw_e_len] :
-            if testnum(x) == True :
-                value = getnum(x)
-                if value < 0 or value > 65535:
-                    print('Error: Value out of range 0..65535')
-                    print('See file "' + listing_name + '" at line '  + str(line[C_LNUM]))
-                    print(full_source[line[C_LNUM] - 1])
-                    sys.exit()
-                line.append('0x%04X' % value)
-                extmem_cnt += 1
-            elif x in lbl_name :
-                value = lbl_value[lbl_name.index(x)]
-                line.append('0x%04X' % value)
-                extmem_cnt += 1
-            else :
-                if x[0]=='"' and x[-1]=='"' and len(x)>2:
-                    for c in x[1:-1]:
-                        value = ord(c)
-                        line.append('0x%04X' % value)
-                        extmem_cnt += 1
-                else:
-                    print('Error: Invalid argument')
-                    print('See file "' + listing_name + '" at line '  + str(line[C_LNUM]))
-                    print(full_source[line[C_LNUM] - 1])
-                    sys.exit()
+        # arg2
+        opc_lt = enc.arg2
+        if opc_lt == '#U8' :
+            line.lo, line.lo_ref = self.operand(arg2, line.lnum, 2)
+            self.check_u8(line, opc_lt, 2)
+            line.olt = opc_lt
+        elif (opc_lt == '#U16') :
+            line.arg, line.arg_ref = self.operand(arg2, line.lnum, 2)
+
+
+    # a #U8 operand given as number is checked at once, labels are checked by step 4
+    # (the distance of a branch is checked by step 4, as the code may still move)
+    def check_u8(self, line, opc_lt, argnum):
+        if opc_lt == '#U8' and line.lo_ref == '' and line.lo > 255:
+            self.error('Error: Argument too big, must be 0 .. 255', line.lnum,
+                       column=self.column(line.lnum, argnum))
+
+
+    # set the EXTMEM address counter by an org_e directive
+    def org_e(self, line):
+        value = self.const_value(line.args[0], line.lnum, 1)
         
-        del line[C_ARG1:dw_e_len]
-
-    return
-
+        if value < self.extmem_cnt:
+            self.error('Error: address counter must not be set back\n'
+                       'Current value : ' + '0x%04X' % self.extmem_cnt + '   New value : ' + '0x%04X' % value,
+                       line.lnum)
+            
+        self.extmem_cnt = value
+
+
+    def exec_directive(self, line):
+
+        symbols = self.symbols
+
+        # EQU
+        if line.mne=='equ':
+            if len(line.args)!=1 or line.label not in symbols:
+                self.error('Error in EQU directive!', line.lnum)
+            value = self.const_value(line.args[0], line.lnum, 1)
+            # write value to the label defined in this line
+            symbols.set_value(line.label, value)
+            if self.address_dependent(line.args[0]):
+                self.address_equs.add(line.label)
+         
+        # ORG_E
+        elif line.mne=='org_e':
+            if len(line.args)!=1:
+                self.error('Error in ORG_E directive!', line.lnum)
+            self.org_e(line)
+
+        # ORG_I
+        elif line.mne=='org_i':
+            if len(line.args)!=1:
+                self.error('Error in ORG_I directive!', line.lnum)
+            value = self.const_value(line.args[0], line.lnum, 1)
+            if value > 255:
+                self.error('Error: Value out of range 0..255', line.lnum)
+
+            self.intmem_cnt = value
+
+
+        # RES_I
+        elif line.mne=='res_i':
+            if len(line.args)!=1:
+                self.error('Error in RES_I directive! Wrong number of arguments', line.lnum)
+            # get the number of words to reserve
+            # Must be an integer or an already defined label
+            value = self.reserve_count(line.args[0], line.lnum, 1)
+
+            # add own label value to label list
+            if line.label in symbols:
+                symbols.set_value(line.label, self.intmem_cnt)
+
+            self.intmem_ranges.append((self.intmem_cnt, value, line.lnum))
+            self.intmem_cnt+=value
+            if self.intmem_cnt > 256:
+                self.error('Error: Exceeded INTMEM range 0..255', line.lnum, ' or previous')
 
-# ################################################################################
-# ################################################################################
+        
+        # RES_E
+        elif line.mne=='res_e':
+            if len(line.args)!=1:
+                self.error('Error in RES_E directive! Wrong number of arguments', line.lnum)
+            # keep current EXTMEM address for listing and output
+            line.addr = self.extmem_cnt
+            # get the number of words to reserve
+            # Must be an integer or an already defined label
+            value = self.reserve_count(line.args[0], line.lnum, 1)
+            line.size = value
+
+            # add own label value to label list
+            if line.label in symbols:
+                symbols.set_value(line.label, self.extmem_cnt)
 
-# ---  Setup assembler : create lists from table of instructions ---
-# ##################################################################
+            
+            self.extmem_cnt+=value
+            if self.extmem_cnt > 65536:
+                self.error('Error: Exceeded EXTMEM range 0..65535', line.lnum, ' or previous')
 
-# from table 'instructions' extract mnemonics, args1 and args2
-for instr in instructions:
-    if instr[I_MNE] not in mnemonics:
-        mnemonics.append(instr[0])
-    if (instr[I_ARG1] not in args1) and (instr[I_ARG1] not in special_args):
-        args1.append(instr[I_ARG1])
-    if (instr[I_ARG2] not in args2) and (instr[I_ARG2] not in special_args):
-        args2.append(instr[I_ARG2])
+        
+        #'DW_E'
+        elif line.mne=='dw_e':
+            if len(line.args) < 1:
+                self.error('Error in DW_E directive! No arguments found.', line.lnum)
+     
+            # update labellist
+            if line.label in symbols :
+                symbols.set_value(line.label, self.extmem_cnt)
+                
+            line.addr = self.extmem_cnt
+            line.words = array('H')
+            line.refs = []
+            
+            for num, x in enumerate(line.args) :
+                if testnum(x) == True :
+                    line.words.append(self.getnum(x, line.lnum, num + 1))
+                elif x in symbols or self.is_external(x) :
+                    # labels are linked in step 4, so forward references are allowed
+                    line.refs.append((len(line.words), x))
+                    line.words.append(0)
+                elif is_expression(x) :
+                    value, ref = self.operand(x, line.lnum, num + 1)
+                    if ref != '':
+                        line.refs.append((len(line.words), ref))
+                    line.words.append(value)
+                else :
+                    if x[0]=='"' and x[-1]=='"' and len(x)>2:
+                        for c in x[1:-1]:
+                            line.words.append(ord(c))
+                    else:
+                        self.error('Error: Invalid argument', line.lnum,
+                                   column=self.column(line.lnum, num + 1))
+
+            line.size = len(line.words)
+            self.extmem_cnt += line.size
+
+        return
+
+
+    # ---  Step 1 : read all source code into 'full_source'  ---
+    # ##########################################################
+
+    def gather(self, filename, source=None):
+
+        self.filename = filename
+        # register the filename to avoid repeated inclusions
+        self.list_of_filenames.append(os.path.abspath(filename))
+        # derive the filename for the listing with the complete source code
+        # e.g. mainfile.asm -> mainfile.lst
+        self.listing_name = Path(filename).stem + '.lst'
+
+        #read the 'main' source file and all include files into 'full_source'
+        self.gather_source(filename, source)
+
+
+    # ---  Step 1b : preprocessor, expands macros, rept and conditional assembly  ---
+    # ##############################################################################
+    #
+    #   name    macro   par1 par2       define a macro, the body ends with endm
+    #           ...                     parameters used in the body are replaced by
+    #           endm                    the arguments of the call, an '@' in a name
+    #                                   gets a number unique for each expansion
+    #   label   name    arg1 arg2       call a macro, the label goes to its first line
+    #           rept    count           repeat the lines up to endr 'count' times
+    #           endr
+    #           if      value           assemble the following lines if 'value' is not 0,
+    #           ifdef   label           if the label is defined, or if it is not (ifndef)
+    #           else                    by an equ directive before
+    #           endif
+    #
+    # Values are numbers or EQU labels defined before. Include directives are resolved
+    # by step 1, so they are not subject to conditional assembly.
+    # The preprocessor only runs if a source file contains one of its directives. The
+    # lines are expanded as a stream into a new 'full_source', so the listing shows the
+    # expansions: a call becomes a comment marked with '; -> ' and is followed by the
+    # lines of the macro, directives and skipped lines are kept without code. The
+    # source map points the expanded lines to the lines of the macro in its file.
+
+    # (text, tokens, index to 'sources', line in that file) of each line of a
+    # combined source 'full_source' with its 'source_map'
+    def source_records(self, full_source, source_map, file_tokens):
+        runs = source_map + [(len(full_source), -1, 0)]
+        for run in range(len(runs) - 1):
+            start, index, fileline = runs[run]
+            for linenum in range(start, runs[run + 1][0]):
+                if index < 0:
+                    yield full_source[linenum], None, -1, 0
+                else:
+                    yield (full_source[linenum], file_tokens[index][fileline + linenum - start],
+                           index, fileline + linenum - start)
+
+
+    def preprocess(self):
+        if not any(source.preprocess for source in self.sources):
+            return
+
+        records = self.source_records(self.full_source, self.source_map, self.file_tokens())
+        self.full_source = []
+        self.source_map = []
+        self.line_tokens = []
+        full_source = self.full_source
+        line_tokens = self.line_tokens
+
+        # the lines are appended one by one, a run of the source map goes on while
+        # they follow each other in the same file
+        following = None
+        for text, tokens, index, fileline in self.pre_stream(records, 0):
+            if (index, fileline) != following:
+                self.map_source(index, fileline)
+            full_source.append(text)
+            line_tokens.append(tokens)
+            following = (index, fileline + 1) if index >= 0 else (-1, 0)
+
+
+    # an error of the preprocessor in line 'lnum' of the new 'full_source' (default:
+    # the line written last), the preprocessor goes on like steps 2 and 3
+    def pre_error(self, message, lnum=None):
+        try:
+            self.error(message, lnum or len(self.full_source))
+        except AsmError as e:
+            self.collect(e)
+
+
+    # value of a token known to the preprocessor: a number, an EQU label defined
+    # before or an expression of them, None if not known
+    def pre_evaluate(self, kind, value):
+        if kind == TOK_NUMBER:
+            return value
+        if kind == TOK_EXPR:
+            try:
+                expression = parse_expression(value)
+                if expression.address or not expression.names <= self.pre_values.keys():
+                    return None
+                return expression.function(self.pre_values.get, None)
+            except (ArithmeticError, ValueError):
+                return None
+        return self.pre_values.get(value)
+
+
+    # value of the argument of if and rept: a number, an EQU label defined before
+    # or an expression of them
+    def pre_value(self, tokens, mne):
+        if len(tokens) != 1:
+            self.pre_error('Error in ' + mne.upper() + ' directive!')
+            return 0
+        value = self.pre_evaluate(*tokens[0])
+        if value is not None:
+            return value
+        self.pre_error('Error: ' + mne.upper() + ' needs a number or an EQU label defined before')
+        return 0
+
+
+    # the lines of 'records' with all directives of the preprocessor executed
+    # 'depth' counts the macro expansions the lines come from
+    def pre_stream(self, records, depth):
+        records = iter(records)
+        macros = self.macros
+        # one entry for each open if: True while its lines are assembled, False while
+        # they are skipped, None if the whole if is skipped by an outer one
+        conditions = []
+
+        for record in records:
+            text, tokens, index, fileline = record
+            if tokens is None:
+                yield record
+                continue
+            kind, name = tokens[0]
+            # the directive or macro name follows the label, if there is one
+            # a macro name is a label if a mnemonic, directive or macro name follows
+            first = 1
+            if kind == TOK_MNEMONIC or (name in macros and (len(tokens) < 2 or
+                                                            (tokens[1][0] != TOK_MNEMONIC and
+                                                             tokens[1][1] not in macros))):
+                first = 0
+            mne = tokens[first][1] if first < len(tokens) else ''
+            active = not conditions or conditions[-1] is True
+
+            if mne in PRE_CONDITIONALS:
+                yield text, None, index, fileline
+                if first:
+                    self.pre_error('Error: ' + mne.upper() + ' must not have a label')
+                if mne == 'else' or mne == 'endif':
+                    if not conditions:
+                        self.pre_error('Error: ' + mne.upper() + ' without IF')
+                    elif mne == 'endif':
+                        conditions.pop()
+                    elif conditions[-1] is not None:
+                        conditions[-1] = not conditions[-1]
+                elif not active:
+                    conditions.append(None)
+                elif mne == 'if':
+                    conditions.append(self.pre_value(tokens[first + 1:], mne) != 0)
+                elif len(tokens) != 2 or tokens[1][0] != TOK_LABEL:
+                    self.pre_error('Error in ' + mne.upper() + ' directive!')
+                    conditions.append(False)
+                else:
+                    conditions.append((tokens[1][1] in self.pre_values) == (mne == 'ifdef'))
+                continue
+
+            if not active:
+                yield text, None, index, fileline
+                continue
+
+            if mne == 'macro':
+                yield text, None, index, fileline
+                lnum = len(self.full_source)
+                body = []
+                for record in records:
+                    yield record[0], None, record[2], record[3]
+                    words = [token[1] for token in record[1] or ()]
+                    if 'endm' in words[:2]:
+                        break
+                    if 'macro' in words[:2]:
+                        self.pre_error('Error: macro definitions must not be nested')
+                    body.append(record)
+                else:
+                    self.pre_error('Error: MACRO without ENDM', lnum)
+                    return
+                params = [value for kind, value in tokens[2:]]
+                if first == 0 or any(kind != TOK_LABEL or not is_valid_label(value)
+                                     for kind, value in tokens[2:]):
+                    self.pre_error('Error in MACRO directive! A label (the name) and '
+                                   'parameters made of a-z, 0-9 and underscore expected', lnum)
+                elif name in macros:
+                    self.pre_error('Error: redefinition of macro "' + name + '"', lnum)
+                else:
+                    macros[name] = (params, [record + (macro_template(record[0], params),)
+                                             for record in body])
+                    # the number after '@' must end where the name goes on
+                    for num, (_, _, _, _, pieces) in enumerate(macros[name][1]):
+                        for piece in pieces or ():
+                            if isinstance(piece, tuple) and re.search('@[0-9]', piece[0]):
+                                self.pre_error('Error: no digit must follow the \'@\' in "' + piece[0] + '"',
+                                               lnum + 1 + num)
+                continue
+
+            if mne == 'rept':
+                yield text, None, index, fileline
+                lnum = len(self.full_source)
+                count = self.pre_value(tokens[first + 1:], mne)
+                if first:
+                    self.pre_error('Error: REPT must not have a label')
+                # the body up to the matching endr, rept may be nested
+                body = []
+                nested = 0
+                for record in records:
+                    words = [token[1] for token in record[1] or ()]
+                    if 'endr' in words[:2]:
+                        if nested == 0:
+                            break
+                        nested -= 1
+                    elif 'rept' in words[:2]:
+                        nested += 1
+                    body.append(record)
+                else:
+                    self.pre_error('Error: REPT without ENDR', lnum)
+                    return
+                for _ in range(count):
+                    yield from self.pre_stream(body, depth)
+                yield record[0], None, record[2], record[3]
+                continue
+
+            if mne in ('endm', 'endr'):
+                yield text, None, index, fileline
+                self.pre_error('Error: ' + mne.upper() + ' without ' + ('MACRO' if mne == 'endm' else 'REPT'))
+                continue
+
+            if kind == TOK_LABEL and mne in macros:
+                yield from self.expand_macro(record, first, depth)
+                continue
+
+            # EQU values are known for the conditions that follow
+            if mne == 'equ' and first and len(tokens) == 3:
+                value = self.pre_evaluate(*tokens[2])
+                if value is not None:
+                    self.pre_values[name] = value
+            yield record
+            if depth == 0:
+                self.pre_check_names(tokens)
+
+        if conditions:
+            self.pre_error('Error: IF without ENDIF')
+
+
+    # names with '@' are made by macro expansions only, so they cannot be the same
+    # as a label outside of a macro, checks the tokens of the line written last
+    def pre_check_names(self, tokens):
+        if any('@' in value for kind, value in tokens if kind in (TOK_LABEL, TOK_EXPR)):
+            self.pre_error("Error: '@' is only allowed in names in the body of a macro")
+
+
+    # the lines of a macro call 'record', 'first' is the index of the macro name in its tokens
+    def expand_macro(self, record, first, depth):
+        text, tokens, index, fileline = record
+        name = tokens[first][1]
+        yield '; -> ' + text, None, index, fileline
+        if depth == 0:
+            self.pre_check_names(tokens)
+        params, body = self.macros[name]
+        # the arguments as written in the call, names are not converted to lowercase
+        words = [match.group(match.lastindex) for match in lexer.finditer(text)
+                 if match.lastindex in (2, 4)]
+        args = words[first + 1:]
+        if len(args) != len(params):
+            self.pre_error('Error: macro "' + name + '" needs ' + str(len(params)) + ' arguments')
+            return
+        if depth >= MAX_MACRO_DEPTH:
+            self.pre_error('Error: macros nested too deep (does "' + name + '" call itself?)')
+            return
+
+        self.expansions += 1
+        # '@' stays in the name, so it differs from all labels outside of macros
+        unique = '@' + str(self.expansions)
+        lines = []
+        for text, tokens, index, fileline, pieces in body:
+            if pieces is not None:
+                text = ''.join(args[piece] if isinstance(piece, int) else
+                               piece[0].replace('@', unique) if isinstance(piece, tuple) else piece
+                               for piece in pieces)
+                tokens = tokenize_line(text)
+            lines.append((text, tokens, index, fileline))
+
+        # the label of the call goes to the first line of code of the macro
+        label = words[0] if first else ''
+        for text, tokens, index, fileline in self.pre_stream(lines, depth + 1):
+            if label and tokens is not None:
+                if tokens[0][0] != TOK_MNEMONIC:
+                    yield text, tokens, index, fileline
+                    self.pre_error('Error: the first line of macro "' + name + '" has a label, '
+                                   'so the call must not have one')
+                    label = ''
+                    continue
+                text = label.ljust(7) + ' ' + text.lstrip()
+                tokens = [(TOK_LABEL, label.lower())] + tokens
+                label = ''
+            yield text, tokens, index, fileline
+        yield '; -> end of macro "' + name + '"\n', None, -1, 0
+        if label:
+            self.pre_error('Error: Orphaned Label. Macro "' + name + '" has no code')
+
+
+    # ---  Step 2 : filter 'full_source' for pure source code and put it into 'code' ---
+    #      Create the symbol table with labels, line numbers, and kinds
+    # ##################################################################################
+
+    # tokens of the lines of each source file, every source file is tokenized
+    # only once, or taken from the cache
+    def file_tokens(self):
+        if self.cache is not None:
+            return [self.cache.tokens(source) for source in self.sources]
+        return [tokenize_lines(source.lines) for source in self.sources]
+
+
+    # tokens of each line of 'full_source', None for lines without code
+    def source_tokens(self):
+        if self.line_tokens is not None:
+            yield from enumerate(self.line_tokens)
+            return
+        file_tokens = self.file_tokens()
+
+        runs = self.source_map + [(len(self.full_source), -1, 0)]
+        for run in range(len(runs) - 1):
+            start, index, fileline = runs[run]
+            if index < 0:
+                continue
+            tokens = file_tokens[index]
+            for linenum in range(start, runs[run + 1][0]):
+                yield linenum, tokens[fileline + linenum - start]
+
+
+    def tokenize(self):
+
+        symbols = self.symbols
+
+        for linenum, tokens in self.source_tokens():
+            if tokens is None:
+                continue
+
+            # line number for reference and linkage
+            lnum = linenum + 1
+            # commas only separate arguments
+            if (TOK_COMMA, ',') in tokens:
+                tokens = [token for token in tokens if token[0] != TOK_COMMA]
+                if not tokens:
+                    continue
+            kind, label = tokens[0]
+
+            try:
+                # if the mnemonic is not preceded by a label...
+                if kind == TOK_MNEMONIC:
+                    label = ''
+                    first = 0
+                #else test if label is valid
+                elif kind != TOK_REGISTER:
+                    # label already existing?
+                    if label in symbols:
+                        self.error('Error: redeclaration of label', lnum)
+                    # label must not be the only string in a line
+                    if len(tokens) < 2:
+                        self.error('Error: Orphaned Label.', lnum)
+                    # Test for valid label then add it with line number and kind to the symbol table
+                    # names with '@' come from macro expansions (see Step 1b)
+                    name = label.replace('@', '_') if self.line_tokens is not None else label
+                    if kind != TOK_LABEL or not is_valid_label(name) :
+                        self.error("Error: invalid label. Use only a-z, 0-9 and underscore, don't start with a number",
+                                   lnum)
+                    if tokens[1][1] in (SYM_EQU, SYM_RES_I, SYM_RES_E):
+                        symbols.define(label, lnum, tokens[1][1])
+                    else:
+                        symbols.define(label, lnum, SYM_CODE)
+                    first = 1
+
+                else : 
+                    self.error("Error! Do not use reserved names as a label", lnum)
+            except AsmError as e:
+                self.collect(e)
+                continue
+
+            self.code.append(CodeLine(lnum, label, tokens[first][1],
+                                      [value for kind, value in tokens[first + 1:]]))
+
+
+    # ---  Step 3 : assemble ---
+    # ##########################
+
+    def assemble(self):
+
+        for line in self.code:
+            try:
+                if line.mne in mnemonics:
+                    self.add_to_code(line)
+                elif line.mne in directives:
+                    self.exec_directive(line)
+                else:
+                    self.error('Error: Mnemonic or directive expected.', line.lnum,
+                               column=self.column(line.lnum))
+            except AsmError as e:
+                self.collect(e)
+
+        # the addresses are not reliable after an error, so the later steps are not
+        # run, but step 4 checks the operands for the report of all errors (after a
+        # line with an error the distances of branches may be off by its size)
+        if self.diagnostics:
+            self.link()
+
+
+    # ---  Step 3a : peephole optimizer (optional) ---
+    # ################################################
+
+    # index of the first instruction at or after code[num] that is still in the
+    # code, None if data, an org_e or the end of the code comes first
+    def live_from(self, num):
+        code = self.code
+        while num < len(code):
+            line = code[num]
+            if not line.removed:
+                if line.mne in mnemonics:
+                    return num
+                if line.addr is not None or line.mne == 'org_e':
+                    return None
+            num += 1
+        return None
+
+
+    # index of the instruction a label operand points to, None if it is a number
+    # or not the label of an instruction
+    def target_index(self, name, labels):
+        if name == '' or name not in labels:
+            return None
+        return self.live_from(labels[name])
+
+
+    # label operand of an instruction with one argument (branch, jmpd, calld)
+    def target_ref(self, line):
+        if line.olt == '#S8':
+            return line.lo_ref
+        return line.arg_ref
+
+
+    # indices of the chain of jmpd instructions reached from the target of code[num],
+    # an empty list if the target is no jmpd, None if the chain is an endless loop
+    def jump_chain(self, num, labels):
+        chain = []
+        target = self.target_index(self.target_ref(self.code[num]), labels)
+        # a jmpd to an address relative to itself ('$') cannot be followed
+        while target is not None and self.code[target].mne == 'jmpd' and '$' not in self.code[target].arg_ref:
+            if target == num or target in chain:
+                return None
+            chain.append(target)
+            target = self.target_index(self.code[target].arg_ref, labels)
+        return chain
+
+
+    # True if instruction 'line' matches 'pattern', 'other' is the first
+    # instruction when 'line' is the second one
+    def peep_match(self, pattern, num, labels, other=None):
+        line = self.code[num]
+        mnes, arg1, arg2 = pattern
+        if line.mne not in mnes or len(line.args) != (arg1 != '') + (arg2 != ''):
+            return False
+        for pos, arg in enumerate((arg1, arg2)):
+            if arg == '':
+                continue
+            value = line.args[pos]
+            if arg == 'X':
+                # with '$' the same text has another value in the other instruction
+                if value in named_args or (isinstance(value, str) and '$' in value):
+                    return False
+                # the same operand as the other argument of the first instruction
+                if other is not None and value != other.args[1 - pos]:
+                    return False
+            elif arg == 'NEXT':
+                target = self.target_index(self.target_ref(line), labels)
+                if target is None or target != self.live_from(num + 1):
+                    return False
+            elif arg == 'JMPD':
+                if not self.jump_chain(num, labels):
+                    return False
+            elif value != arg:
+                return False
+        return True
+
+
+    # remove an instruction or dw_e, its label keeps the address of the next line
+    # 'opt' names the step that removed it in the listing
+    def remove_line(self, line, opt):
+        line.removed = True
+        line.opt = opt
+        line.size = 0
+        line.olt = ''
+        line.lo_ref = ''
+        line.arg_ref = ''
+        line.arg = None
+        line.refs = None
+
+
+    def peep_remove(self, line, rule):
+        stats = self.peephole_stats[rule]
+        stats[1] += line.size
+        stats[2] += line.cycles[1]
+        self.remove_line(line, '-O: ' + rule)
+
+
+    # apply the rules of table 'peephole_rules' until none matches any more,
+    # then assign the new addresses
+    def peephole(self):
+        code = self.code
+        self.peephole_stats = {rule[0]: [0, 0, 0] for rule in peephole_rules}
+        # index into 'code' of each label of an instruction, dw_e or res_e
+        labels = {line.label: num for num, line in enumerate(code)
+                  if line.label != '' and line.addr is not None}
+        changed = True
+        while changed:
+            changed = False
+            for num, line in enumerate(code):
+                if line.mne not in mnemonics or line.removed:
+                    continue
+                for rule, first, second, action in peephole_rules:
+                    if not self.peep_match(first, num, labels):
+                        continue
+                    if second is not None:
+                        nextnum = self.live_from(num + 1)
+                        if nextnum is None or not self.peep_match(second, nextnum, labels, line):
+                            continue
+                        # a label of the second instruction (or of removed ones before it)
+                        if any(code[between].label != '' and code[between].addr is not None
+                               for between in range(num + 1, nextnum + 1)):
+                            continue
+                    self.peephole_stats[rule][0] += 1
+                    if action in (PEEP_DROP_FIRST, PEEP_DROP_BOTH):
+                        self.peep_remove(line, rule)
+                    if action in (PEEP_DROP_SECOND, PEEP_DROP_BOTH):
+                        self.peep_remove(code[nextnum], rule)
+                    if action == PEEP_RETARGET:
+                        # jump directly to the target of the last jmpd of the chain
+                        chain = self.jump_chain(num, labels)
+                        jump = code[chain[-1]]
+                        line.arg_ref = jump.arg_ref
+                        line.arg = jump.arg
+                        line.opt = '-O: ' + rule
+                        # the jmpd instructions are not executed any more
+                        self.peephole_stats[rule][2] += sum(code[target].cycles[1] for target in chain)
+                    changed = True
+                    break
+
+        if any(stats[0] for stats in self.peephole_stats.values()):
+            self.layout()
+
+
+    # lines of text with the savings of the peephole optimizer
+    def peephole_report(self):
+        report = []
+        words = 0
+        cycles = 0
+        for rule, (count, rulewords, rulecycles) in self.peephole_stats.items():
+            if count:
+                report.append('%-20s %5d x  %5d words  %5d cycles' % (rule, count, rulewords, rulecycles))
+                words += rulewords
+                cycles += rulecycles
+        report.append('%-20s           %5d words  %5d cycles' % ('Total saved', words, cycles))
+        return report
+
+
+    # ---  Step 3c : dead code elimination (optional) ---
+    # ###################################################
+
+    # Code is split into blocks, each label and each org_e begins a new one.
+    # Starting from the blocks at the first instruction, the reset and interrupt
+    # vectors and the labels of the keep-list all blocks are marked that are reached
+    # by falling through, by a branch, jmpd or calld or by any label used as operand
+    # of a reached block (the address may be loaded for calli/jmpi).
+    # The instructions and dw_e of the other blocks are removed, res_e is kept.
+
+    def dead_code(self):
+        code = self.code
+
+        blocks = []		# list of blocks, each a list of indices into 'code'
+        sections = []		# section number of each block
+        section = 0
+        current = None
+        for num, line in enumerate(code):
+            if line.mne == 'org_e':
+                current = None
+                section += 1
+                continue
+            if line.addr is None:
+                continue
+            if current is None or line.label != '':
+                current = []
+                blocks.append(current)
+                sections.append(section)
+            current.append(num)
+
+        # EXTMEM address -> block of the line at this address
+        addr_block = {}
+        label_block = {}
+        for blocknum, block in enumerate(blocks):
+            for num in block:
+                line = code[num]
+                if not line.removed:
+                    addr_block.setdefault(line.addr, blocknum)
+                if line.label != '':
+                    label_block[line.label] = blocknum
+
+        # roots
+        todo = []
+        for addr in (RESET_VECTOR,) + IRQ_VECTORS:
+            if addr in addr_block:
+                todo.append(addr_block[addr])
+        for blocknum, block in enumerate(blocks):
+            if any(code[num].mne in mnemonics and not code[num].removed for num in block):
+                todo.append(blocknum)
+                break
+        for name in self.keep:
+            if name not in label_block:
+                self.error('Error: Label "' + name + '" of the keep-list is not a label of the code')
+            todo.append(label_block[name])
+
+        reached = set()
+        while todo:
+            blocknum = todo.pop()
+            if blocknum in reached:
+                continue
+            reached.add(blocknum)
+            falls = True
+            for num in blocks[blocknum]:
+                line = code[num]
+                if line.removed:
+                    continue
+                # labels used as operands and numeric targets of jumps
+                refs = [line.lo_ref, line.arg_ref] + [ref for _, ref in line.refs or []]
+                for ref in refs:
+                    if ref == '':
+                        continue
+                    for name in self.ref_names(ref):
+                        if name in label_block:
+                            todo.append(label_block[name])
+                if line.lo_ref == '' and line.olt == '#S8' and line.lo in addr_block:
+                    todo.append(addr_block[line.lo])
+                if line.arg_ref == '' and line.mne in ('jmpd', 'calld') and line.arg in addr_block:
+                    todo.append(addr_block[line.arg])
+                falls = line.mne not in ('rets', 'reti', 'jmpd', 'jmpi')
+            if falls and blocknum + 1 < len(blocks) and sections[blocknum + 1] == sections[blocknum]:
+                todo.append(blocknum + 1)
+
+        # remove the blocks not reached
+        self.gc_blocks = []
+        for blocknum, block in enumerate(blocks):
+            if blocknum in reached:
+                continue
+            words = 0
+            for num in block:
+                line = code[num]
+                if not line.removed and (line.mne in mnemonics or line.mne == 'dw_e'):
+                    words += line.size
+                    self.remove_line(line, '--gc: not reachable')
+            if words:
+                first = code[block[0]]
+                self.gc_blocks.append((first.label, first.lnum, words))
+
+        if self.gc_blocks:
+            self.layout()
+
+
+    # lines of text with the blocks removed by the dead code elimination
+    def dead_code_report(self):
+        report = []
+        for label, lnum, words in self.gc_blocks:
+            report.append('Line ' + str(lnum) + '  ' + (label or '(no label)') + ' ' + str(words) + ' words')
+        report.append('Total reclaimed ' + str(sum(block[2] for block in self.gc_blocks)) + ' words')
+        return report
+
+
+    # ---  Step 3b : relax branches (optional) ---
+    # ############################################
+
+    # assign the EXTMEM addresses again after the size of instructions has changed,
+    # the labels of instructions, dw_e and res_e are moved with them
+    # EQU values and res_e sizes given by labels or expressions are computed again
+    # in the order of the lines, as by step 3, since they may depend on addresses
+    def layout(self):
+        symbols = self.symbols
+        self.extmem_cnt = 0
+        for line in self.code:
+            if line.mne == 'org_e':
+                self.org_e(line)
+                continue
+            if line.mne == 'equ':
+                if line.label in symbols and not testnum(line.args[0]):
+                    symbols.set_value(line.label, self.const_value(line.args[0], line.lnum, 1))
+            elif line.mne == 'res_e' and line.addr is not None and not testnum(line.args[0]):
+                line.size = self.reserve_count(line.args[0], line.lnum, 1)
+            if line.addr is not None:
+                if line.label in symbols:
+                    symbols.set_value(line.label, self.extmem_cnt)
+                line.addr = self.extmem_cnt
+                self.extmem_cnt += line.size
+        if self.extmem_cnt > 65536:
+            self.error('Error: Exceeded EXTMEM range 0..65535', self.code[-1].lnum, ' or previous')
+
+
+    # replace each branch whose target is out of reach with the inverted branch around
+    # a jmpd and recompute the layout until no branch changes any more
+    # a relaxed branch becomes short again when its target is within reach
+    def relax_branches(self):
+        branches = [line for line in self.code if line.olt == '#S8']
+        passes = 0
+        changed = True
+        while changed:
+            changed = False
+            for line in branches:
+                target = line.lo
+                if line.lo_ref != '':
+                    target = self.ref_value(line.lo_ref, line.addr)
+                    if target == -1:
+                        # not defined, reported by step 4
+                        continue
+                far = not branch_fits(line.addr, target)
+                if passes >= RELAX_SHRINK_PASSES:
+                    far = far or line.far
+                if far != line.far:
+                    line.far = far
+                    if far:
+                        line.size = FAR_BRANCH_SIZE
+                        line.cycles = FAR_BRANCH_CYCLES
+                    else:
+                        line.size = 1
+                        line.cycles = opcode_cycles(line.opcode)
+                    changed = True
+            if changed:
+                self.layout()
+            passes += 1
+
+
+    # ---  Step 4 : link ---
+    # ######################
+
+    def link(self):
+        symbols = self.symbols
+
+        for line in self.code:
+            try:
+                # an object is only linked for the report of the errors of step 3,
+                # its external labels are left to the linker
+                if self.relocatable and any(name not in symbols
+                                            for ref in [line.lo_ref, line.arg_ref] + [ref for _, ref in line.refs or []]
+                                            if ref != '' for name in self.ref_names(ref)):
+                    continue
+                # replace all target labels with their value
+                if line.lo_ref != '' :
+                    line.lo = self.linkvalue(line.lo_ref, line.lnum, line.addr)
+                if line.arg_ref != '' :
+                    line.arg = self.linkvalue(line.arg_ref, line.lnum, line.addr)
+                if line.refs :
+                    for wordnum, word in line.refs :
+                        line.words[wordnum] = self.linkvalue(word, line.lnum, line.addr)
+
+                # put the #U8 and #S8 operands into the opcode
+                if line.olt == '#U8' :
+                    if line.lo > 255 :
+                        self.error('Error: Argument too big, must be 0 .. 255', line.lnum)
+                    line.opcode += line.lo
+                elif line.olt == '#S8' :
+                    if line.far :
+                        # inverted branch over the jmpd to the target
+                        line.opcode = (line.opcode ^ BRANCH_INVERT) + FAR_BRANCH_SIZE - 1
+                        line.arg = line.lo
+                        continue
+                    if not branch_fits(line.addr, line.lo) :
+                        self.error('Error: Destination out of reach (-128 .. +127)', line.lnum)
+                    offset = line.lo - line.addr - 1
+                    if offset < 0 :
+                        offset = 256 + offset
+                    line.opcode += offset
+            except AsmError as e:
+                self.collect(e)
+        self.check_errors()
+
+
+    # ---  Step 5 : create final listing  ---
+    # #######################################
+
+    # worst case cycles of the straight-line code starting at code[start], i.e. all
+    # instructions up to the next rets, reti, jmpd or jmpi (or until a gap or data)
+    # a branch counts with its maximum, a calld with the cycles of its subroutine
+    # returns (cycles, index into 'code' of the last instruction)
+    # 'memo' keeps the results of all labels, 'active' the subroutines being counted
+    def straight_cycles(self, start, memo, active):
+        if start in memo:
+            return memo[start]
+        active.add(start)
+
+        code = self.code
+        cycles = 0
+        last = start
+        nextaddr = code[start].addr
+        for num in range(start, len(code)):
+            line = code[num]
+            if line.addr is None or line.removed:
+                continue
+            if line.cycles is None or line.addr != nextaddr:
+                break
+            cycles += line.cycles[1]
+            nextaddr += line.size
+            last = num
+            if line.mne == 'calld':
+                callee = self.code_index.get(line.arg)
+                # a recursive call is only counted once
+                if callee is not None and callee not in active:
+                    cycles += self.straight_cycles(callee, memo, active)[0]
+            if line.mne in ('rets', 'reti', 'jmpd', 'jmpi'):
+                break
+
+        active.discard(start)
+        memo[start] = (cycles, last)
+        return memo[start]
+
+
+    def make_listing(self):
+
+        code = self.code
+        # add the hex listing to the source code
+        listing = []
+        codelinenum = 0
+
+        for linenum, srcline in enumerate(self.full_source) :
+            if codelinenum < len(code) and code[codelinenum].lnum == linenum + 1:
+                line = code[codelinenum]
+                if line.opt != '' :
+                    end = '\n' if srcline.endswith('\n') else ''
+                    if line.removed :
+                        srcline = srcline.rstrip('\n') + '  ; removed by ' + line.opt + end
+                    else :
+                        srcline = srcline.rstrip('\n') + '  ; ' + line.opt + end
+                if line.removed :
+                    listing.append('                             ' + srcline)
+                elif line.mne in mnemonics : 
+                    temp = '0x%04X  0x%04X  ' % (line.addr, line.opcode)
+                    if line.far :
+                        # the target follows the jmpd, it is shown after the source line
+                        temp = temp + '0x%04X  ' % JMPD_OPCODE
+                        end = '\n' if srcline.endswith('\n') else ''
+                        srcline = srcline.rstrip('\n') + '  ; relaxed: jmpd 0x%04X' % line.arg + end
+                    elif line.arg is None :
+                        temp = temp + '        '
+                    else :
+                        temp = temp + '0x%04X  ' % line.arg
+                    # cycles, min/max for branches
+                    if line.cycles[0] == line.cycles[1] :
+                        temp = temp + '%-5d' % line.cycles[0]
+                    else :
+                        temp = temp + '%-5s' % ('%d/%d' % line.cycles)
+                    listing.append(temp + srcline)
+                elif line.mne == 'dw_e' :
+                    temp = '  '.join(['0x%04X' % line.addr] + ['0x%04X' % word for word in line.words])
+                    listing.append(temp + ' | ' + srcline)
+                else:
+                    listing.append('                             ' + srcline)
+                codelinenum += 1
+                if codelinenum == len(code):
+                    listing.extend(self.full_source[linenum + 1:])
+                    break
+            else:
+                listing.append('                             ' + srcline)
+
+        # append list of label/value pairs
+        listing.append('\n\nList of labels\n\n')
+
+        for symbol in self.symbols:
+            listing.append("Line " + str(symbol.line) + "  ")
+            listing.append(symbol.name + ' ' + str(symbol.value))
+            listing.append(' | ' + str('0x%04X' % symbol.value) + '\n')
+
+        # append the worst case cycles of the code following each label
+        # instructions are found by their address to follow calld
+        self.code_index = {}
+        for num, line in enumerate(code):
+            if line.cycles is not None and not line.removed:
+                self.code_index[line.addr] = num
+        labels = [(symbol, self.code_index.get(symbol.value)) for symbol in self.symbols
+                  if symbol.kind == SYM_CODE]
+        labels = [(symbol, num) for symbol, num in labels if num is not None]
+        if labels:
+            listing.append('\n\nCycles per label (worst case of the straight-line code '
+                           'up to rets/reti/jmpd/jmpi, including called subroutines)\n\n')
+        memo = {}
+        for symbol, num in labels:
+            cycles, last = self.straight_cycles(num, memo, set())
+            listing.append("Line " + str(symbol.line) + "  ")
+            listing.append(symbol.name + ' ' + str(cycles) + ' cycles')
+            listing.append(' | up to line ' + str(code[last].lnum) + ' ' + code[last].mne + '\n')
+
+        if self.optimize:
+            listing.append('\n\nPeephole optimizer (cycles saved per execution, '
+                           'branches counted with their maximum)\n\n')
+            listing.append('\n'.join(self.peephole_report()) + '\n')
+
+        if self.gc:
+            listing.append('\n\nDead code elimination (blocks not reachable from the vectors)\n\n')
+            listing.append('\n'.join(self.dead_code_report()) + '\n')
+
+        # append the source map: the lines of this listing taken from each source file
+        listing.append('\n\nSource files (lines of this listing -> file and lines)\n\n')
+        runs = self.source_map + [(len(self.full_source), -1, 0)]
+        for run in range(len(runs) - 1):
+            start, index, fileline = runs[run]
+            end = runs[run + 1][0]
+            if index < 0 or end == start:
+                continue
+            listing.append('Lines ' + str(start + 1) + ' - ' + str(end) + '  ' +
+                           self.sources[index].name + ' ' + str(fileline + 1) + ' - ' +
+                           str(fileline + end - start) + '\n')
+
+        self.listing = ''.join(listing)
+
+
+    # ---  Step 6 : Generate output listings  ---
+    # #######################################m###
+
+    def make_outputs(self):
+
+        code = self.code
+
+
+        # First: generate the .bin file that can be used for the initialization
+        # of a block ram via the FPGA configuration file. (Pseudo ROM)
+        #
+        # The files size must exactly match the BRAM size, so if there are gaps
+        # from skipping memory areas by using org_e or res_e directives these gaps
+        # are filled with zeros and included in the file
+        # The file length must be adjusted in the asm file via directives
+
+        # Although the resulting .bin file does not include any information where it is
+        # stored in the address space, we must keep track of the address information
+        # during the generation of the file to detect and handle gaps.  
+        # The words are collected in 'image', a MemoryImage of contiguous runs of
+        # words. Gaps are only filled with zeros, in one go, for the formats without
+        # addresses (.bin and raw), all other formats are generated from the runs.
+
+        image = MemoryImage()
+
+        # Now filter list 'code' for all instruction/dw_e/res_e entries
+        # since only these three types contribute to the data output
+        for line in code :
+
+            if line.addr is None or line.removed or line.size == 0 :
+                continue
+            # sections placed by org_e always ascend, but check it for linked objects
+            if line.addr < image.end and not image.empty() :
+                self.error('Error: EXTMEM 0x{:04X} is already used by previous code'.format(line.addr),
+                           line.lnum)
+
+            if line.mne in mnemonics :
+                words = [line.opcode]
+                if line.far:
+                    words.append(JMPD_OPCODE)
+                if line.arg is not None:
+                    words.append(line.arg)
+                image.add(line.addr, words)
+            elif line.mne == 'dw_e' :
+                image.add(line.addr, line.words)
+            elif line.mne == 'res_e' :
+                # reserved words are filled with zeros
+                image.reserve(line.addr, line.size)
+
+        self.image = image
+        self.binary = ''.join(map('{:016b}\n'.format, image.dense()))
+            
 
-# create a numerical fingerprint for each instruction
-for instr in instructions:
-    # each instruction has a mnemonic, so start with 0
-    fp = mnemonics.index(instr[I_MNE]) * 65536
-    # 'special_args' count as zero, so start with 1
-    if instr[I_ARG1] != '':  # '' counts as zero
-        if instr[I_ARG1] in num_args:
-            fp += 256
-        else:
-            fp += (args1.index(instr[I_ARG1]) + 2) * 256
-    if instr[I_ARG2] != '':  # '' counts as zero
-        if instr[I_ARG2] in num_args:
-            fp += 1
-        else:
-            fp += (args2.index(instr[I_ARG2]) + 2)
-    fingerprint.append(fp)
-    #print(instr, fp)
-# Debug! Should only be invoked when making changes to 'instructions'
-# that lead to duplicate fingerprints
-if len(fingerprint) != len(set(fingerprint)):
-    print('Error! Instructions table is equivocal')
-
-# fill the two arrays with reserved strings  
-named_args = tuple(set(args1 + args2))
-mnemonics_and_directives = tuple(mnemonics) + directives
-
-# Say Hello
-print('\nEC16ASM  V1.0.1 08-Feb-2025 -  Assembler for the EC16 microprocessor\n')
-
-
-# ---  Step 1 : read all source code into 'full_source' and create listing  ---
-# #############################################################################
-
-# open the 'main' ASM file mentioned in the command line
-if len(sys.argv) == 2:
-    filename = sys.argv[1]
-    # register the filename to avoid repeated inclusions
-    list_of_filenames.append(os.path.abspath(filename))
-    # derive the filename for the listing with the complete source code
-    # e.g. mainfile.asm -> mainfile.lst
-    listing_name = Path(filename).stem + '.lst'
-else:
-    print('Error in command line! Usage: ec16asm.py "mainfile.asm"')
-    sys.exit()
-    
-readsourcefile(filename)  #read the 'main' source file into list 'single_source'
-full_source = single_source  #copy 'single_source' into 'full_source'
-single_source = []  #empty 'single_source' for possible include files
-
-#scan 'full_source' for include directive
-while find_include() == True :
-    # include directive found, so comment it out and mark it with '; -> '
-    full_source[linenum] = '; -> ' + full_source[linenum]
-    filename = filename.strip('\"')
-    # ensure that no file is included more than once
-    if os.path.abspath(filename) not in list_of_filenames:
-        # read include file into 'single_source'
-        readsourcefile(filename)
-        linenum += 1
-        # insert include file into 'full_source' 
-        full_source[linenum:linenum] = single_source
-        # mark the end of the include file
-        endmarker = '; -> end of included file "' + filename + '"\n'
-        linenum_temp = linenum+len(single_source)
-        full_source[linenum_temp:linenum_temp] = [endmarker]
-        single_source = []  #empty 'single_source' for possible next include files
-        # register the filename
-        list_of_filenames.append(os.path.abspath(filename))
-        # linenum += 1
+        # Second: generate a text file in the ECMON format
+        # i.e. Target address, '=', up to 8 (ecm_words) words separated by space
+        # e.g. 8000=a100 807f a100 80d4 a100 80df a100 881b
+        # Empty sections (org_e/res_e) are not included, see ecmon_lines()
+
+        self.ecmon = ''.join(ecmon_lines(image, self.ecm_words))
+        self.make_formats()
+        self.make_map()
+
+
+    # Third: the additional output formats chosen, all generated from 'image'
+    def make_formats(self):
+        self.outputs = {}
+        for name in self.formats:
+            extension = output_formats[name][0]
+            self.outputs[extension] = format_image(name, self.image, self.big_endian)
+
+
+    # Fourth: the source map (.map file) as JSON, lines count from 1:
+    #   format, version   MAP_FORMAT, MAP_VERSION
+    #   listing           name of the listing
+    #   files             names of the source files
+    #   lines             [first line of the listing, index to 'files', first line in that
+    #                     file] of each run of lines taken from one file, the index is -1
+    #                     for lines added by the assembler
+    #   addresses         [first address, number of words, line of the listing] of each
+    #                     instruction, dw_e and res_e, sorted by address
+    # both lists are sorted, so map_lookup finds the source of an address by bisection
+    def make_map(self):
+        # make_outputs made sure that the addresses ascend in the order of 'code'
+        addresses = [[line.addr, line.size, line.lnum] for line in self.code
+                     if line.addr is not None and not line.removed and line.size]
+        self.map = json.dumps({'format': MAP_FORMAT,
+                               'version': MAP_VERSION,
+                               'listing': self.listing_name,
+                               'files': [source.name for source in self.sources],
+                               'lines': [[start + 1, index, fileline + 1]
+                                         for start, index, fileline in self.source_map],
+                               'addresses': addresses},
+                              separators=(',', ':')) + '\n'
+
+
+    # options that change the outputs, part of the key of the build cache
+    def options(self):
+        options = []
+        if self.optimize:
+            options.append('O')
+        if self.relax:
+            options.append('relax')
+        if self.gc:
+            options.append('gc=' + ','.join(self.keep))
+        if self.ecm_words != ECM_WORDS:
+            options.append('ecm=' + str(self.ecm_words))
+        return ' '.join(options)
+
+
+    # run all steps on the 'main' asm file, if 'source' is given
+    # it is used as the contents of that file instead of reading it
+    def run(self, filename, source=None):
+        self.timed('gather', self.gather, filename, source)
+
+        # with unchanged source files the outputs of the last run are still valid
+        if self.cache is not None:
+            key = self.cache.outputs_key(filename, self.sources, self.options())
+            outputs = self.cache.load(key)
+            if outputs is not None:
+                self.listing, self.binary, self.ecmon, image, self.map = outputs
+                self.image = MemoryImage.from_json(image)
+                self.make_formats()
+                return Result(self, cached=True)
+
+        for name, step in self.steps():
+            self.timed(name, step)
+
+        if self.cache is not None:
+            self.cache.store(key, [self.listing, self.binary, self.ecmon, self.image.to_json(), self.map])
+        return Result(self)
+
+
+    # steps 1b to 6 in the order run() executes them after gathering the source
+    # as list of (name, method), also used to time the steps separately
+    def steps(self):
+        steps = [('preprocess', self.preprocess), ('tokenize', self.tokenize), ('assemble', self.assemble)]
+        if self.optimize:
+            steps.append(('peephole', self.peephole))
+        return steps + self.link_steps()
+
+    # the steps after assembling, also run by the linker
+    def link_steps(self):
+        steps = []
+        if self.gc:
+            steps.append(('dead_code', self.dead_code))
+        if self.relax:
+            steps.append(('relax', self.relax_branches))
+        steps += [('link', self.link), ('listing', self.make_listing), ('outputs', self.make_outputs)]
+        return steps
+
+
+    # run one step and record its wall time and the net change of allocated memory
+    # blocks: the blocks the step allocated minus those it freed, not its memory use
+    # (which can be large for a step with a net change of 0), but cheap to get
+    def timed(self, name, step, *args):
+        blocks = sys.getallocatedblocks()
+        start = time.perf_counter()
+        step(*args)
+        self.step_stats[name] = (time.perf_counter() - start, sys.getallocatedblocks() - blocks)
+
+
+    # times of the steps and size of the program as dict (JSON-able):
+    #   steps         name -> {'seconds', 'net_blocks'} in the order the steps ran
+    #   lines         lines of the combined source
+    #   files         source files (or object files when linking)
+    #   labels        labels defined
+    #   instructions  instructions in the outputs
+    #   words         words in the outputs (gaps and res_e not counted)
+    # the counts from steps 2 to 6 are None if the outputs came from the build cache
+    def statistics(self):
+        stats = {'steps': {name: {'seconds': seconds, 'net_blocks': net_blocks}
+                           for name, (seconds, net_blocks) in self.step_stats.items()},
+                 'lines': len(self.full_source),
+                 'files': len(self.list_of_filenames),
+                 'labels': None,
+                 'instructions': None,
+                 'words': None}
+        if self.code:
+            stats['labels'] = len(self.symbols)
+            stats['instructions'] = sum(1 for line in self.code
+                                        if line.cycles is not None and not line.removed)
+            stats['words'] = sum(len(run) for _, run in self.image.segments)
+        return stats
+
+
+    # ---  Object files and linker  ---
+    # ##################################
+
+    # An object file holds the result of steps 1 to 3 of one 'main' asm file as JSON:
+    #   format, version   OBJ_FORMAT, OBJ_VERSION
+    #   filename          name of the 'main' asm file
+    #   source            combined source code, lines of the listing
+    #   symbols           [name, line number, value, kind] of each label defined
+    #   externals         labels used but defined by other objects
+    #   intmem            [first location, number of words, line number] of each res_i
+    #   files             names of the source files
+    #   source_map        [first line in 'source', index to 'files', first line in that
+    #                     file] of each run of lines taken from one file (from 0)
+    #   code              the lines of list 'code' with the encoded words (opcode, arg,
+    #                     words) and the relocation records: the labels still to be
+    #                     linked into the #U8/#S8 part of the opcode (lo_ref), the #U16
+    #                     argument (arg_ref) and the dw_e data (refs)
+    # The EXTMEM sections of an object begin at its org_e directives. Code before the
+    # first org_e is relocatable, the linker places it after the code of the previous
+    # object, just as if the asm file was included there.
+
+    # assemble steps 1 to 3 of a 'main' asm file into an object (dict)
+    def compile(self, filename, source=None):
+        self.relocatable = True
+        self.gather(filename, source)
+        self.preprocess()
+        self.tokenize()
+        self.assemble()
+        if self.optimize:
+            self.peephole()
+
+        blank = CodeLine(0, '', '', [])
+        code = []
+        for line in self.code:
+            # only the attributes that differ from a new CodeLine
+            record = {}
+            for slot in CodeLine.__slots__:
+                value = getattr(line, slot)
+                if value != getattr(blank, slot):
+                    record[slot] = list(value) if slot == 'words' else value
+            code.append(record)
+
+        return {'format': OBJ_FORMAT,
+                'version': OBJ_VERSION,
+                'filename': filename,
+                'source': self.full_source,
+                'symbols': [[s.name, s.line, s.value, s.kind] for s in self.symbols],
+                'externals': sorted(self.externals),
+                'intmem': [list(r) for r in self.intmem_ranges],
+                'files': [source.name for source in self.sources],
+                'source_map': [list(run) for run in self.source_map],
+                'code': code}
+
+
+    # append the source code, labels and code of an object, 'name' is its file name
+    def load_object(self, obj, name):
+        if obj.get('format') != OBJ_FORMAT or obj.get('version') != OBJ_VERSION:
+            self.error('Error: "' + name + '" is not an EC16 object file of version ' + str(OBJ_VERSION))
+        # line numbers of the object continue those of the objects before
+        offset = len(self.full_source)
+        self.list_of_filenames.append(os.path.abspath(name))
+        self.full_source.extend(obj['source'])
+        # the source files of the object, only their names are needed for the source map
+        files = len(self.sources)
+        self.sources.extend(SourceFile(filename, []) for filename in obj['files'])
+        for start, index, fileline in obj['source_map']:
+            self.source_map.append((start + offset, index + files if index >= 0 else -1, fileline))
+
+        for symname, line, value, kind in obj['symbols']:
+            if symname in self.symbols:
+                try:
+                    self.error('Error: redeclaration of label', line + offset)
+                except AsmError as e:
+                    self.collect(e)
+                    continue
+            self.symbols.define(symname, line + offset, kind).value = value
+
+        for record in obj['code']:
+            line = CodeLine(record['lnum'] + offset, record.get('label', ''),
+                            record['mne'], record.get('args', []))
+            for slot, value in record.items():
+                if slot == 'words':
+                    value = array('H', value)
+                elif slot == 'cycles':
+                    value = tuple(value)
+                elif slot == 'refs':
+                    value = [tuple(ref) for ref in value]
+                setattr(line, slot, value)
+            line.lnum += offset
+            self.code.append(line)
+
+        # INTMEM must not be reserved by two objects
+        ranges = [(first, count, lnum + offset) for first, count, lnum in obj['intmem']]
+        for first, count, lnum in ranges:
+            for other, othercount, otherlnum in self.intmem_ranges:
+                if first < other + othercount and other < first + count:
+                    try:
+                        self.error('Error: INTMEM already reserved by the object at line ' + str(otherlnum),
+                                   lnum)
+                    except AsmError as e:
+                        self.collect(e)
+        self.intmem_ranges.extend(ranges)
+
+
+    # link objects and create the outputs, 'objects' is a list of (file name, object)
+    # the outputs are named after 'filename'
+    def run_link(self, objects, filename):
+        self.filename = filename
+        self.listing_name = Path(filename).stem + '.lst'
+        for name, obj in objects:
+            self.timed('load ' + name, self.load_object, obj, name)
+        self.check_errors()
+
+        # place the sections and move all labels to their final addresses
+        self.timed('layout', self.layout)
+        for name, step in self.link_steps():
+            self.timed(name, step)
+        return Result(self)
+
+
+# assemble a 'main' asm file including all its include files and return a Result
+# if 'source' is given it is used as the contents of that file instead of reading it
+# with a BuildCache unchanged files are not tokenized again
+# 'options' are the keyword arguments of Assembler:
+#   relax=True       branches out of reach are replaced by an inverted branch and jmpd
+#   optimize=True    the peephole optimizer removes and shortens instructions
+#   gc=True          code not reachable from the vectors is removed,
+#   keep=[labels]    except the code of these labels
+#   formats=[names]  additional output formats (see output_formats) in Result.outputs,
+#   big_endian=True  with the raw/Intel HEX/S-record words high byte first
+#   ecm_words=N      words per line of the .ecm file
+#   max_errors=N     errors collected before AsmError is raised (0: no limit, default 1)
+# raises AsmError with the errors sorted by source file and line
+def assemble(filename, source=None, cache=None, **options):
+    return Assembler(cache, **options).run(filename, source)
+
+
+# ---  Output formats  ---
+# ########################
+
+# an array('H') of words as bytes, little endian unless 'big_endian'
+def image_bytes(words, big_endian=False):
+    if big_endian != (sys.byteorder == 'big'):
+        words = array('H', words)
+        words.byteswap()
+    return words.tobytes()
+
+
+# $readmemh file: the address of each run of words, then one word per line
+def format_mem(image):
+    lines = []
+    for addr, run in image.segments:
+        lines.append('@{:04x}\n'.format(addr))
+        lines.extend(map('{:04x}\n'.format, run))
+    return ''.join(lines)
+
+
+# one line of an Intel HEX file, the checksum makes the sum of all bytes zero
+def ihex_record(rectype, addr, data):
+    record = bytes((len(data), addr >> 8, addr & 0xFF, rectype)) + data
+    return ':' + (record + bytes(((-sum(record)) & 0xFF,))).hex().upper() + '\n'
+
+
+# Intel HEX file with byte addresses (word address * 2), addresses beyond
+# 64 KByte are reached by extended linear address records
+def format_ihex(image, big_endian=False):
+    lines = []
+    upper = 0
+    for start, run in image.segments:
+        data = image_bytes(run, big_endian)
+        addr = start * 2
+        for offset in range(0, len(data), HEX_RECORD_BYTES):
+            if (addr + offset) >> 16 != upper:
+                upper = (addr + offset) >> 16
+                lines.append(ihex_record(4, 0, upper.to_bytes(2, 'big')))
+            chunk = data[offset:offset + HEX_RECORD_BYTES]
+            # a record must not cross a 64 KByte boundary
+            split = 0x10000 - ((addr + offset) & 0xFFFF)
+            if split < len(chunk):
+                lines.append(ihex_record(0, (addr + offset) & 0xFFFF, chunk[:split]))
+                upper += 1
+                lines.append(ihex_record(4, 0, upper.to_bytes(2, 'big')))
+                lines.append(ihex_record(0, 0, chunk[split:]))
+            else:
+                lines.append(ihex_record(0, (addr + offset) & 0xFFFF, chunk))
+    lines.append(ihex_record(1, 0, b''))
+    return ''.join(lines)
+
+
+# one line of an S-record file, the checksum is the one's complement of the byte sum
+def srec_record(rectype, addr, addr_size, data):
+    record = bytes((addr_size + len(data) + 1,)) + addr.to_bytes(addr_size, 'big') + data
+    return 'S' + rectype + (record + bytes(((~sum(record)) & 0xFF,))).hex().upper() + '\n'
+
+
+# S-record file with byte addresses (word address * 2), S1/S9 records with
+# 16-bit addresses if all data is below 64 KByte, otherwise S2/S8 with 24 bits
+def format_srec(image, big_endian=False):
+    if image.end * 2 <= 0x10000:
+        datatype, endtype, addr_size = '1', '9', 2
     else:
-        # if the file is already included only add a comment
-        linenum += 1
-        full_source[linenum:linenum] = ['; -> ignored since already included\n']
-        linenum += 1
-
-# all source files are now combined in 'full_source', so write it as listing 
-with open(listing_name, 'w', encoding="utf-8") as listing:
-    listing.writelines(full_source)
-
-
-# ---  Step 2 : filter 'full_source' for pure source code and put it into 'code' ---
-#      Create lists with labels, line numbers, and values
-# ##################################################################################
-
-for linenum, asmline in enumerate(full_source):
-    # remove comments
-    asmline = asmline.split(';', 1)[0]
-    # remove leading and trailing white space chars
-    asmline = asmline.strip()
-    # if line is now empty, discard it
-    if (not asmline):
-        continue
-
-    # create list of tokens (labels, mnemonics & arguments)
-    asmlinesplit = [p for p in re.split("(\\s|\\\".*?\\\"|'.*?')", asmline) if p.strip()]
-
-    # for 'dw_e' only the label and dw_e itself must be converted to lowercase
-    # while a possible text argument must not
-    if (len(asmlinesplit) > 2) and (asmlinesplit[0].lower() == 'dw_e'):
-        asmlinesplit[0] = asmlinesplit[0].lower()
-    elif (len(asmlinesplit) > 3) and (asmlinesplit[1].lower() == 'dw_e'):
-        asmlinesplit[0] = asmlinesplit[0].lower()
-        asmlinesplit[1] = asmlinesplit[1].lower()
-   # all other tokens are converted to lowercase
+        datatype, endtype, addr_size = '2', '8', 3
+    lines = [srec_record('0', 0, 2, b'EC16')]
+    for start, run in image.segments:
+        data = image_bytes(run, big_endian)
+        addr = start * 2
+        for offset in range(0, len(data), HEX_RECORD_BYTES):
+            lines.append(srec_record(datatype, addr + offset, addr_size,
+                                     data[offset:offset + HEX_RECORD_BYTES]))
+    lines.append(srec_record(endtype, 0, addr_size, b''))
+    return ''.join(lines)
+
+
+# lines of the .ecm file: each run of contiguous words of the image is split into
+# lines of 'words_per_line' words, written as address '=' words
+def ecmon_lines(image, words_per_line=ECM_WORDS):
+    for addr, run in image.segments:
+        for offset in range(0, len(run), words_per_line):
+            yield ('{:04x}='.format(addr + offset) +
+                   ' '.join(map('{:04x}'.format, run[offset:offset + words_per_line])) + '\n')
+
+
+# seconds needed to send the .ecm file to ECMON over the serial port
+def upload_seconds(ecmon, baud=ECM_BAUD):
+    return len(ecmon) * SERIAL_CHAR_BITS / baud
+
+
+# characters of the ECMON lines for a run of 'count' words: 'aaaa=' per line,
+# each word with its separating space or line end
+def ecmon_chars(count, words_per_line=ECM_WORDS):
+    return 5 * (-(-count // words_per_line) + count)
+
+
+# ---  Differential upload  ---
+# #############################
+
+# MemoryImage of an earlier .ecm file, a .bin file or a raw little/big endian image
+# .bin and raw images have no addresses, they begin at 0 until moved by rebase()
+# raises OSError and ValueError
+def read_image(name, big_endian=False):
+    suffix = Path(name).suffix.lower()
+    image = MemoryImage()
+    if suffix == '.ecm':
+        words = {}
+        with open(name, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip() == '':
+                    continue
+                addr, data = line.split('=')
+                addr = int(addr, 16)
+                for word in data.split():
+                    words[addr & 0xFFFF] = int(word, 16)
+                    addr += 1
+        for addr in sorted(words):
+            image.add(addr, (words[addr],))
+    elif suffix == '.bin':
+        with open(name, 'r', encoding='utf-8') as f:
+            image.add(0, [int(word, 2) for word in f.read().split()])
     else:
-        for num, token in enumerate(asmlinesplit):
-            asmlinesplit[num] = token.lower()
-
-    # add line number for reference and linkage
-    asmlinesplit[0:0]=[linenum+1]
-
-    # if the mnemonic is not preceded by a label...
-    if asmlinesplit[1] in mnemonics_and_directives:
-        # insert an empty string in front of it
-        asmlinesplit[1:1]=['']
-    #else test if label is valid
-    elif (asmlinesplit[1] not in named_args):
-        # label already existing?
-        if asmlinesplit[1] in lbl_name:
-            print('Error: redeclaration of label')
-            print('See "' + listing_name + '" at line '  + str(linenum+1))
-            print(full_source[linenum])
-            sys.exit()            
-        # label must not be the only string in a line
-        if len(asmlinesplit) < 3:
-            print('Error: Orphaned Label. See "' + listing_name + '" at line '  + str(linenum+1))
-            print(full_source[linenum])
-            sys.exit()
-        # Test for valid label then add line number and label to resp. list
-        if is_valid_label(asmlinesplit[1]) :
-            lbl_name.append(asmlinesplit[1])
-        else :
-            print("Error: invalid label. Use only a-z, 0-9 and underscore, don't start with a number")
-            print(full_source[linenum])
-            sys.exit()
-        lbl_line.append(asmlinesplit[0])
-        # add -1 as marker for 'not initialized'
-        lbl_value.append(-1)
-
-    elif asmlinesplit[1] in named_args : 
-        print("Error! Do not use reserved names as a label")
-        print(full_source[linenum])
-        sys.exit()
-
-    if asmlinesplit[2] in mnemonics:
-        while len(asmlinesplit) < 5:
-            asmlinesplit.append('')
-        asmlinesplit.extend([''] + [''] + [''] + [''] + [''])
-    code.append(asmlinesplit)
-
-
-# ---  Step 3 : assemble ---
-# ##########################
-
-for linenum, line in enumerate(code):
-    if line[C_MNE] in mnemonics:
-        add_to_code()
-    elif line[C_MNE] in directives:
-        exec_directive()
-    else:
-        print('Error: Mnemonic or directive expected.')
-        print('See "' + listing_name + '" at line '  + str(line[C_LNUM]))
-        print(full_source[line[C_LNUM] - 1])
-        sys.exit(1)
-
-
-# ---  Step 4 : link ---
-# ######################
-
-# replace all target labels with their value in hex
-for linenum, line in enumerate(code):
-    if line[C_MNE] not in directives :
-        if (line[C_OLT] !='') and (line[C_OPCLO] in lbl_name) :
-            code[linenum][C_OPCLO] = '0x%04X' % (lbl_value[lbl_name.index(line[C_OPCLO])])
-        if line[C_ARG] in lbl_name :
-            code[linenum][C_ARG] = '0x%04X' % (lbl_value[lbl_name.index(line[C_ARG])])
-    elif line[C_MNE] == 'dw_e' :
-        for wordnum, word in enumerate(line[C_ARG2:]) :
-            if word in lbl_name :
-                code[linenum][C_ARG2 + wordnum] = '0x%04X' % (lbl_value[lbl_name.index(word)])
-    elif line[C_MNE] == 'res_e' :
-        if line[C_ARG2] in lbl_name :
-            code[linenum][C_ARG2] = '0x%04X' % (lbl_value[lbl_name.index(line[C_ARG2])])
-
-for linenum, line in enumerate(code):
-    if line[C_MNE] not in directives :
-        if line[C_OLT] == '#U8' :
-            u8temp = getnum(line[C_OPCLO])
-            if u8temp > 255 :
-                print('Error: Argument too big, must be 0 .. 255')
-                print('See "' + listing_name + '" at line '  + str(line[C_LNUM]))
-                print(full_source[line[C_LNUM] - 1])
-                sys.exit(1)
-            code[linenum][C_OPC] = '0x%04X' % (getnum(line[C_OPC]) + getnum(line[C_OPCLO]))
-        if line[C_OLT] == '#S8' :
-            targetaddr = getnum(line[C_OPCLO])
-            curraddr = getnum(line[C_ADDR])
-            offset = targetaddr - curraddr - 1
-            if (offset > 128) or (offset < -127) :
-                print('Error: Destination out of reach (-127 .. +128)')
-                print('See "' + listing_name + '" at line '  + str(line[C_LNUM]))
-                print(full_source[line[C_LNUM] - 1])
-                sys.exit(1)
-            if offset < 0 :
-                offset = 256 + offset
-            code[linenum][C_OPC] = '0x%04X' % (getnum(line[C_OPC]) + offset)
-
-
-# ---  Step 5 : create final listing  ---
-# #######################################
-
-# add the hex listing to 'full_source' and overwrite listing file 
-codelinenum = 0
-
-for linenum, line in enumerate(full_source) :
-    if code[codelinenum][C_LNUM] == linenum + 1:
-        if code[codelinenum][C_MNE] not in directives : 
-            temp = code[codelinenum][C_ADDR] + '  '
-            temp = temp + code[codelinenum][C_OPC] + '  '
-            if code[codelinenum][C_ARG] == '' :
-                temp = temp + '        '
-            else :
-                temp = temp + code[codelinenum][C_ARG] + '  '
-            full_source[linenum] = temp + full_source[linenum]
-        elif code[codelinenum][C_MNE] == 'dw_e' :
-            temp = '  '.join(code[codelinenum][C_ARG1:])
-            full_source[linenum] = temp + ' | ' + full_source[linenum]
+        with open(name, 'rb') as f:
+            data = f.read()
+        if len(data) % 2:
+            raise ValueError('odd number of bytes')
+        run = array('H', data)
+        if big_endian != (sys.byteorder == 'big'):
+            run.byteswap()
+        image.add(0, run)
+    return image
+
+
+# MemoryImage of the words of 'image' that differ from 'previous' (or were not
+# loaded by it); unchanged words between two changed runs of the same run of
+# 'image' are sent again if that makes the .ecm file shorter (or not longer)
+def diff_image(image, previous, words_per_line=ECM_WORDS):
+    old = {}
+    for addr, run in previous.segments:
+        for offset, word in enumerate(run):
+            old[addr + offset] = word
+
+    diff = MemoryImage()
+    for addr, run in image.segments:
+        # runs of changed words as [first, end] offsets into 'run'
+        changed = []
+        for offset, word in enumerate(run):
+            if old.get(addr + offset) != word:
+                if changed and changed[-1][1] == offset:
+                    changed[-1][1] += 1
+                else:
+                    changed.append([offset, offset + 1])
+        merged = []
+        for first, end in changed:
+            if merged:
+                last = merged[-1]
+                separate = (ecmon_chars(last[1] - last[0], words_per_line) +
+                            ecmon_chars(end - first, words_per_line))
+                if ecmon_chars(end - last[0], words_per_line) <= separate:
+                    last[1] = end
+                    continue
+            merged.append([first, end])
+        for first, end in merged:
+            diff.add(addr + first, run[first:end])
+    return diff
+
+
+# contents of an output file of format 'name' (see output_formats) made from
+# a MemoryImage, str or bytes, only the raw image includes the gaps
+def format_image(name, image, big_endian=False):
+    if name == 'raw':
+        return image_bytes(image.dense(), big_endian)
+    if name == 'mem':
+        return format_mem(image)
+    if name == 'ihex':
+        return format_ihex(image, big_endian)
+    return format_srec(image, big_endian)
+
+
+# write the text (or bytes) of one output file
+def write_output(name, text):
+    if isinstance(text, bytes):
+        with open(name, 'wb') as f:
+            f.write(text)
+        return
+    with open(name, 'w', encoding="utf-8") as f:
+        f.write(text)
+
+
+# write the additional output formats of a Result, named after 'filename'
+def write_formats(filename, result):
+    stem = Path(filename).stem
+    for extension, contents in result.outputs.items():
+        write_output(stem + extension, contents)
+
+
+# names of the output files, e.g. mainfile.asm -> mainfile.lst, mainfile.bin, mainfile.ecm
+def output_names(filename):
+    stem = Path(filename).stem
+    return stem + '.lst', stem + '.bin', stem + '.ecm'
+
+
+# assemble a 'main' asm file and write the output files into the current directory
+# if assembling fails the combined source code is written as listing to look up
+# the line numbers of the error messages, then AsmError is raised again
+def build(filename, cache=None, assembler=None):
+    listing_name, binlisting_name, ecmlisting_name = output_names(filename)
+    if assembler is None:
+        assembler = Assembler(cache)
+    try:
+        result = assembler.run(filename)
+    except AsmError as e:
+        if e.listing is not None:
+            write_output(listing_name, e.listing)
+        raise
+    write_output(listing_name, result.listing)
+    write_output(binlisting_name, result.binary)
+    write_output(ecmlisting_name, result.ecmon)
+    write_output(map_name(filename), result.map)
+    write_formats(filename, result)
+    return result
+
+
+# assemble a 'main' asm file including all its include files into an object (dict)
+# labels that are not defined are left to the linker, raises AsmError
+# 'options' are the keyword arguments of Assembler, e.g. optimize and max_errors
+def compile_object(filename, source=None, **options):
+    return Assembler(**options).compile(filename, source)
+
+
+# name of the object file, e.g. mainfile.asm -> mainfile.obj
+def object_name(filename):
+    return Path(filename).stem + '.obj'
+
+
+# name of the source map, e.g. mainfile.asm -> mainfile.map
+def map_name(filename):
+    return Path(filename).stem + '.map'
+
+
+# read a source map (see Assembler.make_map), raises OSError and ValueError
+def read_map(name):
+    with open(name, 'r', encoding="utf-8") as f:
+        srcmap = json.load(f)
+    if not isinstance(srcmap, dict) or srcmap.get('format') != MAP_FORMAT or srcmap.get('version') != MAP_VERSION:
+        raise ValueError('"' + name + '" is not an EC16 source map of version ' + str(MAP_VERSION))
+    return srcmap
+
+
+# source of EXTMEM address 'addr' by a source map (dict): (file name, line number)
+# or None if no instruction or data of a source file is there
+def map_lookup(srcmap, addr):
+    # the last entry beginning at or before 'addr', lists compare element by element
+    addresses = srcmap['addresses']
+    num = bisect.bisect_right(addresses, [addr, math.inf]) - 1
+    if num < 0 or addr >= addresses[num][0] + addresses[num][1]:
+        return None
+    lnum = addresses[num][2]
+    lines = srcmap['lines']
+    num = bisect.bisect_right(lines, [lnum, math.inf]) - 1
+    if num < 0 or lines[num][1] < 0:
+        return None
+    start, index, fileline = lines[num]
+    return srcmap['files'][index], fileline + lnum - start
+
+
+def write_object(name, obj):
+    with open(name, 'w', encoding="utf-8") as f:
+        json.dump(obj, f, separators=(',', ':'))
+
+
+# read an object file, an asm file is assembled into an object instead
+def read_object(name, optimize=False, max_errors=1):
+    if Path(name).suffix.lower() == '.asm':
+        return compile_object(name, optimize=optimize, max_errors=max_errors)
+    try:
+        with open(name, 'r', encoding="utf-8") as f:
+            return json.load(f)
+    except OSError:
+        raise AsmError([Diagnostic('Error opening object file! File "' + name + '" not found.')]) from None
+    except ValueError:
+        raise AsmError([Diagnostic('Error: "' + name + '" is not an EC16 object file')]) from None
+
+
+# link objects, given as a list of (file name, object), and return a Result
+# the outputs are named after 'filename', 'options' as for assemble(), raises AsmError
+def link_objects(objects, filename, **options):
+    return Assembler(**options).run_link(objects, filename)
+
+
+# link object files (or asm files) in the given order and write the output files,
+# named after 'output' or the first file, into the current directory
+def build_linked(filenames, output=None, options=None):
+    options = options or {}
+    if output is None:
+        output = filenames[0]
+    listing_name, binlisting_name, ecmlisting_name = output_names(output)
+    objects = [(name, read_object(name, options.get('optimize', False), options.get('max_errors', 1)))
+               for name in filenames]
+    try:
+        result = link_objects(objects, output, **options)
+    except AsmError as e:
+        if e.listing is not None:
+            write_output(listing_name, e.listing)
+        raise
+    write_output(listing_name, result.listing)
+    write_output(binlisting_name, result.binary)
+    write_output(ecmlisting_name, result.ecmon)
+    write_output(map_name(output), result.map)
+    write_formats(output, result)
+    return result
+
+
+# ---  Batch mode : assemble many 'main' asm files in parallel  ---
+# #################################################################
+
+# build one 'main' asm file given with its absolute path, the include files are
+# searched and the output files are written in the directory of that file,
+# just as if the assembler was started there
+# returns (True, '') or (False, error messages)
+# 'options' is a dict with the keyword arguments of Assembler
+def batch_build(path, cache_dir=None, options=None):
+    if not os.path.isfile(path):
+        return False, 'Error opening first asm file! File "' + path + '" not found.'
+    cwd = os.getcwd()
+    os.chdir(os.path.dirname(path))
+    try:
+        cache = None
+        if cache_dir is not None:
+            cache = BuildCache(cache_dir)
+        build(os.path.basename(path), assembler=Assembler(cache, **(options or {})))
+    except AsmError as e:
+        return False, str(e)
+    except OSError as e:
+        return False, 'Error: ' + str(e)
+    finally:
+        os.chdir(cwd)
+    return True, ''
+
+
+# expand wildcards in the file arguments, keep their order and drop duplicates
+def batch_files(patterns):
+    paths = []
+    for pattern in patterns:
+        if any(c in pattern for c in '*?['):
+            matches = sorted(glob.glob(pattern))
         else:
-            full_source[linenum] = '                        ' + full_source[linenum]
-        codelinenum += 1
-        if codelinenum == len(code):
-            break
+            matches = [pattern]
+        for path in matches:
+            path = os.path.abspath(path)
+            if path not in paths:
+                paths.append(path)
+    return paths
+
+
+# assemble all files in a pool of processes and print a summary in the order
+# of the command line, returns 0 if all files were assembled without errors
+def batch(patterns, jobs=None, cache_dir=None, options=None):
+    paths = batch_files(patterns)
+    if cache_dir is not None:
+        cache_dir = os.path.abspath(cache_dir)
+    cache_dirs = [cache_dir] * len(paths)
+    options_list = [options] * len(paths)
+    if jobs == 1 or len(paths) < 2:
+        results = [batch_build(path, cache_dir, options) for path in paths]
     else:
-        full_source[linenum] = '                        ' + full_source[linenum]
-
-# append list of label/value pairs
-
-labellisting = []
-
-for x in range(len(lbl_line)):
-    labellisting.append("Line " + str(lbl_line[x]) + "  ")
-    labellisting.append(lbl_name[x] + ' ' + str(lbl_value[x]))
-    labellisting.append(' | ' + str('0x%04X' % lbl_value[x]) + '\n')
-with open(listing_name, 'w', encoding="utf-8") as listing:
-    listing.writelines(full_source)
-    listing.writelines('\n\nList of labels\n\n')
-    listing.writelines(labellisting)
-
-
-# ---  Step 6 : Generate output listings  ---
-# #######################################m###
-
-binlisting = []  # main.bin  Binary listing as init file for FPGA
-ecmonlisting = []  # main.ecm  Hex listing in ecmon notation
-load_addr : int = 0
-memcount : int = 0
-code_addr : int = 0
-hexline = ''
-
-
-# First: generate the .bin file that can be used for the initialization
-# of a block ram via the FPGA configuration file. (Pseudo ROM)
-#
-# The files size must exactly match the BRAM size, so if there are gaps
-# from skipping memory areas by using org_e or res_e directives these gaps
-# are filled with zeros and included in the file
-# The file length must be adjusted in the asm file via directives
-
-# Although the resulting .bin file does not include any information where it is
-# stored in the address space, we must keep track of the address information
-# during the generation of the file to detect and handle gaps.  
-# 
-
-# Get the starting address by scanning for the first instruction/dw_e/res_e
-for line in code:
-    if (line[C_MNE] in mnemonics):
-        memcount = getnum(line[C_ADDR])
-        break
-    elif (line[C_MNE] == 'dw_e'):
-        memcount = getnum(line[C_ARG1])
-        break
-    elif (line[C_MNE] == 'res_e'):
-        memcount = getnum(line[C_ARG1])
-        break
-
-# Now filter list 'code' for all instruction/dw_e/res_e entries
-# since only these three types contribute to the data output
-for line in code :
-
-    if line[C_MNE] in mnemonics :
-        code_addr = getnum(line[C_ADDR])
-        while code_addr > memcount :
-            binlisting.append('0000000000000000\n')
-            memcount += 1
-        hexline = line[C_OPC][2:]
-        binlisting.append("{0:016b}".format(int(hexline, 16)) + '\n')
-        memcount += 1
-        if line[C_ARG] != '':
-            hexline = line[C_ARG][2:]
-            binlisting.append("{0:016b}".format(int(hexline, 16)) + '\n')
-            memcount += 1
-        continue
-    elif line[C_MNE] == 'dw_e' :
-        code_addr = getnum(line[C_ARG1])
-        while code_addr > memcount :
-            binlisting.append('0000000000000000\n')
-            memcount += 1
-        for hexline in line[C_ARG2:] :
-            hexline = hexline[2:]
-            binlisting.append("{0:016b}".format(int(hexline, 16)) + '\n')
-            memcount += 1
-        continue
-    elif line[C_MNE] == 'res_e' :
-        code_addr = getnum(line[C_ARG2])
-        while code_addr > memcount :
-            binlisting.append('0000000000000000\n')
-            memcount += 1
-        continue
-    
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(batch_build, paths, cache_dirs, options_list))
 
-# Second: generate a text file in the ECMON format
-# i.e. Target address, '=', up to 8 words separated by space
-# e.g. 8000=a100 807f a100 80d4 a100 80df a100 881b
-# Empty sections (org_e/res_e) are not included
-
-# Get the starting address again but this time ignore res_e
-for line in code:
-    if (line[C_MNE] in mnemonics):
-        adjacentaddr = getnum(line[C_ADDR])
-        break
-    elif (line[C_MNE] == 'dw_e'):
-        adjacentaddr = getnum(line[C_ARG1])
-        break
-
-# Now filter list 'code' for all instruction/dw_e entries
-# since only these two types contribute to the data output
-
-# Beginning from the start address gather up all contiguous code
-# until the end of the list is reached or until a gap is found.
-# Write this block to the file. If the end of code is not reached
-# repeat the process.
-
-block : list = []
-block.append(adjacentaddr)
-
-blocklist : list = [] 
-
-for i in range(len(code)) :
-
-    if (code[i][C_MNE] in mnemonics) :
-        curraddr = getnum(code[i][C_ADDR])
-        curropc =  code[i][C_OPC]
-        currarg = [code[i][C_ARG]]
-    elif (code[i][C_MNE] == 'dw_e') :
-        curraddr = getnum(code[i][C_ARG1])
-        curropc = ""
-        currarg = code[i][C_ARG2:]
-    else :
-        continue   
-
-    if curraddr != adjacentaddr :
-        blocklist.append(block)
-        block = [curraddr]
-        adjacentaddr = curraddr
-    oldblocklength = len(block)
-    if curropc != "" :
-        block.append(curropc)
-    if currarg != [''] :
-        block.extend(currarg)
-    adjacentaddr += len(block) - oldblocklength
-
-blocklist.append(block)
-
-for block in blocklist :
-    ecm_full_lines = int((len(block)-1) / 8)
-    ecm_last_line =  int((len(block)-1) % 8)
-    load_addr = block[0]
-    offset : int = 1
-    
-    while ecm_full_lines > 0 :
-        ecmonlisting.append('{:04x}'.format(load_addr))
-        ecmonlisting.append('=')
-        ecm_words=0
-        while ecm_words < 7:
-            ecmonlisting.append(block[offset + ecm_words][2:].lower())
-            ecmonlisting.append(' ')
-            ecm_words += 1
-        ecmonlisting.append(block[offset + ecm_words][2:].lower())
-        ecmonlisting.append('\n')
-        offset += 8
-        load_addr += 8
-        ecm_full_lines -= 1
-
-    if ecm_last_line > 0 :
-        ecmonlisting.append('{:04x}'.format(load_addr))
-        ecmonlisting.append('=')
-        ecm_words=0
-        while ecm_words < ecm_last_line - 1:
-            ecmonlisting.append(block[offset + ecm_words][2:].lower())
-            ecmonlisting.append(' ')
-            ecm_words += 1
-        ecmonlisting.append(block[offset + ecm_words][2:].lower())
-        ecmonlisting.append('\n')
-        
+    failed = 0
+    for path, (ok, messages) in zip(paths, results):
+        if ok:
+            print(' OK      ', os.path.relpath(path))
+        else:
+            failed += 1
+            print(' FAILED  ', os.path.relpath(path))
+            for message in messages.split('\n'):
+                print('          ' + message)
 
-filename = sys.argv[1]
-binlisting_name = Path(filename).stem + '.bin'
-ecmlisting_name = Path(filename).stem + '.ecm'
+    print('\n' + str(len(paths) - failed) + ' of ' + str(len(paths)) + ' files assembled without errors')
+    if failed:
+        return 1
+    return 0
 
-with open(binlisting_name, 'w', encoding="utf-8") as listing:
-    listing.writelines(binlisting)
 
-with open(ecmlisting_name, 'w', encoding="utf-8") as listing:
-    listing.writelines(ecmonlisting)
+# ---  Watch mode : assemble again whenever a source file changes  ---
+# ####################################################################
 
-print('\n S U C C E S S \n')
-print('Assembly complete without errors')
-print('Generated the following files :')
-print(' -  ', listing_name, '  (full listing)')
-print(' -  ', binlisting_name, '  (bin data for FPGA memory)')
-print(' -  ', ecmlisting_name, '  (hex data for upload with ECMON via terminal)')
+# the cache keeps the source files and their tokens in memory between the runs,
+# so only changed files are read and tokenized again
+def watch(filename, cache_dir=None, options=None, interval=0.2):
+    cache = BuildCache(cache_dir)
+    print('Watching "' + filename + '" and its include files, stop with Ctrl+C\n')
+    try:
+        while True:
+            # assemble and report only the result and the error messages
+            assembler = Assembler(cache, **(options or {}))
+            start = time.perf_counter()
+            try:
+                build(filename, assembler=assembler)
+            except AsmError as e:
+                print(time.strftime('%H:%M:%S') + '  FAILED')
+                print_errors(e)
+            else:
+                print(time.strftime('%H:%M:%S') + '  OK  ' +
+                      '%.1f ms' % ((time.perf_counter() - start) * 1000))
+
+            # wait until the 'main' file or one of the include files changes
+            files = list(assembler.list_of_filenames)
+            stamps = [file_stamp(path) for path in files]
+            while [file_stamp(path) for path in files] == stamps:
+                time.sleep(interval)
+    except KeyboardInterrupt:
+        print()
+    return 0
+
+
+# ---  Command line tool  ---
+# ###########################
+
+# list the files of the additional output formats after a successful build
+def print_formats(filename, formats):
+    stem = Path(filename).stem
+    for name in formats:
+        extension, description = output_formats[name]
+        print(' -  ', stem + extension, '  (' + description + ')')
+
+
+# write the differential .ecm file of 'result' against the image 'previous' and
+# report the serial traffic saved compared to the full .ecm file
+def print_diff(filename, result, previous, previous_name, args):
+    diff_name = Path(filename).stem + '_diff.ecm'
+    if Path(previous_name).suffix.lower() != '.ecm':
+        previous.rebase(result.image.start)
+    diff = ''.join(ecmon_lines(diff_image(result.image, previous, args.ecm_words), args.ecm_words))
+    write_output(diff_name, diff)
+    print('\nDifferential upload against', previous_name, ':')
+    print(' -  ', diff_name, '  (changed words only for upload with ECMON)')
+    print(' -   saved', len(result.ecmon) - len(diff), 'of', len(result.ecmon), 'bytes, about',
+          '{:.2f} s instead of {:.2f} s at {} baud'.format(upload_seconds(diff, args.baud),
+                                                          upload_seconds(result.ecmon, args.baud), args.baud))
+
+
+# call function(*args, **kwargs), with cProfile if 'profile' names the file of the profile
+def profiled(profile, function, *args, **kwargs):
+    if profile is None:
+        return function(*args, **kwargs)
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args, **kwargs)
+    finally:
+        profiler.dump_stats(profile)
+        print('Profile written to', profile, '(python -m pstats ' + profile + ')')
+
+
+# errors of an AsmError, with their number if there are more than one
+def print_errors(e):
+    for diagnostic in e.diagnostics:
+        print(diagnostic)
+        print()
+    count = sum(diagnostic.lnum is not None for diagnostic in e.diagnostics)
+    if count > 1:
+        print(count, 'errors')
+
+
+# statistics of a build (Result.stats)
+def print_stats(stats):
+    print('\nStatistics :')
+    print(' -   {:<16} {:>9} {:>11}'.format('step', 'time/ms', 'net blocks'))
+    total = 0.0
+    for name, step in stats['steps'].items():
+        total += step['seconds']
+        print(' -   {:<16} {:>9.2f} {:>+11d}'.format(name, step['seconds'] * 1000, step['net_blocks']))
+    print(' -   {:<16} {:>9.2f}'.format('total', total * 1000))
+    for count in ('lines', 'files', 'labels', 'instructions', 'words'):
+        if stats[count] is not None:
+            print(' -   {:<16} {:>9d}'.format(count, stats[count]))
+
+
+# estimated time to upload the .ecm file to ECMON
+def print_upload(ecmlisting_name, ecmon, baud):
+    print('\nUpload of', ecmlisting_name, ':', len(ecmon), 'characters, about',
+          '{:.2f} s at {} baud'.format(upload_seconds(ecmon, baud), baud))
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(prog='ec16asm.py',
+                                     description='Assembler for the EC16 microprocessor')
+    parser.add_argument('mainfile', nargs='?', help='asm file to assemble')
+    parser.add_argument('--batch', nargs='+', metavar='ASMFILE',
+                        help='assemble several asm files (wildcards allowed) in parallel, '
+                             'the output files are written next to each of them')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of processes used by --batch (default: number of CPUs)')
+    parser.add_argument('--cache', action='store_true',
+                        help='keep tokenized source files and outputs in a build cache')
+    parser.add_argument('--cache-dir', default='.ec16cache', metavar='DIR',
+                        help='directory of the build cache (default: .ec16cache)')
+    parser.add_argument('--watch', action='store_true',
+                        help='assemble again whenever the asm file or one of its include files changes')
+    parser.add_argument('--relax', action='store_true',
+                        help='replace branches out of reach by an inverted branch and jmpd')
+    parser.add_argument('-O', dest='optimize', action='store_true',
+                        help='run the peephole optimizer (code must not jump to numeric addresses)')
+    parser.add_argument('--gc', action='store_true',
+                        help='remove code not reachable from the reset and interrupt vectors')
+    parser.add_argument('--keep', action='append', default=[], metavar='LABEL[,LABEL]',
+                        help='labels whose code --gc must keep (can be repeated)')
+    parser.add_argument('--format', action='append', default=[], metavar='FORMAT[,FORMAT]',
+                        help='write additional outputs: ' +
+                             ', '.join(name + ' (' + extension + ', ' + description + ')'
+                                       for name, (extension, description) in output_formats.items()))
+    parser.add_argument('--big-endian', action='store_true',
+                        help='high byte first in the raw, Intel HEX and S-record outputs')
+    parser.add_argument('--ecm-words', type=int, default=ECM_WORDS, metavar='N',
+                        help='words per line of the .ecm file (default: ' + str(ECM_WORDS) + ')')
+    parser.add_argument('--baud', type=int, default=ECM_BAUD, metavar='RATE',
+                        help='baud rate for the estimated upload time of the .ecm file '
+                             '(default: ' + str(ECM_BAUD) + ')')
+    parser.add_argument('--diff-against', default=None, metavar='FILE',
+                        help='also write NAME_diff.ecm with only the words changed since FILE '
+                             '(.ecm, .bin or raw image of the previous upload)')
+    parser.add_argument('--max-errors', type=int, default=MAX_ERRORS, metavar='N',
+                        help='report up to N errors before giving up, 0 for no limit '
+                             '(default: ' + str(MAX_ERRORS) + ')')
+    parser.add_argument('--stats', action='store_true',
+                        help='print the time and the net change of allocated memory blocks of each step '
+                             'and the size of the program')
+    parser.add_argument('--profile', default=None, metavar='FILE',
+                        help='run the build with cProfile and write the profile to FILE (see pstats)')
+    parser.add_argument('-c', dest='compile', action='store_true',
+                        help='assemble into an object file (.obj) for the linker')
+    parser.add_argument('--link', nargs='+', metavar='OBJFILE',
+                        help='link object files (or asm files) in this order, '
+                             'code without org_e follows the code of the previous file')
+    parser.add_argument('-o', dest='output', default=None, metavar='NAME',
+                        help='name of the outputs of --link (default: first file)')
+    args = parser.parse_args(argv)
+
+    cache_dir = None
+    if args.cache:
+        cache_dir = args.cache_dir
+
+    # keyword arguments of Assembler
+    keep = [name.strip().lower() for names in args.keep for name in names.split(',') if name.strip()]
+    formats = [name.strip().lower() for names in args.format for name in names.split(',') if name.strip()]
+    for name in formats:
+        if name not in output_formats:
+            parser.error('unknown output format "' + name + '", choose from ' + ', '.join(output_formats))
+    if args.jobs is not None and args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    if args.ecm_words < 1:
+        parser.error('--ecm-words must be at least 1')
+    if args.baud < 1:
+        parser.error('--baud must be at least 1')
+    if args.max_errors < 0:
+        parser.error('--max-errors must not be negative')
+    options = {'relax': args.relax, 'optimize': args.optimize, 'gc': args.gc, 'keep': keep,
+               'formats': formats, 'big_endian': args.big_endian, 'ecm_words': args.ecm_words,
+               'max_errors': args.max_errors}
+
+    # Say Hello
+    print('\nEC16ASM  ' + VERSION + ' -  Assembler for the EC16 microprocessor\n')
+
+    # read the previous image before the build may overwrite it
+    previous = None
+    if args.diff_against is not None:
+        try:
+            previous = read_image(args.diff_against, args.big_endian)
+        except OSError:
+            print('Error opening previous image! File "' + args.diff_against + '" not found.')
+            return 1
+        except ValueError:
+            print('Error: "' + args.diff_against + '" is not an .ecm, .bin or raw image')
+            return 1
+
+    if args.batch is not None:
+        if args.mainfile is not None:
+            args.batch.insert(0, args.mainfile)
+        return batch(args.batch, args.jobs, cache_dir, options)
+
+    if args.link is not None:
+        if args.mainfile is not None:
+            args.link.insert(0, args.mainfile)
+        try:
+            result = profiled(args.profile, build_linked, args.link, args.output, options)
+        except AsmError as e:
+            print_errors(e)
+            return 1
+        listing_name, binlisting_name, ecmlisting_name = output_names(args.output or args.link[0])
+        print('\n S U C C E S S \n')
+        print('Linking complete without errors')
+        print('Generated the following files :')
+        print(' -  ', listing_name, '  (full listing)')
+        print(' -  ', binlisting_name, '  (bin data for FPGA memory)')
+        print(' -  ', ecmlisting_name, '  (hex data for upload with ECMON via terminal)')
+        print(' -  ', map_name(args.output or args.link[0]), '  (source map of the EXTMEM addresses)')
+        print_formats(args.output or args.link[0], formats)
+        print_upload(ecmlisting_name, result.ecmon, args.baud)
+        if previous is not None:
+            print_diff(args.output or args.link[0], result, previous, args.diff_against, args)
+        if args.gc:
+            print('\nDead code elimination :')
+            print(' -  ', 'Total reclaimed', sum(block[2] for block in result.gc_blocks), 'words')
+        if args.stats:
+            print_stats(result.stats)
+        return 0
+
+    # the 'main' ASM file mentioned in the command line
+    if args.mainfile is None:
+        print('Error in command line! Usage: ec16asm.py "mainfile.asm"')
+        return 1
+    filename = args.mainfile
+
+    if args.watch:
+        return watch(filename, cache_dir, options)
+
+    if args.compile:
+        try:
+            obj = compile_object(filename, optimize=args.optimize, max_errors=args.max_errors)
+        except AsmError as e:
+            if e.listing is not None:
+                write_output(Path(filename).stem + '.lst', e.listing)
+            print_errors(e)
+            return 1
+        write_object(object_name(filename), obj)
+        print('\n S U C C E S S \n')
+        print('Assembly complete without errors')
+        print('Generated the following file :')
+        print(' -  ', object_name(filename), '  (object file for the linker)')
+        return 0
+
+    cache = None
+    if cache_dir is not None:
+        cache = BuildCache(cache_dir)
+
+    assembler = Assembler(cache, **options)
+    try:
+        result = profiled(args.profile, build, filename, assembler=assembler)
+    except AsmError as e:
+        print_errors(e)
+        return 1
+
+    listing_name, binlisting_name, ecmlisting_name = output_names(filename)
+    print('\n S U C C E S S \n')
+    print('Assembly complete without errors')
+    print('Generated the following files :')
+    print(' -  ', listing_name, '  (full listing)')
+    print(' -  ', binlisting_name, '  (bin data for FPGA memory)')
+    print(' -  ', ecmlisting_name, '  (hex data for upload with ECMON via terminal)')
+    print(' -  ', map_name(filename), '  (source map of the EXTMEM addresses)')
+    print_formats(filename, formats)
+    print_upload(ecmlisting_name, result.ecmon, args.baud)
+    if previous is not None:
+        print_diff(filename, result, previous, args.diff_against, args)
+    if args.optimize and not result.cached:
+        print('\nPeephole optimizer :')
+        for line in assembler.peephole_report():
+            print(' -  ', line)
+    if args.gc and not result.cached:
+        print('\nDead code elimination :')
+        print(' -  ', assembler.dead_code_report()[-1])
+    if args.stats:
+        print_stats(result.stats)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
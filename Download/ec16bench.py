@@ -0,0 +1,323 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import tracemalloc
+
+from ec16asm import instructions, I_MNE, I_ARG1, I_ARG2, AsmError, Assembler, VERSION as ASM_VERSION
+
+
+# Benchmark for the EC16 assembler
+#
+# A synthetic program is generated from the table 'instructions' of ec16asm.py:
+# a given number of instructions and labels, spread over a chain of nested include
+# files, with dw_e string tables and org_e gaps far ahead. It is assembled several
+# times, each step of the assembler is timed separately and the best time of all
+# runs is kept. The steps are run and timed by Assembler.run(), so the times and
+# net blocks are those of --stats of ec16asm.py. A separate run with tracemalloc
+# records the peak memory of each step (tracemalloc slows everything down, so it
+# is not used for the times).
+# The results are appended to a JSON file, each run is compared with the last one
+# of the same program found there.
+
+
+# version shown in the greeting of the command line tool
+VERSION = 'V1.0.0 18-Oct-2026'
+
+# default JSON file of the results
+RESULTS_FILE = 'ec16bench.json'
+
+# INTMEM variables of the generated program, operands of #U8
+BENCH_VARS = 16
+
+# the largest distance of a branch to the label before it, keeps all branches in reach
+BRANCH_REACH = 120
+
+# characters of the dw_e strings
+STRING_CHARS = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 .,:!?-+*/()'
+
+
+# ---  Synthetic source code  ---
+# ###############################
+
+# operand of an instruction for the column 'kind' of table 'instructions'
+def operand(kind, rnd, labels, branch_label):
+    if kind == '#U8':
+        if rnd.random() < 0.7:
+            return 'v_' + str(rnd.randrange(BENCH_VARS))
+        return '0x{:02X}'.format(rnd.randrange(256))
+    if kind == '#U16':
+        if rnd.random() < 0.8:
+            return rnd.choice(labels)
+        return '0x{:04X}'.format(rnd.randrange(65536))
+    if kind == '#S8':
+        return branch_label
+    # register names: a, c, ie, int, status, flags, imask, sp
+    return kind
+
+
+# write the files of a synthetic program into 'directory' and return the name of
+# the 'main' asm file (relative to 'directory')
+#   count      number of instructions
+#   labels     number of code labels (more are added where branches need them)
+#   depth      number of nested include files, each with its share of the code
+#   strings    number of dw_e string tables
+#   gaps       number of org_e that skip EXTMEM
+# raises ValueError if the program does not fit into EXTMEM
+def generate(directory, count=20000, labels=2000, depth=4, strings=200, gaps=4, seed=1):
+    rnd = random.Random(seed)
+    labels = max(1, min(labels, count))
+    names = ['l_' + str(num) for num in range(labels)]
+
+    # the words of the program without gaps decide how far each gap can skip
+    sizes = [2 if '#U16' in entry[I_ARG1:I_ARG2 + 1] else 1 for entry in instructions]
+    words = count * sum(sizes) // len(sizes) + count // 8 + strings * 64
+    gap_words = max(0, (65536 - 2 * words) // (gaps + 1)) if gaps else 0
+
+    files = [[] for _ in range(depth + 1)]
+    per_file = -(-count // (depth + 1))
+    label_every = max(1, count // labels)
+    gap_every = count // (gaps + 1) if gaps else 0
+    strings_every = max(1, count // strings) if strings else 0
+
+    addr = 0
+    last_label = 0			# address of the label before the current line
+    last_label_name = ''
+    extra = 0			# labels added for branches
+    num_label = 0
+    num_gap = 0
+    num_string = 0
+    lines = files[0]
+    lines.append('; synthetic benchmark program for ec16asm.py, seed ' + str(seed) + '\n')
+    lines.append('        org_i   0x10\n')
+    for num in range(BENCH_VARS):
+        lines.append('v_' + str(num) + '     res_i   1\n')
+    lines.append('        org_e   0x0000\n')
+
+    for num in range(count):
+        lines = files[num // per_file]
+
+        if gap_every and num and num % gap_every == 0 and num_gap < gaps:
+            num_gap += 1
+            addr += gap_words
+            lines.append('        org_e   0x{:04X}\n'.format(addr))
+        if strings_every and num and num % strings_every == 0 and num_string < strings:
+            text = ''.join(rnd.choice(STRING_CHARS) for _ in range(rnd.randrange(32, 65)))
+            lines.append('s_' + str(num_string) + '     dw_e    "' + text + '"\n')
+            num_string += 1
+            addr += len(text)
+
+        entry = rnd.choice(instructions)
+        label = ''
+        if num % label_every == 0 and num_label < labels:
+            label = names[num_label]
+            num_label += 1
+        elif entry[I_ARG1] == '#S8' and addr - last_label > BRANCH_REACH:
+            label = 'r_' + str(extra)
+            extra += 1
+        if label != '':
+            last_label = addr
+            last_label_name = label
+        branch_label = last_label_name if entry[I_ARG1] == '#S8' else ''
+
+        args = [operand(kind, rnd, names, branch_label) for kind in entry[I_ARG1:I_ARG2 + 1] if kind != '']
+        line = '{:<8}{:<8}{}'.format(label, entry[I_MNE], '   '.join(args)).rstrip()
+        if num % 7 == 0:
+            line += '   ; step ' + str(num)
+        lines.append(line + '\n')
+        addr += 2 if '#U16' in entry[I_ARG1:I_ARG2 + 1] else 1
+
+    if addr > 65536:
+        raise ValueError('the program needs ' + str(addr) + ' words, more than EXTMEM')
+
+    # chain of include files: main.asm -> inc1.asm -> inc2.asm ...
+    filenames = ['main.asm'] + ['inc' + str(num) + '.asm' for num in range(1, depth + 1)]
+    for num, name in enumerate(filenames):
+        with open(os.path.join(directory, name), 'w', encoding='utf-8') as f:
+            f.writelines(files[num])
+            if num < depth:
+                f.write('        include "' + filenames[num + 1] + '"\n')
+    return filenames[0]
+
+
+# ---  Measurement  ---
+# #####################
+
+# assemble 'filename' once, return the Assembler and the statistics of each step
+# (name -> {'seconds', 'net_blocks'}, see Assembler.statistics)
+def timed_run(filename, options):
+    asm = Assembler(**options)
+    asm.run(filename)
+    return asm, asm.statistics()['steps']
+
+
+# assembler that also records the peak memory of each step, tracemalloc must run
+class PeakAssembler(Assembler):
+
+    def __init__(self, **options):
+        super().__init__(**options)
+        self.peaks : dict = {}		# name of the step -> peak memory in bytes
+
+    def timed(self, name, step, *args):
+        tracemalloc.reset_peak()
+        super().timed(name, step, *args)
+        self.peaks[name] = tracemalloc.get_traced_memory()[1]
+
+
+# assemble 'filename' once with tracemalloc, return the peak memory of each step in bytes
+def memory_run(filename, options):
+    asm = PeakAssembler(**options)
+    tracemalloc.start()
+    try:
+        asm.run(filename)
+    finally:
+        tracemalloc.stop()
+    return asm.peaks
+
+
+# run the benchmark in 'directory' and return the results as dict
+def benchmark(directory, params, options, repeat=5, memory=True):
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        filename = generate('.', **params)
+        best = {}
+        for _ in range(repeat):
+            asm, steps = timed_run(filename, options)
+            for name, step in steps.items():
+                best[name] = min(step['seconds'], best.get(name, step['seconds']))
+        peaks = memory_run(filename, options) if memory else {}
+    finally:
+        os.chdir(cwd)
+
+    total = sum(best.values())
+    lines = len(asm.full_source)
+    return {'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'assembler': ASM_VERSION,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'params': params,
+            'options': options,
+            'repeat': repeat,
+            'lines': lines,
+            'files': len(asm.sources),
+            'code_lines': len(asm.code),
+            'words': sum(len(run) for _, run in asm.image.segments),
+            'steps': best,
+            'net_blocks': {name: step['net_blocks'] for name, step in steps.items()},
+            'total': total,
+            'lines_per_s': lines / total if total else 0.0,
+            'peak_memory': peaks,
+            'peak_memory_total': max(peaks.values()) if peaks else 0}
+
+
+# results stored so far in the JSON file (a list of results)
+def read_results(name):
+    try:
+        with open(name, 'r', encoding='utf-8') as f:
+            results = json.load(f)
+    except (OSError, ValueError):
+        return []
+    return results if isinstance(results, list) else []
+
+
+def write_results(name, results):
+    with open(name, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=1)
+        f.write('\n')
+
+
+# print one result, compared with an earlier one of the same program if given
+def print_result(result, earlier=None):
+    print('{} lines in {} files, {} code lines, {} words'.format(result['lines'], result['files'],
+                                                                result['code_lines'], result['words']))
+    print()
+    print('  step           time/ms   net blocks   peak memory/KiB' +
+          ('   vs. ' + earlier['time'] if earlier else ''))
+    net_blocks = result.get('net_blocks', {})
+    for name, seconds in result['steps'].items():
+        line = '  {:<12} {:>9.2f} {:>12} {:>17}'.format(name, seconds * 1000, '{:+d}'.format(net_blocks[name])
+                                                        if name in net_blocks else '-',
+                                                        result['peak_memory'].get(name, 0) // 1024 or '-')
+        if earlier and earlier['steps'].get(name):
+            line += '   {:>+6.1f} %'.format((seconds / earlier['steps'][name] - 1) * 100)
+        print(line)
+    line = '  {:<12} {:>9.2f} {:>12} {:>17}'.format('total', result['total'] * 1000, '',
+                                                    result['peak_memory_total'] // 1024 or '-')
+    if earlier:
+        line += '   {:>+6.1f} %'.format((result['total'] / earlier['total'] - 1) * 100)
+    print(line)
+    print()
+    print('  {:.0f} lines/s'.format(result['lines_per_s']))
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(prog='ec16bench.py',
+                                     description='Benchmark for the EC16 assembler')
+    parser.add_argument('-n', '--instructions', type=int, default=20000, metavar='N',
+                        help='number of instructions (default: 20000)')
+    parser.add_argument('-m', '--labels', type=int, default=2000, metavar='M',
+                        help='number of code labels (default: 2000)')
+    parser.add_argument('--depth', type=int, default=4,
+                        help='number of nested include files (default: 4)')
+    parser.add_argument('--strings', type=int, default=200,
+                        help='number of dw_e string tables (default: 200)')
+    parser.add_argument('--gaps', type=int, default=4,
+                        help='number of org_e gaps (default: 4)')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='seed of the random program (default: 1)')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='assemble this often and keep the best time of each step (default: 5)')
+    parser.add_argument('--relax', action='store_true', help='assemble with --relax')
+    parser.add_argument('-O', dest='optimize', action='store_true', help='assemble with -O')
+    parser.add_argument('--gc', action='store_true', help='assemble with --gc')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='skip the run with tracemalloc that measures the peak memory')
+    parser.add_argument('--json', default=RESULTS_FILE, metavar='FILE',
+                        help='append the results to this JSON file (default: ' + RESULTS_FILE + ')')
+    parser.add_argument('--keep', default=None, metavar='DIR',
+                        help='write the generated program into DIR and keep it')
+    args = parser.parse_args(argv)
+
+    # Say Hello
+    print('\nEC16BENCH  ' + VERSION + ' -  Benchmark for the EC16 assembler ' + ASM_VERSION + '\n')
+
+    params = {'count': args.instructions, 'labels': args.labels, 'depth': args.depth,
+              'strings': args.strings, 'gaps': args.gaps, 'seed': args.seed}
+    options = {'relax': args.relax, 'optimize': args.optimize, 'gc': args.gc}
+    try:
+        if args.keep is not None:
+            os.makedirs(args.keep, exist_ok=True)
+            result = benchmark(args.keep, params, options, max(1, args.repeat), not args.no_memory)
+        else:
+            with tempfile.TemporaryDirectory() as directory:
+                result = benchmark(directory, params, options, max(1, args.repeat), not args.no_memory)
+    except ValueError as e:
+        print('Error:', e)
+        return 1
+    except AsmError as e:
+        for diagnostic in e.diagnostics:
+            print(diagnostic)
+            print()
+        return 1
+
+    results = read_results(args.json)
+    earlier = None
+    for old in reversed(results):
+        if old.get('params') == params and old.get('options') == options:
+            earlier = old
+            break
+    print_result(result, earlier)
+    results.append(result)
+    write_results(args.json, results)
+    print('\nResults appended to', args.json)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,850 @@
+import sys
+import json
+import time
+import argparse
+from pathlib import Path
+
+from ec16asm import (instructions, I_MNE, I_ARG1, I_ARG2, I_OPC, AsmError, assemble, opcode_cycles,
+                     read_map, map_lookup, RESET_VECTOR, IRQ_VECTORS)
+
+
+# Cycle-accurate instruction set simulator for the EC16
+#
+# The simulator executes the .bin or .ecm output of ec16asm.py and counts the
+# clock cycles exactly like the hardware does:
+#   - bits 15:14 of the opcode give the number of cycles (CYC)
+#     00 : 1 cycle, 01 : 2 cycles, 10 : 3 cycles, 11 : branch (2 taken / 1 not taken)
+#   - an interrupt inserts a call to its vector, this takes 3 cycles like CALLD
+#
+# Every opcode is decoded only once: table 'decode' holds for each of the 65536
+# possible opcode words the function that executes it, its operand (lower half of
+# the opcode) and its cycles. So the main loop does no string or bit work at all.
+
+
+# version shown in the greeting of the command line tool
+VERSION = 'V1.0.0 18-Oct-2026'
+
+# size of the memories in words
+EXTMEM_SIZE = 65536
+INTMEM_SIZE = 256
+
+# reset values, the vectors are those of the assembler (IRQ0 has the highest priority)
+RESET_PC = RESET_VECTOR
+RESET_SP = 0xFF
+
+IRQ_CYCLES = 3		# the inserted call takes as long as CALLD
+
+# bits of the STATUS register (MOV A STATUS) and of MOV FLAGS A
+F_CARRY = 0x01
+F_OVER = 0x02
+F_NEG = 0x04
+F_ZERO = 0x08
+F_IE = 0x10
+
+# reasons for the end of Simulator.run()
+STOP_CYCLES = 'cycles'		# the maximum number of cycles is reached
+STOP_STEPS = 'steps'		# the maximum number of instructions is reached
+STOP_BREAK = 'breakpoint'	# the PC reached a breakpoint
+STOP_LOOP = 'loop'		# the CPU waits in an endless loop that no interrupt can leave
+
+
+class SimError(Exception):
+    pass
+
+
+# ---  Execution of the instructions  ---
+# #######################################
+
+# Each function executes one instruction with the lower half of its opcode 'x'
+# (INTMEM address or sign extended branch offset), updates the PC and returns the
+# extra cycles that are not contained in the opcode (only a taken branch has one)
+
+def op_nop(s, x):
+    s.pc = (s.pc + 1) & 0xFFFF
+
+def op_add(s, x):
+    a = s.a
+    m = s.intmem[x]
+    r = a + m
+    s.carry = r > 0xFFFF
+    r &= 0xFFFF
+    s.over = ((a ^ r) & (m ^ r) & 0x8000) != 0
+    s.zero = r == 0
+    s.neg = r > 0x7FFF
+    s.a = r
+    s.pc = (s.pc + 1) & 0xFFFF
+
+def op_addc(s, x):
+    a = s.a
+    m = s.intmem[x]
+    r = a + m + s.carry
+    s.carry = r > 0xFFFF
+    r &= 0xFFFF
+    s.over = ((a ^ r) & (m ^ r) & 0x8000) != 0
+    s.zero = r == 0
+    s.neg = r > 0x7FFF
+    s.a = r
+    s.pc = (s.pc + 1) & 0xFFFF
+
+def op_sub(s, x):
+    a = s.a
+    m = s.intmem[x]
+    r = a - m
+    s.carry = r < 0
+    r &= 0xFFFF
+    s.over = ((a ^ m) & (a ^ r) & 0x8000) != 0
+    s.zero = r == 0
+    s.neg = r > 0x7FFF
+    s.a = r
+    s.pc = (s.pc + 1) & 0xFFFF
+
+def op_subb(s, x):
+    a = s.a
+    m = s.intmem[x]
+    r = a - m - s.carry
+    s.carry = r < 0
+    r &= 0xFFFF
+    s.over = ((a ^ m) & (a ^ r) & 0x8000) != 0
+    s.zero = r == 0
+    s.neg = r > 0x7FFF
+    s.a = r
+    s.pc = (s.pc + 1) & 0xFFFF
+
+def op_cmp(s, x):
+    a = s.a
+    m = s.intmem[x]
+    r = a - m
+    s.carry = r < 0
+    r &= 0xFFFF
+    s.over = ((a ^ m) & (a ^ r) & 0x8000) != 0
+    s.zero = r == 0
+    s.neg = r > 0x7FFF
+    s.pc = (s.pc + 1) & 0xFFFF
+
+def op_mul(s, x):
+    r = s.a * s.intmem[x]
+    s.a = r & 0xFFFF
+    s.intmem[x] = r >> 16
+    s.pc = (s.pc + 1) & 0xFFFF
+
+def op_inc(s, x):
+    r = s.intmem[x] + 1
+    s.carry = r > 0xFFFF
+    r &= 0xFFFF
+    s.over = False
+    s.zero = r == 0
+    s.neg = r > 0x7FFF
+    s.intmem[x] = r
+    s.pc = (s.pc + 1) & 0xFFFF
+
+def op_dec(s, x):
+    r = s.intmem[x] - 1
+    s.carry = r < 0
+    r &= 0xFFFF
+    s.over = False
+    s.zero = r == 0
+    s.neg = r > 0x7FFF
+    s.intmem[x] = r
+    s.pc = (s.pc + 1) & 0xFFFF
+
+# AND, OR, XOR, NOT and SWAP set ZERO and NEG and clear OVER
+def op_and(s, x):
+    r = s.a & s.intmem[x]
+    s.over = False
+    s.zero = r == 0
+    s.neg = r > 0x7FFF
+    s.a = r
+    s.pc = (s.pc + 1) & 0xFFFF
+
+def op_or(s, x):
+    r = s.a | s.intmem[x]
+    s.over = False
+    s.zero = r == 0
+    s.neg = r > 0x7FFF
+    s.a = r
+    s.pc = (s.pc + 1) & 0xFFFF
+
+def op_xor(s, x):
+    r = s.a ^ s.intmem[x]
+    s.over = False
+    s.zero = r == 0
+    s.neg = r > 0x7FFF
+    s.a = r
+    s.pc = (s.pc + 1) & 0xFFFF
+
+def op_not(s, x):
+    r = s.a ^ 0xFFFF
+    s.over = False
+    s.zero = r == 0
+    s.neg = r > 0x7FFF
+    s.a = r
+    s.pc = (s.pc + 1) & 0xFFFF
+
+def op_swap(s, x):
+    a = s.a
+    r = ((a << 8) & 0xFF00) | (a >> 8)
+    s.over = False
+    s.zero = r == 0
+    s.neg = r > 0x7FFF
+    s.a = r
+    s.pc = (s.pc + 1) & 0xFFFF
+
+# shifts and rotates move one bit through CARRY and clear OVER
+def op_rol(s, x):
+    a = s.a
+    r = ((a << 1) & 0xFFFF) | s.carry
+    s.carry = a > 0x7FFF
+    s.over = False
+    s.zero = r == 0
+    s.neg = r > 0x7FFF
+    s.a = r
+    s.pc = (s.pc + 1) & 0xFFFF
+
+def op_ror(s, x):
+    a = s.a
+    r = (a >> 1) | (s.carry << 15)
+    s.carry = (a & 1) != 0
+    s.over = False
+    s.zero = r == 0
+    s.neg = r > 0x7FFF
+    s.a = r
+    s.pc = (s.pc + 1) & 0xFFFF
+
+def op_shl(s, x):
+    a = s.a
+    r = (a << 1) & 0xFFFF
+    s.carry = a > 0x7FFF
+    s.over = False
+    s.zero = r == 0
+    s.neg = r > 0x7FFF
+    s.a = r
+    s.pc = (s.pc + 1) & 0xFFFF
+
+def op_shr(s, x):
+    a = s.a
+    r = a >> 1
+    s.carry = (a & 1) != 0
+    s.over = False
+    s.zero = r == 0
+    s.neg = False
+    s.a = r
+    s.pc = (s.pc + 1) & 0xFFFF
+
+def op_clr_c(s, x):
+    s.carry = False
+    s.pc = (s.pc + 1) & 0xFFFF
+
+def op_set_c(s, x):
+    s.carry = True
+    s.pc = (s.pc + 1) & 0xFFFF
+
+def op_clr_ie(s, x):
+    s.ie = False
+    s.pc = (s.pc + 1) & 0xFFFF
+
+def op_set_ie(s, x):
+    s.ie = True
+    s.pc = (s.pc + 1) & 0xFFFF
+
+def op_clr_int(s, x):
+    s.irr = 0
+    s.pc = (s.pc + 1) & 0xFFFF
+
+# moves between ACCU, INTMEM and the special registers
+def op_mov_m_a(s, x):
+    s.intmem[x] = s.a
+    s.pc = (s.pc + 1) & 0xFFFF
+
+def op_mov_a_m(s, x):
+    s.a = s.intmem[x]
+    s.pc = (s.pc + 1) & 0xFFFF
+
+def op_mov_a_status(s, x):
+    s.a = s.status()
+    s.pc = (s.pc + 1) & 0xFFFF
+
+def op_mov_flags_a(s, x):
+    a = s.a
+    s.carry = (a & F_CARRY) != 0
+    s.over = (a & F_OVER) != 0
+    s.neg = (a & F_NEG) != 0
+    s.zero = (a & F_ZERO) != 0
+    s.ie = (a & F_IE) != 0
+    s.pc = (s.pc + 1) & 0xFFFF
+
+def op_mov_imask_a(s, x):
+    s.imask = s.a & 0x0F
+    s.pc = (s.pc + 1) & 0xFFFF
+
+def op_mov_sp_a(s, x):
+    s.sp = s.a & 0xFF
+    s.pc = (s.pc + 1) & 0xFFFF
+
+def op_load_m(s, x):
+    pc = s.pc
+    s.intmem[x] = s.extmem[(pc + 1) & 0xFFFF]
+    s.pc = (pc + 2) & 0xFFFF
+
+def op_load_a(s, x):
+    pc = s.pc
+    s.a = s.extmem[(pc + 1) & 0xFFFF]
+    s.pc = (pc + 2) & 0xFFFF
+
+# indirect moves, the pointer is taken from INTMEM
+def op_movi_m_a(s, x):
+    intmem = s.intmem
+    intmem[intmem[x] & 0xFF] = s.a
+    s.pc = (s.pc + 1) & 0xFFFF
+
+def op_movi_a_m(s, x):
+    intmem = s.intmem
+    s.a = intmem[intmem[x] & 0xFF]
+    s.pc = (s.pc + 1) & 0xFFFF
+
+def op_movxi_m_a(s, x):
+    addr = s.intmem[x]
+    if addr in s.io_write:
+        s.io_write[addr](s.a)
+    else:
+        s.extmem[addr] = s.a
+    s.pc = (s.pc + 1) & 0xFFFF
+
+def op_movxi_a_m(s, x):
+    addr = s.intmem[x]
+    if addr in s.io_read:
+        s.a = s.io_read[addr]() & 0xFFFF
+    else:
+        s.a = s.extmem[addr]
+    s.pc = (s.pc + 1) & 0xFFFF
+
+# the stack grows downwards in INTMEM, SP points to the next free word
+def op_push(s, x):
+    sp = s.sp
+    s.intmem[sp] = s.a
+    s.sp = (sp - 1) & 0xFF
+    s.pc = (s.pc + 1) & 0xFFFF
+
+def op_pop(s, x):
+    sp = (s.sp + 1) & 0xFF
+    s.a = s.intmem[sp]
+    s.sp = sp
+    s.pc = (s.pc + 1) & 0xFFFF
+
+def op_jmpd(s, x):
+    s.pc = s.extmem[(s.pc + 1) & 0xFFFF]
+
+def op_jmpi(s, x):
+    s.pc = s.intmem[x]
+
+def op_calld(s, x):
+    pc = s.pc
+    sp = s.sp
+    s.intmem[sp] = (pc + 2) & 0xFFFF
+    s.sp = (sp - 1) & 0xFF
+    s.pc = s.extmem[(pc + 1) & 0xFFFF]
+
+def op_calli(s, x):
+    sp = s.sp
+    s.intmem[sp] = (s.pc + 1) & 0xFFFF
+    s.sp = (sp - 1) & 0xFF
+    s.pc = s.intmem[x]
+
+def op_rets(s, x):
+    sp = (s.sp + 1) & 0xFF
+    s.pc = s.intmem[sp]
+    s.sp = sp
+
+def op_reti(s, x):
+    sp = (s.sp + 1) & 0xFF
+    s.pc = s.intmem[sp]
+    s.sp = sp
+    # the interrupt in progress with the highest priority is the one that ends
+    iip = s.iip
+    s.iip = iip & (iip - 1)
+
+# conditional branches, 'x' is the sign extended offset
+# the offset is added to the address of the next instruction
+def op_brcc(s, x):
+    if s.carry:
+        s.pc = (s.pc + 1) & 0xFFFF
+        return 0
+    s.pc = (s.pc + 1 + x) & 0xFFFF
+    return 1
+
+def op_brcs(s, x):
+    if not s.carry:
+        s.pc = (s.pc + 1) & 0xFFFF
+        return 0
+    s.pc = (s.pc + 1 + x) & 0xFFFF
+    return 1
+
+def op_broc(s, x):
+    if s.over:
+        s.pc = (s.pc + 1) & 0xFFFF
+        return 0
+    s.pc = (s.pc + 1 + x) & 0xFFFF
+    return 1
+
+def op_bros(s, x):
+    if not s.over:
+        s.pc = (s.pc + 1) & 0xFFFF
+        return 0
+    s.pc = (s.pc + 1 + x) & 0xFFFF
+    return 1
+
+def op_brnc(s, x):
+    if s.neg:
+        s.pc = (s.pc + 1) & 0xFFFF
+        return 0
+    s.pc = (s.pc + 1 + x) & 0xFFFF
+    return 1
+
+def op_brns(s, x):
+    if not s.neg:
+        s.pc = (s.pc + 1) & 0xFFFF
+        return 0
+    s.pc = (s.pc + 1 + x) & 0xFFFF
+    return 1
+
+def op_brzc(s, x):
+    if s.zero:
+        s.pc = (s.pc + 1) & 0xFFFF
+        return 0
+    s.pc = (s.pc + 1 + x) & 0xFFFF
+    return 1
+
+def op_brzs(s, x):
+    if not s.zero:
+        s.pc = (s.pc + 1) & 0xFFFF
+        return 0
+    s.pc = (s.pc + 1 + x) & 0xFFFF
+    return 1
+
+def op_illegal(s, x):
+    raise SimError('Illegal opcode 0x%04X at address 0x%04X' % (s.extmem[s.pc], s.pc))
+
+
+# function executing each instruction of table 'instructions'
+# key is (mnemonic, arg1, arg2) as in that table
+executors : dict = {('add', 'a', '#U8'): op_add,
+                    ('addc', 'a', '#U8'): op_addc,
+                    ('and', 'a', '#U8'): op_and,
+                    ('brcc', '#S8', ''): op_brcc,
+                    ('brcs', '#S8', ''): op_brcs,
+                    ('brnc', '#S8', ''): op_brnc,
+                    ('brns', '#S8', ''): op_brns,
+                    ('broc', '#S8', ''): op_broc,
+                    ('bros', '#S8', ''): op_bros,
+                    ('brzc', '#S8', ''): op_brzc,
+                    ('brzs', '#S8', ''): op_brzs,
+                    ('calld', '#U16', ''): op_calld,
+                    ('calli', '#U8', ''): op_calli,
+                    ('clr', 'c', ''): op_clr_c,
+                    ('clr', 'ie', ''): op_clr_ie,
+                    ('clr', 'int', ''): op_clr_int,
+                    ('cmp', 'a', '#U8'): op_cmp,
+                    ('dec', '#U8', ''): op_dec,
+                    ('inc', '#U8', ''): op_inc,
+                    ('jmpd', '#U16', ''): op_jmpd,
+                    ('jmpi', '#U8', ''): op_jmpi,
+                    ('mov', '#U8', 'a'): op_mov_m_a,
+                    ('mov', 'a', '#U8'): op_mov_a_m,
+                    ('mov', 'a', 'status'): op_mov_a_status,
+                    ('mov', 'flags', 'a'): op_mov_flags_a,
+                    ('mov', 'imask', 'a'): op_mov_imask_a,
+                    ('mov', 'sp', 'a'): op_mov_sp_a,
+                    ('load', '#U8', '#U16'): op_load_m,
+                    ('load', 'a', '#U16'): op_load_a,
+                    ('movi', '#U8', 'a'): op_movi_m_a,
+                    ('movi', 'a', '#U8'): op_movi_a_m,
+                    ('movxi', '#U8', 'a'): op_movxi_m_a,
+                    ('movxi', 'a', '#U8'): op_movxi_a_m,
+                    ('mul', 'a', '#U8'): op_mul,
+                    ('nop', '', ''): op_nop,
+                    ('not', 'a', ''): op_not,
+                    ('or', 'a', '#U8'): op_or,
+                    ('pop', 'a', ''): op_pop,
+                    ('push', 'a', ''): op_push,
+                    ('reti', '', ''): op_reti,
+                    ('rets', '', ''): op_rets,
+                    ('rol', 'a', ''): op_rol,
+                    ('ror', 'a', ''): op_ror,
+                    ('set', 'c', ''): op_set_c,
+                    ('set', 'ie', ''): op_set_ie,
+                    ('shl', 'a', ''): op_shl,
+                    ('shr', 'a', ''): op_shr,
+                    ('sub', 'a', '#U8'): op_sub,
+                    ('subb', 'a', '#U8'): op_subb,
+                    ('swap', 'a', ''): op_swap,
+                    ('xor', 'a', '#U8'): op_xor}
+
+
+# ---  Setup simulator : create the decode table from table of instructions  ---
+# ##############################################################################
+
+# the upper half of an opcode selects the instruction
+# upper half of opcode -> entry of table 'instructions'
+opcode_instructions : dict = {}
+
+# opcode word -> (function, operand, cycles)
+decode : list = []
+
+for instr in instructions:
+    key = int(instr[I_OPC], 16) >> 8
+    # Debug! Should only be invoked when making changes to 'instructions'
+    if key in opcode_instructions or (instr[I_MNE], instr[I_ARG1], instr[I_ARG2]) not in executors:
+        print('Error! Instructions table does not match the simulator')
+    opcode_instructions[key] = instr
+
+for upper in range(256):
+    instr = opcode_instructions.get(upper)
+    # a branch takes the minimum, its function adds one cycle if it is taken
+    cycles = opcode_cycles(upper << 8)[0]
+    if instr is None:
+        decode.extend([(op_illegal, 0, 0)] * 256)
+        continue
+    function = executors[(instr[I_MNE], instr[I_ARG1], instr[I_ARG2])]
+    if instr[I_ARG1] == '#S8':
+        # branch offsets are sign extended
+        decode.extend([(function, lower - 256 if lower > 127 else lower, cycles)
+                       for lower in range(256)])
+    else:
+        decode.extend([(function, lower, cycles) for lower in range(256)])
+
+
+# text of the instruction at 'addr' as it would be written in the asm file
+def disassemble(extmem, addr):
+    opcode = extmem[addr]
+    instr = opcode_instructions.get(opcode >> 8)
+    if instr is None:
+        return 'dw_e 0x%04X' % opcode
+    args = []
+    for arg in (instr[I_ARG1], instr[I_ARG2]):
+        if arg == '#U8':
+            args.append('0x%02X' % (opcode & 0xFF))
+        elif arg == '#S8':
+            args.append('0x%04X' % ((addr + 1 + decode[opcode][1]) & 0xFFFF))
+        elif arg == '#U16':
+            args.append('0x%04X' % extmem[(addr + 1) & 0xFFFF])
+        elif arg:
+            args.append(arg)
+    return ' '.join([instr[I_MNE]] + args)
+
+
+# ################################################################################
+# ################################################################################
+
+# the simulator keeps the complete state of one EC16 with its memories
+class Simulator:
+
+    def __init__(self):
+        self.extmem : list = [0] * EXTMEM_SIZE  # code, data and I/O
+        self.intmem : list = [0] * INTMEM_SIZE  # registers, stack and scratch pad memory
+        # memory mapped I/O accessed by MOVXI: address -> function
+        # io_read functions return the value, io_write functions receive it
+        self.io_read : dict = {}
+        self.io_write : dict = {}
+        # source map of the program loaded (see ec16asm.py), None if there is none
+        self.srcmap = None
+        self.reset()
+
+    # reset the CPU, the memories keep their contents
+    def reset(self):
+        self.pc : int = RESET_PC
+        self.sp : int = RESET_SP
+        self.a : int = 0
+        # flags
+        self.zero : bool = False
+        self.neg : bool = False
+        self.over : bool = False
+        self.carry : bool = False
+        self.ie : bool = False
+        # interrupt control, bit n belongs to IRQn
+        self.irr : int = 0     # Interrupt Request Register
+        self.imask : int = 0   # interrupt mask
+        self.iip : int = 0     # Interrupt In Progress
+        # rising edges on the interrupt inputs still to come: list of (cycle, IRQ number)
+        self.events : list = []
+        # counters
+        self.cycles : int = 0
+        self.steps : int = 0
+
+    # content of the STATUS register: SP, IE and the flags
+    def status(self):
+        return ((self.sp << 8) | (self.ie and F_IE) | (self.zero and F_ZERO) |
+                (self.neg and F_NEG) | (self.over and F_OVER) | (self.carry and F_CARRY))
+
+    # ---  Loading of programs  ---
+
+    # load a text file in the ECMON format, e.g. 8000=a100 807f a100 80d4
+    def load_ecm(self, text):
+        for num, line in enumerate(text.splitlines()):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                addr, words = line.split('=')
+                addr = int(addr, 16)
+                for word in words.split():
+                    value = int(word, 16)
+                    if not 0 <= value <= 0xFFFF:
+                        raise ValueError
+                    self.extmem[addr & 0xFFFF] = value
+                    addr += 1
+            except ValueError:
+                raise SimError('Error in ECMON data at line ' + str(num + 1) + ': ' + line) from None
+
+    # load a .bin file, one word per line as 16 binary digits, starting at 'base'
+    def load_bin(self, text, base=0):
+        addr = base
+        for num, line in enumerate(text.splitlines()):
+            line = line.strip()
+            if not line:
+                continue
+            if len(line) != 16 or line.strip('01'):
+                raise SimError('Error in bin data at line ' + str(num + 1) + ': ' + line)
+            self.extmem[addr & 0xFFFF] = int(line, 2)
+            addr += 1
+
+    # load a .ecm or .bin file or assemble an .asm file and load the result
+    # the source map is taken from the assembler or from the .map file next to the file
+    def load_file(self, filename, base=0):
+        suffix = Path(filename).suffix.lower()
+        if suffix == '.asm':
+            result = assemble(filename)
+            self.load_ecm(result.ecmon)
+            self.srcmap = json.loads(result.map)
+            return
+        try:
+            self.srcmap = read_map(Path(filename).with_suffix('.map'))
+        except (OSError, ValueError):
+            self.srcmap = None
+        try:
+            with open(filename, 'r', encoding="utf-8") as f:
+                text = f.read()
+        except OSError as e:
+            raise SimError('Error opening file! ' + str(e)) from None
+        if suffix == '.bin':
+            self.load_bin(text, base)
+        else:
+            self.load_ecm(text)
+
+    # source file and line of the instruction at 'addr' as text, '' if not known
+    def source(self, addr):
+        if self.srcmap is None:
+            return ''
+        found = map_lookup(self.srcmap, addr)
+        if found is None:
+            return ''
+        return '%s:%d' % found
+
+    # ---  Interrupts  ---
+
+    # rising edge on interrupt input IRQn, it is registered in IRRn
+    def irq(self, n):
+        self.irr |= 1 << n
+
+    # schedule a rising edge on IRQn at the given cycle
+    def schedule_irq(self, cycle, n):
+        self.events.append((cycle, n))
+        self.events.sort()
+
+    # the interrupt that is taken next or -1 if none:
+    # the highest priority pending one that is enabled and not blocked by an
+    # interrupt in progress with the same or a higher priority
+    def next_interrupt(self):
+        if not self.ie:
+            return -1
+        pending = self.irr & self.imask
+        if not pending:
+            return -1
+        n = (pending & -pending).bit_length() - 1
+        if self.iip & ((2 << n) - 1):
+            return -1
+        return n
+
+    # insert a call to the vector of interrupt 'n', returns its cycles
+    def take_interrupt(self, n):
+        self.irr &= ~(1 << n)
+        self.iip |= 1 << n
+        sp = self.sp
+        self.intmem[sp] = self.pc
+        self.sp = (sp - 1) & 0xFF
+        self.pc = IRQ_VECTORS[n]
+        return IRQ_CYCLES
+
+    # ---  Execution  ---
+
+    # execute one instruction (or take an interrupt and execute the first instruction
+    # of its service routine), returns the cycles it took
+    def step(self):
+        cycles = 0
+        while self.events and self.events[0][0] <= self.cycles:
+            self.irq(self.events.pop(0)[1])
+        if self.irr:
+            n = self.next_interrupt()
+            if n >= 0:
+                cycles = self.take_interrupt(n)
+        function, x, opcycles = decode[self.extmem[self.pc]]
+        extra = function(self, x)
+        if extra:
+            opcycles += extra
+        cycles += opcycles
+        self.cycles += cycles
+        self.steps += 1
+        return cycles
+
+    # execute instructions until one of the limits is reached, the PC reaches one of
+    # the 'breakpoints' or the CPU waits in an endless loop (a jump or branch to
+    # itself) that no interrupt can leave, returns the reason (STOP_...)
+    def run(self, max_cycles=None, max_steps=None, breakpoints=()):
+        # the main loop keeps counters in local variables and calls the functions
+        # of table 'decode' directly, everything else is checked only when necessary
+        ext = self.extmem
+        table = decode
+        stops = frozenset(breakpoints)
+        cycle_limit = self.cycles + max_cycles if max_cycles is not None else float('inf')
+        step_limit = self.steps + max_steps if max_steps is not None else float('inf')
+        cycles = self.cycles
+        steps = self.steps
+        events = self.events
+        next_event = events[0][0] if events else float('inf')
+        reason = None
+
+        try:
+            while True:
+                if cycles >= next_event:
+                    while events and events[0][0] <= cycles:
+                        self.irq(events.pop(0)[1])
+                    next_event = events[0][0] if events else float('inf')
+                if self.irr:
+                    n = self.next_interrupt()
+                    if n >= 0:
+                        cycles += self.take_interrupt(n)
+                pc = self.pc
+                if stops and pc in stops:
+                    reason = STOP_BREAK
+                    break
+                function, x, opcycles = table[ext[pc]]
+                extra = function(self, x)
+                if extra:
+                    opcycles += extra
+                cycles += opcycles
+                steps += 1
+                if self.pc == pc:
+                    # an endless loop is only left by an interrupt
+                    if not events and self.next_interrupt() < 0:
+                        reason = STOP_LOOP
+                        break
+                    # wait for the next rising edge without executing every loop
+                    if (cycles < next_event < cycle_limit and step_limit == float('inf')
+                            and self.next_interrupt() < 0):
+                        loops = (next_event - cycles + opcycles - 1) // opcycles
+                        cycles += loops * opcycles
+                        steps += loops
+                if cycles >= cycle_limit:
+                    reason = STOP_CYCLES
+                    break
+                if steps >= step_limit:
+                    reason = STOP_STEPS
+                    break
+        finally:
+            self.cycles = cycles
+            self.steps = steps
+        return reason
+
+
+# ---  Command line tool  ---
+# ###########################
+
+# parse an IRQ event of the command line, e.g. 1000:2 for IRQ2 at cycle 1000
+def irq_event(text):
+    try:
+        cycle, n = text.split(':')
+        cycle = int(cycle, 0)
+        n = int(n, 0)
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected CYCLE:IRQ, e.g. 1000:2') from None
+    if not 0 <= n < len(IRQ_VECTORS):
+        raise argparse.ArgumentTypeError('IRQ number must be 0 to ' + str(len(IRQ_VECTORS) - 1))
+    return cycle, n
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(prog='ec16sim.py',
+                                     description='Simulator for the EC16 microprocessor')
+    parser.add_argument('file', help='.ecm or .bin file to execute, an .asm file is assembled first')
+    parser.add_argument('--base', type=lambda s: int(s, 0), default=0,
+                        help='load address of a .bin file (default: 0)')
+    parser.add_argument('--cycles', type=lambda s: int(s, 0), default=None,
+                        help='stop after this number of cycles')
+    parser.add_argument('--steps', type=lambda s: int(s, 0), default=None,
+                        help='stop after this number of instructions')
+    parser.add_argument('--break', dest='breakpoints', type=lambda s: int(s, 0),
+                        action='append', default=[], metavar='ADDR',
+                        help='stop when the PC reaches this address (can be repeated)')
+    parser.add_argument('--irq', type=irq_event, action='append', default=[],
+                        metavar='CYCLE:IRQ', help='rising edge on an interrupt input at a cycle')
+    parser.add_argument('--clock', type=float, default=20.0,
+                        help='clock frequency in MHz for the run time (default: 20)')
+    parser.add_argument('--trace', action='store_true',
+                        help='print every executed instruction')
+    args = parser.parse_args(argv)
+
+    # Say Hello
+    print('\nEC16SIM  ' + VERSION + ' -  Simulator for the EC16 microprocessor\n')
+
+    sim = Simulator()
+    try:
+        sim.load_file(args.file, args.base)
+    except AsmError as e:
+        for diagnostic in e.diagnostics:
+            print(diagnostic)
+            print()
+        return 1
+    except SimError as e:
+        print(e)
+        return 1
+    for cycle, n in args.irq:
+        sim.schedule_irq(cycle, n)
+
+    start = time.perf_counter()
+    try:
+        if args.trace:
+            # single steps with the same stop conditions as Simulator.run()
+            reason = None
+            while reason is None:
+                pc = sim.pc
+                if pc in args.breakpoints:
+                    reason = STOP_BREAK
+                    break
+                sim.step()
+                print(('%10d  0x%04X  %-22s A=0x%04X  SP=0x%02X  %s' %
+                       (sim.cycles, pc, disassemble(sim.extmem, pc), sim.a, sim.sp, sim.source(pc))).rstrip())
+                if sim.pc == pc and not sim.events and sim.next_interrupt() < 0:
+                    reason = STOP_LOOP
+                elif args.cycles is not None and sim.cycles >= args.cycles:
+                    reason = STOP_CYCLES
+                elif args.steps is not None and sim.steps >= args.steps:
+                    reason = STOP_STEPS
+        else:
+            reason = sim.run(args.cycles, args.steps, args.breakpoints)
+    except SimError as e:
+        print(e)
+        return 1
+    elapsed = time.perf_counter() - start
+
+    source = sim.source(sim.pc)
+    print('Stopped at 0x%04X (%s)' % (sim.pc, reason) + ('  ' + source if source else ''))
+    print('A=0x%04X  SP=0x%02X  STATUS=0x%04X  IMASK=0x%X  IRR=0x%X  IIP=0x%X' %
+          (sim.a, sim.sp, sim.status(), sim.imask, sim.irr, sim.iip))
+    print('%d instructions, %d cycles = %.3f ms at %g MHz' %
+          (sim.steps, sim.cycles, sim.cycles / (args.clock * 1000), args.clock))
+    if elapsed > 0:
+        print('Simulated %.2f million instructions per second' % (sim.steps / elapsed / 1e6))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,292 @@
+import os
+import tempfile
+import unittest
+
+from ec16asm import AsmError, BuildCache, assemble, compile_object, link_objects, main
+
+
+# words of the EXTMEM image of a Result: address -> word
+def image_words(result):
+    words = {}
+    for addr, run in result.image.segments:
+        for num, word in enumerate(run):
+            words[addr + num] = word
+    return words
+
+
+# error messages of a source that does not assemble, all errors are collected
+def error_messages(test, source, **options):
+    with test.assertRaises(AsmError) as caught:
+        assemble('err.asm', source, max_errors=0, **options)
+    return [diagnostic.message for diagnostic in caught.exception.diagnostics]
+
+
+# operands and data given as expressions
+class Expressions(unittest.TestCase):
+
+    def test_precedence(self):
+        result = assemble('expr.asm', '        org_e   0\n'
+                                      '        dw_e    1+2*3 (1+2)*3 1|2&3 1<<2+1 7-2-1 -1+2 ~0 17%5\n')
+        words = image_words(result)
+        self.assertEqual([words[addr] for addr in range(8)], [7, 9, 3, 8, 4, 1, 0xFFFF, 2])
+
+    def test_hi_lo_and_address(self):
+        result = assemble('expr.asm', '        org_e   0x0100\n'
+                                      'start   nop\n'
+                                      '        dw_e    hi(start+0x200) lo(0x1234) $ $+1 table-start\n'
+                                      'table   nop\n')
+        words = image_words(result)
+        self.assertEqual([words[addr] for addr in range(0x101, 0x106)], [0x03, 0x34, 0x101, 0x102, 6])
+
+    def test_equ_and_res_i(self):
+        result = assemble('expr.asm', '        org_i   0x10\n'
+                                      'size    equ     4\n'
+                                      'len     equ     size*2+1\n'
+                                      'buf     res_i   len-1\n'
+                                      'next    res_i   1\n')
+        self.assertEqual(result.symbols.value('len'), 9)
+        self.assertEqual(result.symbols.value('next'), 0x18)
+
+    def test_errors(self):
+        messages = error_messages(self, '        org_e   0\n'
+                                        '        load    a   (1+2\n'
+                                        '        load    a   nolabel+1\n')
+        self.assertEqual(messages, ['Error in expression: ")" expected', 'Error: Label "nolabel" not defined'])
+
+
+# EQU values and res_e sizes that depend on addresses must follow the code when
+# it is moved after step 3 (peephole optimizer, linker)
+class AddressDependentValues(unittest.TestCase):
+
+    def test_optimizer(self):
+        source = ('        org_e   0\n'
+                  'start   push    a\n'
+                  '        pop     a\n'
+                  'fin     nop\n'
+                  'len     equ     fin-start\n'
+                  'data    dw_e    len fin-start len*2\n'
+                  'pad     res_e   0x20-$\n'
+                  'end     nop\n')
+        result = assemble('opt.asm', source, optimize=True)
+        symbols = result.symbols
+        self.assertEqual(symbols.value('fin'), 0)
+        self.assertEqual(symbols.value('len'), 0)
+        data = [line for line in result.code if line.label == 'data'][0]
+        self.assertEqual(list(data.words), [0, 0, 0])
+        self.assertEqual(symbols.value('end'), 0x20)
+
+    def test_relax(self):
+        result = assemble('relax.asm', '        org_e   0\n'
+                                       'start   brzc    far\n'
+                                       'fin     nop\n'
+                                       'len     equ     fin-start\n'
+                                       '        org_e   0x200\n'
+                                       'far     rets\n', relax=True)
+        self.assertEqual(result.symbols.value('len'), 3)
+
+    def test_link(self):
+        first = compile_object('a.asm', '        org_e   0\n' + '        nop\n' * 6)
+        second = compile_object('b.asm', 'subr    nop\n'
+                                         'here    equ     subr\n'
+                                         '        load    a   here\n'
+                                         '        load    a   here+1\n'
+                                         '        rets\n')
+        result = link_objects([('a.asm', first), ('b.asm', second)], 'a.asm')
+        self.assertEqual(result.symbols.value('subr'), 6)
+        self.assertEqual(result.symbols.value('here'), 6)
+        loads = [line.arg for line in result.code if line.mne == 'load']
+        self.assertEqual(loads, [6, 7])
+
+
+# the offset of a branch is a signed byte added to the address after the branch
+class BranchRange(unittest.TestCase):
+
+    def test_forward(self):
+        result = assemble('fwd.asm', '        org_e   0\n'
+                                     '        brzc    target\n'
+                                     '        org_e   0x80\n'
+                                     'target  nop\n')
+        self.assertEqual(image_words(result)[0], 0xC37F)
+        messages = error_messages(self, '        org_e   0\n'
+                                        '        brzc    target\n'
+                                        '        org_e   0x81\n'
+                                        'target  nop\n')
+        self.assertEqual(messages, ['Error: Destination out of reach (-128 .. +127)'])
+
+    def test_backward(self):
+        result = assemble('back.asm', '        org_e   0\n'
+                                      'target  nop\n'
+                                      '        org_e   0x7F\n'
+                                      '        brzc    target\n')
+        self.assertEqual(image_words(result)[0x7F], 0xC380)
+        messages = error_messages(self, '        org_e   0\n'
+                                        'target  nop\n'
+                                        '        org_e   0x80\n'
+                                        '        brzc    target\n')
+        self.assertEqual(messages, ['Error: Destination out of reach (-128 .. +127)'])
+
+    def test_relaxed(self):
+        result = assemble('relax.asm', '        org_e   0\n'
+                                       '        brzc    far\n'
+                                       '        org_e   0x200\n'
+                                       'far     rets\n', relax=True)
+        words = image_words(result)
+        self.assertEqual([words[0], words[1], words[2]], [0xC702, 0xA000, 0x0200])
+
+
+# all errors of a run are reported, also those found when linking
+class CollectedErrors(unittest.TestCase):
+
+    def test_range_errors_with_other_errors(self):
+        messages = error_messages(self, '        org_e   0\n'
+                                        '        mov     a   300\n'
+                                        '        brzs    far\n'
+                                        '        frob    a\n'
+                                        '        load    a   nolabel\n'
+                                        '        org_e   0x200\n'
+                                        'far     rets\n')
+        self.assertEqual(messages, ['Error: Argument too big, must be 0 .. 255',
+                                    'Error: Destination out of reach (-128 .. +127)',
+                                    'Error: Mnemonic or directive expected.',
+                                    'Error: Label "nolabel" not defined'])
+
+    def test_jobs_below_one(self):
+        with self.assertRaises(SystemExit):
+            main(['--batch', 'none.asm', '-j', '0'])
+
+
+# macros, rept and conditional assembly
+class Preprocessor(unittest.TestCase):
+
+    def test_local_labels(self):
+        # a user label 'l_1' must not collide with the 'l@' of the first expansion
+        source = ('        org_i   0x10\n'
+                  'v       res_i   1\n'
+                  '        org_e   0\n'
+                  'wait    macro\n'
+                  'l@      dec     v\n'
+                  '        brzc    l@\n'
+                  '        endm\n'
+                  'l_1     nop\n'
+                  '        wait\n'
+                  '        wait\n'
+                  '        jmpd    l_1\n')
+        result = assemble('mac.asm', source)
+        symbols = result.symbols
+        self.assertEqual(symbols.value('l_1'), 0)
+        self.assertEqual(symbols.value('l@1'), 1)
+        self.assertEqual(symbols.value('l@2'), 3)
+        self.assertEqual(image_words(result)[6], 0)
+
+    def test_at_names(self):
+        messages = error_messages(self, '        org_e   0\n'
+                                        'm       macro\n'
+                                        'x@1     nop\n'
+                                        '        endm\n'
+                                        'y@      nop\n')
+        self.assertEqual(messages, ['Error: no digit must follow the \'@\' in "x@1"',
+                                    "Error: '@' is only allowed in names in the body of a macro"])
+
+    def test_label_named_like_macro(self):
+        result = assemble('mac.asm', '        org_e   0\n'
+                                     'foo     macro   n\n'
+                                     '        dw_e    n\n'
+                                     '        endm\n'
+                                     'foo     nop\n'
+                                     'bar     foo     3\n'
+                                     '        foo     4\n'
+                                     '        jmpd    foo\n')
+        self.assertEqual(result.symbols.value('foo'), 0)
+        self.assertEqual(result.symbols.value('bar'), 1)
+        words = image_words(result)
+        self.assertEqual([words[addr] for addr in range(5)], [0, 3, 4, 0xA000, 0])
+
+    def test_rept_and_nested_if(self):
+        source = ('        org_e   0\n'
+                  'debug   equ     1\n'
+                  'count   equ     3\n'
+                  '        rept    count-1\n'
+                  '        if      debug\n'
+                  '        if      count&4\n'
+                  '        dw_e    1\n'
+                  '        else\n'
+                  '        dw_e    2\n'
+                  '        endif\n'
+                  '        else\n'
+                  '        dw_e    3\n'
+                  '        endif\n'
+                  '        endr\n'
+                  '        ifndef  nothing\n'
+                  '        dw_e    4\n'
+                  '        endif\n')
+        words = image_words(assemble('rept.asm', source))
+        self.assertEqual(words, {0: 2, 1: 2, 2: 4})
+
+
+# objects and the linker
+class Linker(unittest.TestCase):
+
+    def test_externals(self):
+        first = compile_object('o1.asm', '        org_e   0x0100\n'
+                                         'start   load    a   tab+2\n'
+                                         '        jmpd    sub1+1\n'
+                                         '        dw_e    hi(tab) lo(tab)\n')
+        second = compile_object('o2.asm', '        org_e   0x0200\n'
+                                          'sub1    nop\n'
+                                          '        rets\n'
+                                          'tab     dw_e    1 2 3\n')
+        words = image_words(link_objects([('o1.asm', first), ('o2.asm', second)], 'o1.asm'))
+        self.assertEqual([words[addr] for addr in range(0x100, 0x106)],
+                         [0x6000, 0x0204, 0xA000, 0x0201, 0x0002, 0x0002])
+
+    def test_undefined_external(self):
+        first = compile_object('o1.asm', '        org_e   0\n'
+                                         '        jmpd    nowhere\n')
+        with self.assertRaises(AsmError) as caught:
+            link_objects([('o1.asm', first)], 'o1.asm')
+        self.assertEqual(caught.exception.diagnostics[0].message, 'Error: Label not defined in any object')
+
+
+# peephole optimizer (-O) and dead code elimination (--gc)
+class Optimizer(unittest.TestCase):
+
+    def test_peephole_rules(self):
+        source = ('        org_i   0x10\n'
+                  'v       res_i   1\n'
+                  '        org_e   0\n'
+                  'start   push    a\n'
+                  '        pop     a\n'
+                  '        mov     a   v\n'
+                  '        mov     v   a\n'
+                  '        jmpd    next\n'
+                  'next    jmpd    start\n')
+        result = assemble('peep.asm', source, optimize=True)
+        used = sorted(rule for rule, (count, words, cycles) in result.peephole.items() if count)
+        self.assertEqual(used, ['jmpd to next', 'mov a X / mov X a', 'push a / pop a'])
+        self.assertEqual(result.symbols.value('next'), 1)
+
+    def test_dead_code(self):
+        result = assemble('gc.asm', '        org_e   0\n'
+                                    'start   jmpd    start\n'
+                                    'dead    nop\n'
+                                    '        nop\n', gc=True)
+        self.assertEqual(result.gc_blocks, [('dead', 3, 2)])
+        self.assertEqual(image_words(result), {0: 0xA000, 1: 0})
+
+
+# tokens read back from the cache directory are the same as those of the lexer
+class Cache(unittest.TestCase):
+
+    def test_tokens_from_disk(self):
+        source = '        org_e   0\n        dw_e    1, 2, "a;b"\n'
+        with tempfile.TemporaryDirectory() as directory:
+            first = assemble('cache.asm', source, cache=BuildCache(directory))
+            # other options, so the outputs are not taken from the cache, but the tokens
+            second = assemble('cache.asm', source, cache=BuildCache(directory), optimize=True)
+            self.assertTrue(any(name.startswith('tok') for name in os.listdir(directory)))
+        self.assertEqual(image_words(first), image_words(second))
+        self.assertEqual(image_words(second), {0: 1, 1: 2, 2: ord('a'), 3: ord(';'), 4: ord('b')})
+
+
+if __name__ == '__main__':
+    unittest.main()